@@ -0,0 +1,137 @@
+"""Заранее сгенерированные варианты шагов для кнопки "🔄 Переписать".
+
+Сразу после показа декомпозиции одним запросом к LLM генерируется по несколько
+вариантов каждого шага. Переписывание шага берёт следующий вариант из пула
+без обращения к LLM; когда вариантов шага остаётся мало, пул пополняется в
+фоне. Число фоновых запросов на задачу ограничено ALTERNATIVES_MAX_CALLS.
+"""
+import os
+import asyncio
+from collections import OrderedDict, deque
+
+from logging_setup import get_logger
+
+ALTERNATIVES_ENABLED = os.getenv("ALTERNATIVES_ENABLED", "1") == "1"
+# Сколько вариантов каждого шага генерировать за один запрос
+ALTERNATIVES_PER_STEP = int(os.getenv("ALTERNATIVES_PER_STEP", 3))
+# Сколько фоновых запросов к LLM допускается на одну задачу (первое заполнение и пополнения)
+ALTERNATIVES_MAX_CALLS = int(os.getenv("ALTERNATIVES_MAX_CALLS", 3))
+# Пополнять шаг, когда вариантов осталось не больше стольких
+ALTERNATIVES_REFILL_BELOW = 1
+# Для скольких задач хранить варианты (старые вытесняются)
+ALTERNATIVES_MAX_TASKS = 10000
+# Сколько ждать уже идущей генерации, прежде чем переписать шаг отдельным запросом, с.
+# Фоновая генерация может стоять в очереди к Gemini за запросами всех остальных, поэтому ждём недолго
+ALTERNATIVES_WAIT_SECONDS = 3
+
+log = get_logger('alternatives')
+
+
+class _TaskAlternatives:
+    def __init__(self, task_id, task_name, steps):
+        self.task_id = task_id
+        self.task_name = task_name
+        self.steps = list(steps)
+        self.pool = {index: deque() for index in range(len(self.steps))}
+        # Уже показанные формулировки шагов - повторно не предлагаем
+        self.shown = {index: {step} for index, step in enumerate(self.steps)}
+        self.calls = 0
+        self.pending = None
+
+
+class AlternativesPool:
+    """Варианты шагов текущей задачи каждого пользователя.
+
+    generate(task_name, steps, count) - корутина, которая получает задачу и
+    {номер шага: текст} и возвращает {номер шага: [до count вариантов]}.
+    """
+
+    def __init__(self, generate, per_step=ALTERNATIVES_PER_STEP, max_calls=ALTERNATIVES_MAX_CALLS,
+                 max_tasks=ALTERNATIVES_MAX_TASKS):
+        self.generate = generate
+        self.per_step = per_step
+        self.max_calls = max_calls
+        self.max_tasks = max_tasks
+        self._tasks = OrderedDict()
+
+    def fill(self, user_id, task_id, task_name, steps):
+        """Заводит пул для новой задачи и запускает генерацию вариантов всех шагов в фоне"""
+        self.discard(user_id)
+        entry = _TaskAlternatives(task_id, task_name, steps)
+        self._tasks[user_id] = entry
+        while len(self._tasks) > self.max_tasks:
+            _, old = self._tasks.popitem(last=False)
+            if old.pending is not None:
+                old.pending.cancel()
+        self._schedule(user_id, entry, list(entry.pool))
+
+    def _schedule(self, user_id, entry, indexes):
+        if entry.pending is not None or entry.calls >= self.max_calls or not indexes:
+            return
+        entry.calls += 1
+        entry.pending = asyncio.create_task(self._generate(user_id, entry, indexes))
+
+    async def _generate(self, user_id, entry, indexes):
+        try:
+            steps = {index: entry.steps[index] for index in indexes}
+            result = await self.generate(entry.task_name, steps, self.per_step)
+            for index, variants in result.items():
+                if index in entry.pool:
+                    entry.pool[index].extend(v for v in variants
+                                             if v not in entry.shown[index] and v not in entry.pool[index])
+            log.debug("Generated alternatives for user %s: %d steps", user_id, len(result))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Could not generate alternatives for user %s: %s", user_id, e)
+        finally:
+            entry.pending = None
+
+    async def take(self, user_id, task_id, index, on_wait=None):
+        """Возвращает следующий вариант шага или None, если вариантов нет; пул пополняется в фоне.
+
+        on_wait - корутина без аргументов, вызывается перед ожиданием идущей генерации
+        (например, чтобы показать пользователю, что шаг переписывается).
+        """
+        entry = self._tasks.get(user_id)
+        if entry is None or entry.task_id != task_id or index not in entry.pool:
+            return None
+        self._tasks.move_to_end(user_id)
+
+        # Генерация вариантов уже идёт - дождаться её быстрее, чем делать отдельный запрос
+        pending = entry.pending
+        if not entry.pool[index] and pending is not None:
+            # Пока показывается статус, генерация может завершиться и entry.pending станет None
+            if on_wait is not None:
+                await on_wait()
+            await asyncio.wait({pending}, timeout=ALTERNATIVES_WAIT_SECONDS)
+
+        variant = entry.pool[index].popleft() if entry.pool[index] else None
+        if variant is not None:
+            entry.shown[index].add(variant)
+
+        low = [i for i, variants in entry.pool.items() if len(variants) <= ALTERNATIVES_REFILL_BELOW]
+        if index in low:
+            # Пополняем прежде всего тот шаг, который переписывают
+            self._schedule(user_id, entry, [index] + [i for i in low if i != index])
+        return variant
+
+    def invalidate_step(self, user_id, index, step):
+        """Шаг изменён пользователем - его прежние варианты больше не подходят"""
+        entry = self._tasks.get(user_id)
+        if entry is not None and index in entry.pool:
+            entry.steps[index] = step
+            entry.shown[index].add(step)
+            entry.pool[index].clear()
+
+    def discard(self, user_id):
+        entry = self._tasks.pop(user_id, None)
+        if entry is not None and entry.pending is not None:
+            entry.pending.cancel()
+
+    def stats(self):
+        return {
+            'tasks': len(self._tasks),
+            'variants': sum(len(v) for entry in self._tasks.values() for v in entry.pool.values()),
+            'pending': sum(1 for entry in self._tasks.values() if entry.pending is not None),
+        }
@@ -0,0 +1,100 @@
+"""Аналитика шагов по журналу StepEventLog, векторизованная на numpy.
+
+Запуск из командной строки:
+    python analytics.py step_events.bin
+"""
+import sys
+import json
+
+import numpy as np
+
+from step_events import StepEventLog, STEP_START, STEP_DONE, STEP_SKIP
+
+# Сколько первых шагов показывать в разбивке по номеру шага
+MAX_STEPS = 10
+
+
+def to_numpy(log):
+    """Превращает снимок журнала в словарь numpy-массивов без дополнительного копирования"""
+    return {name: np.frombuffer(column, dtype=column.typecode) if len(column) else np.array([], dtype=column.typecode)
+            for name, column in log.snapshot().items()}
+
+
+def estimate_accuracy(cols):
+    """Насколько реальная длительность завершённых шагов отличается от оценки модели"""
+    mask = (cols['kind'] == STEP_DONE) & (cols['estimate_s'] > 0) & np.isfinite(cols['actual_s'])
+    if not mask.any():
+        return {'count': 0}
+
+    ratio = cols['actual_s'][mask] / cols['estimate_s'][mask]
+    p10, p50, p90 = np.percentile(ratio, [10, 50, 90])
+    return {
+        'count': int(mask.sum()),
+        'median_ratio': float(p50),
+        'p10_ratio': float(p10),
+        'p90_ratio': float(p90),
+        'mean_abs_pct_error': float(np.mean(np.abs(ratio - 1.0)) * 100),
+        'within_50pct_share': float(np.mean(np.abs(ratio - 1.0) <= 0.5)),
+    }
+
+
+def skip_rates(cols, max_steps=MAX_STEPS):
+    """Доля пропусков по номеру шага и в целом"""
+    finished = (cols['kind'] == STEP_DONE) | (cols['kind'] == STEP_SKIP)
+    steps = np.minimum(cols['step'][finished], max_steps - 1)
+    skipped = cols['kind'][finished] == STEP_SKIP
+
+    total = np.bincount(steps, minlength=max_steps)
+    skips = np.bincount(steps, weights=skipped, minlength=max_steps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        by_step = np.where(total > 0, skips / total, 0.0)
+
+    return {
+        'overall': float(skipped.mean()) if skipped.size else 0.0,
+        'by_step': [round(float(x), 4) for x in by_step],
+    }
+
+
+def completion_funnel(cols, max_steps=MAX_STEPS):
+    """Воронка: доля задач, дошедших до каждого шага, и доля завершённых задач"""
+    started = cols['kind'] == STEP_START
+    if not started.any():
+        return {'tasks': 0}
+
+    task_ids, inverse = np.unique(cols['task_id'][started], return_inverse=True)
+    reached = np.zeros(task_ids.size, dtype=np.int16)
+    np.maximum.at(reached, inverse, cols['step'][started])
+
+    # Задача завершена, если её последний шаг выполнен или пропущен
+    finished = ((cols['kind'] == STEP_DONE) | (cols['kind'] == STEP_SKIP)) & \
+               (cols['step'] == cols['steps_total'] - 1)
+    completed = np.isin(task_ids, cols['task_id'][finished])
+
+    reached_counts = np.bincount(np.minimum(reached, max_steps - 1), minlength=max_steps)
+    # Доля задач, дошедших хотя бы до шага i
+    reached_at_least = reached_counts[::-1].cumsum()[::-1] / task_ids.size
+
+    return {
+        'tasks': int(task_ids.size),
+        'completed_share': float(completed.mean()),
+        'reached_step_share': [round(float(x), 4) for x in reached_at_least],
+    }
+
+
+def summarize(log):
+    """Полный отчёт по журналу событий шагов"""
+    cols = to_numpy(log)
+    return {
+        'events': int(cols['kind'].size),
+        'users': int(np.unique(cols['user_id']).size),
+        'estimate_accuracy': estimate_accuracy(cols),
+        'skip_rates': skip_rates(cols),
+        'funnel': completion_funnel(cols),
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python analytics.py <step_events.bin>")
+        sys.exit(1)
+    print(json.dumps(summarize(StepEventLog.load(sys.argv[1])), ensure_ascii=False, indent=2))
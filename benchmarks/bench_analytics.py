@@ -0,0 +1,49 @@
+"""Замер скорости аналитики шагов на синтетическом журнале.
+
+Запуск:
+    python benchmarks/bench_analytics.py [число_событий]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from step_events import StepEventLog, STEP_START, STEP_DONE, STEP_SKIP, STEP_BACK
+from analytics import summarize
+
+
+def build_log(events):
+    """Генерирует журнал, похожий на реальный: задачи из 3-5 шагов, часть брошена на середине"""
+    log = StepEventLog(capacity=events + 16)
+    rng = random.Random(42)
+    task_id = 0
+    ts = time.time()
+    while len(log) < events:
+        task_id += 1
+        user_id = rng.randrange(100_000)
+        steps_total = rng.randint(3, 5)
+        for step in range(steps_total):
+            estimate = rng.choice((5, 7, 10)) * 60
+            log.record(user_id, task_id, step, steps_total, STEP_START, estimate, ts=ts)
+            roll = rng.random()
+            if roll < 0.05:
+                break
+            kind = STEP_SKIP if roll < 0.15 else STEP_BACK if roll < 0.18 else STEP_DONE
+            log.record(user_id, task_id, step, steps_total, kind, estimate, estimate * rng.lognormvariate(0, 0.5), ts=ts)
+    return log
+
+
+if __name__ == '__main__':
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+
+    started = time.perf_counter()
+    log = build_log(events)
+    print(f"Built {len(log)} events in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    report = summarize(log)
+    elapsed = time.perf_counter() - started
+    print(f"summarize(): {elapsed * 1000:.0f} ms for {report['events']} events")
+    print(report)
@@ -0,0 +1,98 @@
+"""Микробатчинг запросов к LLM под всплеском нагрузки.
+
+N пользователей одновременно запрашивают вопросы по задаче (или переписывание
+шага). Сравниваются одиночные запросы и запросы через MicroBatcher: число
+обращений к модели и время, за которое получены все ответы. Модель - заглушка
+FakeModel; её синхронный вызов, как и в боте, выполняется в пуле потоков.
+
+Запуск:
+    python benchmarks/bench_batching.py
+    python benchmarks/bench_batching.py --users 200 --llm-latency lognormal:800,0.4 --window-ms 20
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fakes import FakeModel
+from llm_batcher import MicroBatcher
+from few_shot import ExampleIndex
+
+PROMPTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'prompts')
+
+
+EXAMPLES = ExampleIndex.load()
+
+
+def load_prompt(filename):
+    with open(os.path.join(PROMPTS_DIR, filename), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def make_prompt(kind, index):
+    if kind == 'rewrite':
+        template = load_prompt('rewrite_step.txt')
+        return template.replace('{step}', f"Шаг 2 (5 мин): открой документ номер {index}").replace('{step_number}', '2')
+    task = f"подготовить отчёт номер {index}"
+    return load_prompt('context_questions.txt').replace('{task}', task).replace('{examples}', EXAMPLES.render(task))
+
+
+async def run(args, batched):
+    model = FakeModel(latency=args.llm_latency, seed=1)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.threads))
+
+    async def send(prompt, kind):
+        return await asyncio.to_thread(lambda: model.generate_content(prompt).text)
+
+    batcher = MicroBatcher(send, lambda: load_prompt('batch.txt'), window=args.window_ms / 1000,
+                           max_size=args.max_batch)
+    call = batcher.submit if batched else send
+
+    async def user(index):
+        # Пользователи приходят не одновременно, а в пределах --spread-ms
+        await asyncio.sleep(args.spread_ms / 1000 * index / args.users)
+        started = time.perf_counter()
+        answer = await call(make_prompt(args.kind, index), args.kind)
+        return time.perf_counter() - started, answer
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(user(i) for i in range(args.users)))
+    total = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    empty = sum(1 for _, answer in results if not answer.strip())
+    return {
+        'calls': dict(model.calls),
+        'total_s': total,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'empty_answers': empty,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--kind', choices=('questions', 'rewrite'), default='questions')
+    parser.add_argument('--llm-latency', default='lognormal:300,0.5')
+    parser.add_argument('--spread-ms', type=float, default=200, help="за сколько мс приходят все пользователи")
+    parser.add_argument('--window-ms', type=float, default=10)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=16, help="потоков для синхронных вызовов модели")
+    args = parser.parse_args(argv)
+
+    for batched in (False, True):
+        report = asyncio.run(run(args, batched))
+        title = 'batched' if batched else 'single '
+        print(f"== {title}: {sum(report['calls'].values())} LLM calls {report['calls']}, "
+              f"all answers in {report['total_s']:.2f}s, p50={report['p50_ms']:.0f}ms p95={report['p95_ms']:.0f}ms, "
+              f"empty answers: {report['empty_answers']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Промпт уточняющих вопросов: фиксированные примеры против подобранных под задачу.
+
+Для набора задач собирает prompts/context_questions.txt с прежними тремя
+примерами (FEW_SHOT_DYNAMIC=0) и с FEW_SHOT_COUNT самыми похожими и сравнивает
+длину промпта, оценку токенов (CHARS_PER_TOKEN) и время подбора примеров. С
+--live (нужен GEMINI_KEY) каждый промпт отправляется в Gemini: токены
+считает сама модель (count_tokens), задержка запроса измеряется --repeat раз.
+
+Запуск:
+    python benchmarks/bench_few_shot.py
+    python benchmarks/bench_few_shot.py --live --repeat 3
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from few_shot import ExampleIndex
+from llm_router import LLM_MODELS
+
+# Грубая оценка для русского текста
+CHARS_PER_TOKEN = 3.5
+
+TASKS = (
+    "помыть посуду", "подготовиться к собеседованию в банк", "написать статью для блога",
+    "сделать слайды к докладу", "разобрать входящие письма", "убрать кухню", "выучить испанский",
+    "написать курсовую", "купить подарок маме", "подготовить квартальный отчёт", "починить кран",
+    "собрать вещи в поездку",
+)
+
+
+def build(template, index, task, dynamic):
+    return template.replace('{task}', task).replace('{examples}', index.render(task, dynamic=dynamic))
+
+
+def live_stats(prompts, repeat):
+    """Токены промпта по счёту Gemini и задержка запроса, мс"""
+    import google.generativeai as genai
+    genai.configure(api_key=os.environ['GEMINI_KEY'])
+    model = genai.GenerativeModel(LLM_MODELS[0])
+    tokens, latencies = [], []
+    for prompt in prompts:
+        tokens.append(model.count_tokens(prompt).total_tokens)
+        for _ in range(repeat):
+            started = time.perf_counter()
+            model.generate_content(prompt)
+            latencies.append((time.perf_counter() - started) * 1000)
+    return statistics.mean(tokens), statistics.median(latencies), max(latencies)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--live', action='store_true', help="отправить промпты в Gemini")
+    parser.add_argument('--repeat', type=int, default=1, help="запросов на промпт в режиме --live")
+    args = parser.parse_args(argv)
+
+    with open(os.path.join(os.path.dirname(__file__), '..', 'prompts', 'context_questions.txt'), encoding='utf-8') as f:
+        template = f.read()
+    index = ExampleIndex.load()
+
+    for dynamic in (False, True):
+        started = time.perf_counter()
+        prompts = [build(template, index, task, dynamic) for task in TASKS]
+        build_us = (time.perf_counter() - started) / len(TASKS) * 1e6
+        chars = statistics.mean(len(prompt) for prompt in prompts)
+        title = 'dynamic' if dynamic else 'fixed'
+        line = (f"== {title:<8} prompt {chars:.0f} chars (~{chars / CHARS_PER_TOKEN:.0f} tokens), "
+                f"built in {build_us:.0f} us")
+        if args.live:
+            tokens, p50, worst = live_stats(prompts, args.repeat)
+            line += f"; Gemini: {tokens:.0f} prompt tokens, latency p50={p50:.0f}ms max={worst:.0f}ms"
+        print(line)
+
+    print("\nexamples chosen:")
+    for task in TASKS:
+        print(f"  {task}: {', '.join(example['task'] for example in index.select(task))}")
+
+
+if __name__ == '__main__':
+    main()
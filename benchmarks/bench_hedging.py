@@ -0,0 +1,74 @@
+"""Хеджированные запросы к LLM и выбор модели по задержке.
+
+Две модели-заглушки: быстрая с тяжёлым хвостом задержки и медленная.
+Сравниваются запросы без хеджа и с хеджем после p90: перцентили задержки
+ответа и сколько лишних обращений к моделям стоил хедж. Отдельно видно, что
+маршрутизатор отправляет основной поток запросов более быстрой модели.
+
+Запуск:
+    python benchmarks/bench_hedging.py
+    python benchmarks/bench_hedging.py --requests 500 --fast-latency lognormal:300,1.0 --slow-latency lognormal:600,0.3
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fakes import FakeModel
+from llm_router import ModelRouter
+
+
+async def run(args, hedge):
+    models = {'fast': FakeModel(latency=args.fast_latency, seed=1),
+              'slow': FakeModel(latency=args.slow_latency, seed=2)}
+    router = ModelRouter(models=list(models), hedge=hedge, hedge_max_ratio=args.hedge_ratio)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.threads))
+
+    def send(name):
+        return asyncio.to_thread(lambda: models[name].generate_content("Декомпозируй задачу").text)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    answered_by = {name: 0 for name in models}
+
+    async def request():
+        async with semaphore:
+            started = time.perf_counter()
+            _, model = await router.call('decompose', send)
+            answered_by[model] += 1
+            return time.perf_counter() - started
+
+    latencies = sorted(await asyncio.gather(*(request() for _ in range(args.requests))))
+    return {
+        'calls': {name: sum(model.calls.values()) for name, model in models.items()},
+        'answered_by': answered_by,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p90_ms': latencies[int(len(latencies) * 0.9)] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--fast-latency', default='lognormal:200,0.9')
+    parser.add_argument('--slow-latency', default='lognormal:400,0.3')
+    parser.add_argument('--hedge-ratio', type=float, default=0.1, help="максимальная доля хеджированных запросов")
+    parser.add_argument('--threads', type=int, default=64, help="потоков для синхронных вызовов модели")
+    args = parser.parse_args(argv)
+
+    for hedge in (False, True):
+        report = asyncio.run(run(args, hedge))
+        title = 'hedged  ' if hedge else 'no hedge'
+        print(f"== {title}: p50={report['p50_ms']:.0f}ms p90={report['p90_ms']:.0f}ms p99={report['p99_ms']:.0f}ms, "
+              f"model calls {report['calls']}, answered by {report['answered_by']}")
+
+
+if __name__ == '__main__':
+    main()
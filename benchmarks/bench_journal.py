@@ -0,0 +1,138 @@
+"""Стоимость журнала апдейтов.
+
+1. Запись в журнал из N потоков в режиме group commit: записей в секунду,
+   число сбросов на диск и средний размер группы.
+2. Приём апдейтов через /webhook (Flask test client) с журналом и без.
+3. С --loadtest - сквозной loadtest.py с JOURNAL_ENABLED=0 и 1 и разница
+   в пропускной способности.
+
+Запуск:
+    python benchmarks/bench_journal.py
+    python benchmarks/bench_journal.py --threads 32 --loadtest --users 200
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from harness import BotHarness
+from journal import UpdateJournal
+
+UPDATE = {
+    'update_id': 1,
+    'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'}, 'text': 'Написать отчёт ' * 4},
+}
+PAYLOAD = json.dumps(UPDATE).encode()
+# У каждого апдейта в /webhook свой update_id, иначе все кроме первого отсеются как повторы
+update_ids = itertools.count(1)
+
+
+def next_payload():
+    return json.dumps({**UPDATE, 'update_id': next(update_ids)}).encode()
+
+
+def run_threads(threads, per_thread, target):
+    workers = [threading.Thread(target=target, args=(per_thread,)) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def bench_append(threads, per_thread):
+    directory = tempfile.mkdtemp(prefix='bench_journal_')
+    journal = UpdateJournal(directory, fsync_interval=0)
+
+    def writer(count):
+        for _ in range(count):
+            journal.commit(journal.append(PAYLOAD))
+
+    try:
+        duration = run_threads(threads, per_thread, writer)
+        total = threads * per_thread
+        fsyncs = journal.fsyncs
+        print(f"== journal append: {total} records from {threads} threads in {duration:.2f}s "
+              f"({total / duration:.0f} records/s, {fsyncs} fsyncs, {total / max(fsyncs, 1):.1f} records/fsync)")
+    finally:
+        journal.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_webhook(threads, per_thread):
+    harness = BotHarness()
+    bot = harness.bot
+    bot.open_journal()
+    journal = bot.journal
+
+    def poster(count):
+        client = bot.app.test_client()
+        for _ in range(count):
+            client.post('/webhook', data=next_payload(), content_type='application/json')
+
+    results = {}
+    # Бот не запущен: апдейты только принимаются, очередь чистим между замерами
+    for mode, value in (('off', None), ('on', journal)):
+        bot.journal = value
+        with harness.quiet():
+            duration = run_threads(threads, per_thread, poster)
+        while not bot.update_queue.empty():
+            bot.update_queue.get_nowait()
+        results[mode] = threads * per_thread / duration
+        print(f"== /webhook, journal {mode}: {results[mode]:.0f} updates/s")
+    print(f"   journal overhead at ingestion: {(1 - results['on'] / results['off']) * 100:+.1f}%")
+    if journal is not None:
+        journal.close()
+
+
+def loadtest_throughput(enabled, users, concurrency):
+    out = tempfile.mktemp(suffix='.json')
+    env = {**os.environ, 'JOURNAL_ENABLED': '1' if enabled else '0'}
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), 'loadtest.py'),
+                    '--users', str(users), '--concurrency', str(concurrency), '--out', out],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+    with open(out, encoding='utf-8') as f:
+        reports = json.load(f)
+    os.remove(out)
+    return {report['scenario']: report['updates_per_s'] for report in reports}
+
+
+def bench_loadtest(users, concurrency):
+    off = loadtest_throughput(False, users, concurrency)
+    on = loadtest_throughput(True, users, concurrency)
+    print("== loadtest updates/s, journal off -> on")
+    for scenario in off:
+        change = (on[scenario] / off[scenario] - 1) * 100
+        print(f"   {scenario:<14} {off[scenario]:8.1f} -> {on[scenario]:8.1f} ({change:+.1f}%)")
+    total_off, total_on = sum(off.values()), sum(on.values())
+    print(f"   total overhead: {(1 - total_on / total_off) * 100:+.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16, help="параллельных писателей")
+    parser.add_argument('--records', type=int, default=500, help="записей на поток")
+    parser.add_argument('--loadtest', action='store_true', help="сравнить сквозной loadtest.py")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    bench_append(args.threads, args.records)
+    bench_webhook(args.threads, args.records)
+    if args.loadtest:
+        bench_loadtest(args.users, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Вопросы и черновик декомпозиции одним запросом против двух запросов подряд.
+
+Прогоняет сквозной loadtest.py (сценарии full и skip_context) с
+COMBINED_OVERVIEW=0 и 1 и сравнивает задержку от отправки задачи до готовых
+шагов, число запросов к модели и объём промптов и ответов. Токены оцениваются
+по символам (CHARS_PER_TOKEN), для точного счёта нужен токенизатор модели.
+
+Запуск:
+    python benchmarks/bench_overview.py
+    python benchmarks/bench_overview.py --users 200 --llm-latency lognormal:800,0.4
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+# Грубая оценка для русского текста
+CHARS_PER_TOKEN = 3.5
+
+
+def run_loadtest(combined, scenario, args):
+    out = tempfile.mktemp(suffix='.json')
+    env = {**os.environ, 'COMBINED_OVERVIEW': '1' if combined else '0'}
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), 'loadtest.py'),
+                    '--scenario', scenario, '--users', str(args.users), '--concurrency', str(args.concurrency),
+                    '--llm-latency', args.llm_latency, '--out', out],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+    with open(out, encoding='utf-8') as f:
+        report = json.load(f)[0]
+    os.remove(out)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--llm-latency', default='lognormal:300,0.4')
+    args = parser.parse_args(argv)
+
+    for scenario, answer in (('skip_context', 'skip_context'), ('full', 'context')):
+        for combined in (False, True):
+            report = run_loadtest(combined, scenario, args)
+            latency = report['latency_by_action']
+            flows = max(report['completed'], 1)
+            calls = {kind: count for kind, count in report['llm_calls'].items() if kind != 'alternatives'}
+            tokens_in = report['llm_prompt_chars'] / CHARS_PER_TOKEN / flows
+            tokens_out = report['llm_output_chars'] / CHARS_PER_TOKEN / flows
+            title = 'combined' if combined else 'two-call'
+            print(f"== {scenario:<12} {title}: {report['completed']}/{report['users']} flows; "
+                  f"task p50={latency['task']['p50_ms']}ms, {answer} p50={latency[answer]['p50_ms']}ms "
+                  f"p95={latency[answer]['p95_ms']}ms; LLM calls {calls}; "
+                  f"~{tokens_in:.0f} prompt + {tokens_out:.0f} output tokens/flow (with alternatives)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Планировщик запросов к LLM: приоритеты и честная очередь против FIFO.
+
+Несколько "тяжёлых" пользователей раз за разом жмут "Переписать всё", а в это
+время приходят новые пользователи с первой декомпозицией и фоновые запросы
+вариантов. Лимит одновременных запросов один и тот же; сравнивается обычная
+очередь (FIFO) и LLMScheduler с приоритетами и WFQ по пользователям:
+ожидание слота для каждого вида запросов.
+
+Запуск:
+    python benchmarks/bench_scheduler.py
+    python benchmarks/bench_scheduler.py --limit 4 --heavy-users 3 --heavy-requests 30 --new-users 40
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fakes import LatencyDist
+from llm_scheduler import LLMScheduler, REWRITE, current_user, priority
+
+
+async def run(args, fair):
+    scheduler = LLMScheduler(max_concurrency=args.limit)
+    latency = LatencyDist(args.llm_latency, seed=1)
+    waits = defaultdict(list)
+
+    async def request(user, kind, label, level=0):
+        # FIFO: у всех запросов один класс приоритета и один "пользователь"
+        current_user.set(user if fair else None)
+        with priority(level if fair else REWRITE):
+            started = time.perf_counter()
+            async with scheduler.slot(kind if fair else 'rewrite'):
+                waits[label].append(time.perf_counter() - started)
+                await asyncio.sleep(latency.sample())
+
+    async def heavy(user):
+        # "Переписать всё": повторная декомпозиция и фоновые варианты к ней
+        for _ in range(args.heavy_requests):
+            await asyncio.gather(request(user, 'decompose', 'rewrite_all', REWRITE),
+                                 request(user, 'alternatives', 'background'))
+
+    async def newcomer(user, delay):
+        await asyncio.sleep(delay)
+        await request(user, 'decompose', 'first_decompose')
+
+    rng = random.Random(2)
+    jobs = [heavy(f"heavy{i}") for i in range(args.heavy_users)]
+    jobs += [newcomer(f"new{i}", rng.uniform(0, args.spread_s)) for i in range(args.new_users)]
+    started = time.perf_counter()
+    await asyncio.gather(*jobs)
+    return time.perf_counter() - started, waits
+
+
+def summary(values):
+    values = sorted(values)
+    return f"p50={values[len(values) // 2] * 1000:.0f}ms p95={values[int(len(values) * 0.95)] * 1000:.0f}ms"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--limit', type=int, default=4, help="запросов к LLM одновременно")
+    parser.add_argument('--heavy-users', type=int, default=4)
+    parser.add_argument('--heavy-requests', type=int, default=20, help="\"Переписать всё\" на тяжёлого пользователя")
+    parser.add_argument('--new-users', type=int, default=40)
+    parser.add_argument('--spread-s', type=float, default=5.0, help="за сколько секунд приходят новые пользователи")
+    parser.add_argument('--llm-latency', default='lognormal:200,0.3')
+    args = parser.parse_args(argv)
+
+    for fair in (False, True):
+        total, waits = asyncio.run(run(args, fair))
+        title = 'fair' if fair else 'fifo'
+        print(f"== {title}: all requests in {total:.2f}s; slot wait: "
+              + ', '.join(f"{label} {summary(values)}" for label, values in sorted(waits.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""Заглушки внешних сервисов для нагрузочных тестов: Bot API, Gemini и AssemblyAI"""
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+# Насколько каждый следующий запрос в пачке удлиняет ответ модели (доля задержки одиночного запроса)
+BATCH_ITEM_COST = 0.15
+
+
+class LatencyDist:
+    """Распределение задержки, заданное строкой.
+
+    Форматы:
+        const:50            - всегда 50 мс
+        uniform:20,80       - равномерно от 20 до 80 мс
+        lognormal:300,0.5   - логнормальное с медианой 300 мс и sigma 0.5
+    """
+
+    def __init__(self, spec, seed=None):
+        self.spec = spec
+        kind, _, params = spec.partition(':')
+        values = [float(x) for x in params.split(',') if x]
+        if kind not in ('const', 'uniform', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.kind = kind
+        self.values = values
+        self.rng = random.Random(seed)
+
+    def sample(self):
+        """Возвращает задержку в секундах"""
+        if self.kind == 'const':
+            ms = self.values[0]
+        elif self.kind == 'uniform':
+            ms = self.rng.uniform(self.values[0], self.values[1])
+        else:
+            ms = self.values[0] * self.rng.lognormvariate(0, self.values[1] if len(self.values) > 1 else 0.5)
+        return ms / 1000.0
+
+    def __str__(self):
+        return self.spec
+
+
+class _Server(ThreadingHTTPServer):
+    # Бот обрабатывает апдейты параллельно и открывает много соединений сразу; при очереди
+    # listen() по умолчанию (5) лишние соединения ждут повторного SYN и упираются в таймауты
+    request_queue_size = 256
+
+
+class FakeBotAPI:
+    """Локальный HTTP-сервер, отвечающий как Telegram Bot API.
+
+    Считает вызовы по методам и сообщает о каждом отправленном или
+    отредактированном сообщении через listener(method, chat_id, message_id, text).
+    """
+
+    def __init__(self, latency='const:0', listener=None):
+        self.latency = LatencyDist(latency)
+        self.listener = listener
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = Counter()
+        self._server = _Server(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+
+    def _next_message_id(self, chat_id):
+        with self._lock:
+            self._message_ids[chat_id] += 1
+            return self._message_ids[chat_id] + 1_000_000
+
+    def _message(self, chat_id, message_id, text):
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text or "",
+        }
+
+    def handle(self, method, params):
+        """Возвращает result для вызова метода Bot API"""
+        with self._lock:
+            self.calls[method] += 1
+
+        delay = self.latency.sample()
+        if delay:
+            time.sleep(delay)
+
+        chat_id = int(params.get('chat_id', 0) or 0)
+        text = params.get('text')
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            message_id = self._next_message_id(chat_id)
+            self._notify(method, chat_id, message_id, text)
+            return self._message(chat_id, message_id, text)
+        if method == 'editMessageText':
+            message_id = int(params.get('message_id', 0))
+            self._notify(method, chat_id, message_id, text)
+            return self._message(chat_id, message_id, text)
+        if method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": 4,
+                    "file_path": f"{self.url}/file/{file_id}.oga"}
+        # answerCallbackQuery, deleteMessage, setWebhook и прочие
+        return True
+
+    def _notify(self, method, chat_id, message_id, text):
+        if self.listener:
+            self.listener(method, chat_id, message_id, text)
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Иначе Nagle + delayed ACK добавляют ~40 мс к каждому вызову
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, body, content_type='application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                # Скачивание файлов (голосовые сообщения)
+                self._reply(200, b'OggS', 'application/octet-stream')
+
+            def do_POST(self):
+                method = urlparse(self.path).path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length', 0))
+                raw = self.rfile.read(length).decode('utf-8') if length else ''
+                params = {}
+                for key, values in parse_qs(raw).items():
+                    params[key] = values[0]
+                result = api.handle(method, params)
+                self._reply(200, json.dumps({"ok": True, "result": result}).encode('utf-8'))
+
+        return Handler
+
+
+class FakeServiceError(Exception):
+    """Как google.api_core.exceptions.ServiceUnavailable: временный сбой, который бот повторяет"""
+    code = 503
+
+
+class FakeDeadlineExceeded(FakeServiceError):
+    """Как google.api_core.exceptions.DeadlineExceeded"""
+    code = 504
+
+
+class FakeModel:
+    """Заглушка google.generativeai.GenerativeModel с настраиваемой задержкой.
+
+    Как и настоящий SDK, generate_content блокирует вызывающий поток. Доля
+    error_rate запросов завершается ошибкой после обычной задержки.
+    """
+
+    def __init__(self, latency='lognormal:300,0.5', steps=4, seed=None, error_rate=0.0):
+        self.latency = LatencyDist(latency, seed)
+        self.steps = steps
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.prompt_chars = 0
+        self.output_chars = 0
+        self._lock = threading.Lock()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.prompt_chars = 0
+            self.output_chars = 0
+
+    def _kind(self, prompt):
+        if 'независимых запросов' in prompt:
+            return 'batch'
+        if 'по сути своей другое' in prompt:
+            return 'alternatives'
+        if '"questions"' in prompt:
+            return 'overview'
+        if 'Текущий шаг:' in prompt:
+            return 'rewrite'
+        if 'Декомпозируй' in prompt:
+            return 'decompose'
+        return 'questions'
+
+    def _answer(self, kind, prompt):
+        if kind == 'rewrite':
+            return "Шаг 1 (5 мин): сделай что-то другое"
+        if kind == 'alternatives':
+            count = int(re.search(r'по (\d+) на шаг', prompt).group(1))
+            numbers = re.findall(r'^Шаг (\d+):', prompt, re.MULTILINE)
+            with self._lock:
+                start = self.calls[kind] * count
+            return '\n'.join(f"Шаг {n} (5 мин): другое действие {start + i}" for n in numbers for i in range(count))
+        if kind == 'overview':
+            return json.dumps({'questions': ["Где ты сейчас?", "Сколько у тебя времени?", "Что уже готово?"],
+                               'steps': [{'minutes': 5, 'text': f"простое действие номер {i}"}
+                                         for i in range(1, self.steps + 1)]}, ensure_ascii=False)
+        if kind == 'decompose':
+            if '"steps"' in prompt:
+                return json.dumps({'steps': [{'minutes': 5, 'text': f"простое действие номер {i}"}
+                                             for i in range(1, self.steps + 1)]}, ensure_ascii=False)
+            return '\n'.join(f"Шаг {i} (5 мин): простое действие номер {i}" for i in range(1, self.steps + 1))
+        return "• Где ты сейчас?\n• Сколько у тебя времени?\n• Что уже готово?"
+
+    def generate_content(self, prompt, **kwargs):
+        kind = self._kind(prompt)
+        items = []
+        if kind == 'batch':
+            # Пакетный промпт: отвечаем на каждый запрос, как на одиночный
+            items = [(int(number), body) for number, _, body in
+                     re.findall(r'^<<<ЗАПРОС (\d+) (\w+)>>>\n(.*?)\n<<<КОНЕЦ \1 \2>>>$', prompt,
+                                re.MULTILINE | re.DOTALL)]
+            kind = self._kind(items[0][1]) + '_batch'
+        with self._lock:
+            self.calls[kind] += 1
+            self.prompt_chars += len(prompt)
+        # Ответ на пачку генерируется дольше: каждый следующий запрос добавляет BATCH_ITEM_COST задержки
+        delay = self.latency.sample() * (1 + BATCH_ITEM_COST * max(len(items) - 1, 0))
+        # Как SDK с request_options={'timeout': ...}: запрос дольше таймаута обрывается
+        timeout = (kwargs.get('request_options') or {}).get('timeout')
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise FakeDeadlineExceeded("fake model timeout")
+        time.sleep(delay)
+        if self.error_rate and self.latency.rng.random() < self.error_rate:
+            raise FakeServiceError("fake model error")
+
+        if items:
+            text = json.dumps([{'id': number, 'answer': self._answer(self._kind(body), body)}
+                               for number, body in items], ensure_ascii=False)
+        else:
+            text = self._answer(kind, prompt)
+        with self._lock:
+            self.output_chars += len(text)
+        return SimpleNamespace(text=text)
+
+
+def make_fake_aai(latency='lognormal:800,0.3', text="подготовиться к собеседованию"):
+    """Возвращает объект, подменяющий модуль assemblyai"""
+    dist = LatencyDist(latency)
+    calls = Counter()
+
+    class Transcriber:
+        def transcribe(self, path, config=None):
+            calls['transcribe'] += 1
+            time.sleep(dist.sample())
+            return SimpleNamespace(status='completed', text=text, error=None)
+
+    return SimpleNamespace(
+        Transcriber=Transcriber,
+        TranscriptionConfig=lambda **kwargs: SimpleNamespace(**kwargs),
+        TranscriptStatus=SimpleNamespace(error='error', completed='completed'),
+        calls=calls,
+    )
@@ -0,0 +1,90 @@
+"""Запуск бота против заглушек внешних сервисов (общая часть loadtest.py и replay.py)"""
+import os
+import sys
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fakes import FakeBotAPI, FakeModel, make_fake_aai
+
+
+class BotHarness:
+    """Поднимает заглушки Bot API, Gemini и AssemblyAI и запускает бота в режиме webhook"""
+
+    def __init__(self, api_latency='const:0', llm_latency='lognormal:50,0.5', stt_latency='lognormal:100,0.3',
+                 steps=4, listener=None, verbose=False):
+        self.verbose = verbose
+        self.api = FakeBotAPI(latency=api_latency, listener=listener).start()
+        self.model = FakeModel(latency=llm_latency, steps=steps)
+        self.aai = make_fake_aai(latency=stt_latency)
+        self._local = threading.local()
+        self.bot_thread = None
+
+        os.environ.update({
+            'TELEGRAM_TOKEN': '123456:FAKE-TOKEN',
+            'GEMINI_KEY': 'fake',
+            'RENDER_EXTERNAL_URL': 'http://127.0.0.1',
+            'TELEGRAM_API_URL': self.api.url,
+            'SESSIONS_DIR': tempfile.mkdtemp(prefix='bench_sessions_'),
+            'JOURNAL_DIR': tempfile.mkdtemp(prefix='bench_journal_'),
+        })
+        # Не записываем трафик, который сами же и генерируем
+        os.environ.pop('TRAFFIC_CAPTURE_PATH', None)
+        # Логи бота пишутся в stdout из отдельного потока, перенаправление stdout их не глушит
+        if not verbose:
+            os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+        import bot
+        self.bot = bot
+        # Одна заглушка отвечает за все модели из LLM_MODELS
+        bot.models.update({name: self.model for name in bot.LLM_MODELS})
+        bot.aai = self.aai
+        bot.ASSEMBLYAI_API_KEY = 'fake'
+
+    def quiet(self):
+        """Глушит print-вывод (werkzeug, библиотеки), если не включён verbose"""
+        if self.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    def start_bot(self):
+        """Запускает поток бота так же, как в продакшене, и ждёт инициализации приложения"""
+        self.bot_thread = threading.Thread(target=self.bot.run_bot_webhook, daemon=True)
+        self.bot_thread.start()
+        if not self.bot.health_state.ready.wait(timeout=30):
+            raise RuntimeError(f"Bot is not ready: {self.bot.health_state.not_ready_reason}")
+
+    def reset_counters(self):
+        self.api.reset_counters()
+        self.model.reset_counters()
+        self.aai.calls.clear()
+
+    def counters(self):
+        return {
+            'bot_api_calls': dict(self.api.calls),
+            'llm_calls': dict(self.model.calls),
+            'llm_prompt_chars': self.model.prompt_chars,
+            'llm_output_chars': self.model.output_chars,
+            'stt_calls': dict(self.aai.calls),
+        }
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.bot.app.test_client()
+        return client
+
+    def post_update(self, update):
+        """Отправляет апдейт в /webhook, как это делает Telegram"""
+        response = self._client().post('/webhook', json=update)
+        if response.status_code != 200:
+            raise RuntimeError(f"/webhook returned {response.status_code}")
+
+    def stop(self):
+        self.bot.update_queue.put(None)
+        if self.bot_thread:
+            self.bot_thread.join(timeout=10)
+        self.api.stop()
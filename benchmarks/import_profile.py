@@ -0,0 +1,104 @@
+"""Профиль времени импорта bot.py (python -X importtime).
+
+Запускает `import bot` в отдельных процессах, печатает медиану общего времени,
+самые тяжёлые модули и то, какие тяжёлые SDK загружаются при старте.
+С --baseline-rev то же самое замеряется на другой ревизии git (через worktree).
+
+Запуск:
+    python benchmarks/import_profile.py
+    python benchmarks/import_profile.py --baseline-rev HEAD~1 --runs 5
+"""
+import os
+import re
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# SDK, которые не должны импортироваться при старте
+HEAVY_MODULES = ('google.generativeai', 'assemblyai', 'numpy')
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+FAKE_ENV = {
+    'TELEGRAM_TOKEN': '123456:FAKE-TOKEN',
+    'GEMINI_KEY': 'fake',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+def profile_once(root):
+    """Возвращает {модуль: (собственное время, накопленное время)} в микросекундах"""
+    env = {**os.environ, **FAKE_ENV}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bot'],
+                            cwd=root, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import bot failed in {root}:\n{result.stderr[-2000:]}")
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return modules
+
+
+def profile(root, runs):
+    samples = [profile_once(root) for _ in range(runs)]
+    total_ms = median(s['bot'][1] for s in samples) / 1000
+    # Тяжёлые модули - по медиане накопленного времени среди загруженных во всех прогонах
+    common = set.intersection(*(set(s) for s in samples))
+    cumulative = {name: median(s[name][1] for s in samples) / 1000 for name in common}
+    return {
+        'total_ms': total_ms,
+        'cumulative_ms': cumulative,
+        'heavy_loaded': [name for name in HEAVY_MODULES if name in samples[0]],
+    }
+
+
+def print_profile(title, report, top):
+    print(f"== {title}: import bot {report['total_ms']:.0f} ms (median)")
+    # Только модули верхнего уровня: вложенные уже учтены в накопленном времени родителя
+    top_level = sorted(((ms, name) for name, ms in report['cumulative_ms'].items()
+                        if '.' not in name and name != 'bot'), reverse=True)[:top]
+    for ms, name in top_level:
+        print(f"   {ms:8.1f} ms  {name}")
+    heavy = ', '.join(report['heavy_loaded']) or 'none'
+    print(f"   heavy SDKs loaded at import: {heavy}")
+
+
+def profile_revision(rev, runs):
+    tmp = tempfile.mkdtemp(prefix='import_profile_')
+    worktree = os.path.join(tmp, 'tree')
+    subprocess.run(['git', 'worktree', 'add', '--detach', worktree, rev], cwd=ROOT, check=True,
+                   capture_output=True)
+    try:
+        return profile(worktree, runs)
+    finally:
+        subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=ROOT, capture_output=True)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help="число запусков для медианы")
+    parser.add_argument('--top', type=int, default=10, help="сколько тяжёлых модулей показать")
+    parser.add_argument('--baseline-rev', help="ревизия git для сравнения, например HEAD~1")
+    args = parser.parse_args(argv)
+
+    current = profile(ROOT, args.runs)
+    print_profile('working tree', current, args.top)
+
+    if args.baseline_rev:
+        baseline = profile_revision(args.baseline_rev, args.runs)
+        print_profile(args.baseline_rev, baseline, args.top)
+        saved = baseline['total_ms'] - current['total_ms']
+        print(f"== import time change: {baseline['total_ms']:.0f} ms -> {current['total_ms']:.0f} ms "
+              f"({-saved:+.0f} ms, {-saved / baseline['total_ms'] * 100:+.0f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""Сквозной нагрузочный тест: webhook -> update_queue -> process_updates -> обработчики.
+
+Поднимает заглушку Bot API, подменяет Gemini и AssemblyAI заглушками с заданной
+задержкой и прогоняет тысячи симулированных пользователей через полный сценарий
+(задача -> контекст -> декомпозиция -> шаги с таймерами).
+
+Запуск:
+    python benchmarks/loadtest.py --users 1000 --concurrency 200
+    python benchmarks/loadtest.py --scenario skip_context --llm-latency lognormal:300,0.5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from harness import BotHarness
+
+SCENARIOS = ('full', 'skip_context', 'rewrite', 'voice')
+
+# Диапазон id пользователей для каждого сценария, чтобы сессии не пересекались
+USER_ID_BASE = 10_000_000
+
+
+def percentile(sorted_values, q):
+    """Перцентиль q (0..100) по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 1),
+        'p95_ms': round(percentile(values, 95) * 1000, 1),
+        'p99_ms': round(percentile(values, 99) * 1000, 1),
+        'max_ms': round(values[-1] * 1000, 1) if values else 0.0,
+    }
+
+
+class SimUser:
+    """Симулированный пользователь: отправляет апдейты и ждёт ответов бота"""
+
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.user_id = user_id
+        self.inbox = asyncio.Queue()
+        self.events = []
+
+    async def expect(self, predicate, timeout):
+        """Ждёт сообщение бота, удовлетворяющее predicate(method, message_id, text)"""
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError
+            event = await asyncio.wait_for(self.inbox.get(), remaining)
+            self.events.append(event)
+            if predicate(*event):
+                return event
+
+    async def action(self, name, update, predicate):
+        """Отправляет апдейт через /webhook и замеряет время до ответа бота"""
+        started = time.perf_counter()
+        await self.harness.post_update(update)
+        event = await self.expect(predicate, self.harness.args.timeout)
+        self.harness.latencies[name].append(time.perf_counter() - started)
+        return event
+
+    def first_step_message(self):
+        """(id, текст) первого сообщения с шагом"""
+        for method, message_id, text in self.events:
+            if method == 'sendMessage' and text and text.startswith('Шаг'):
+                return message_id, text
+        return None, None
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.loop = None
+        self.users = {}
+        self.message_texts = {}
+        self.latencies = defaultdict(list)
+        self._update_id = 0
+
+        self.harness = BotHarness(
+            api_latency=args.api_latency,
+            llm_latency=args.llm_latency,
+            stt_latency=args.stt_latency,
+            steps=args.steps,
+            listener=self._on_api_event,
+            verbose=args.verbose,
+        )
+
+    def _on_api_event(self, method, chat_id, message_id, text):
+        # Вызывается из потока заглушки Bot API
+        self.loop.call_soon_threadsafe(self._deliver, method, chat_id, message_id, text)
+
+    def _deliver(self, method, chat_id, message_id, text):
+        self.message_texts[(chat_id, message_id)] = text
+        user = self.users.get(chat_id)
+        if user is not None:
+            user.inbox.put_nowait((method, message_id, text))
+
+    async def post_update(self, update):
+        await asyncio.to_thread(self.harness.post_update, update)
+
+    # Конструкторы апдейтов
+
+    def _next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def message_update(self, user_id, text=None, voice=False):
+        message = {
+            "message_id": self._next_update_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+        }
+        if voice:
+            message["voice"] = {"file_id": f"voice{user_id}", "file_unique_id": f"voice{user_id}", "duration": 3}
+        else:
+            message["text"] = text
+        return {"update_id": self._next_update_id(), "message": message}
+
+    def callback_update(self, user_id, message_id, data):
+        update_id = self._next_update_id()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "FakeBot"},
+                    "text": self.message_texts.get((user_id, message_id), ""),
+                },
+            },
+        }
+
+    def task_text(self, user_id):
+        # Одинаковые задачи, отправленные одновременно, уходят в Gemini одним запросом
+        if self.args.tasks:
+            return f"подготовиться к собеседованию номер {user_id % self.args.tasks}"
+        return f"подготовиться к собеседованию номер {user_id}"
+
+    # Сценарий пользователя
+
+    async def run_user(self, scenario, user_id):
+        user = self.users[user_id] = SimUser(self, user_id)
+        try:
+            decomposed = lambda m, i, t: bool(t) and 'Всего шагов' in t
+            # Простую задачу классификатор (TASK_CLASSIFIER_PATH) декомпозирует сразу, без вопросов
+            questions_or_steps = lambda m, i, t: bool(t) and (t.startswith('📋') or 'Всего шагов' in t)
+            if scenario == 'voice':
+                _, questions_id, text = await user.action(
+                    'voice', self.message_update(user_id, voice=True), questions_or_steps)
+            else:
+                _, questions_id, text = await user.action(
+                    'task', self.message_update(user_id, self.task_text(user_id)), questions_or_steps)
+
+            if 'Всего шагов' in text:
+                final_id = questions_id
+            elif scenario == 'full':
+                _, final_id, _ = await user.action(
+                    'context', self.message_update(user_id, "я дома, есть час, устал"), decomposed)
+            else:
+                _, final_id, _ = await user.action(
+                    'skip_context', self.callback_update(user_id, questions_id, 'skip_context'), decomposed)
+
+            if scenario == 'rewrite':
+                step_id, step_text = user.first_step_message()
+                await user.action(
+                    'rewrite_step', self.callback_update(user_id, step_id, 'rewrite_step_0'),
+                    # При ошибке бот показывает прежний шаг с предупреждением - это не переписанный шаг
+                    lambda m, i, t: i == step_id and bool(t) and t.startswith('Шаг') and t != step_text
+                    and '⚠️' not in t)
+
+            await user.action(
+                'start_steps', self.callback_update(user_id, final_id, 'start_steps'),
+                lambda m, i, t: bool(t) and t.startswith('Шаг 1/'))
+
+            for step in range(1, self.args.steps + 1):
+                if self.args.think:
+                    await asyncio.sleep(self.args.think)
+                marker = f'Шаг {step + 1}/' if step < self.args.steps else 'Все шаги выполнены'
+                await user.action(
+                    'next_step', self.callback_update(user_id, final_id, 'next_step'),
+                    lambda m, i, t, marker=marker: bool(t) and marker in t)
+            return True
+        except (TimeoutError, asyncio.TimeoutError, RuntimeError):
+            return False
+        finally:
+            del self.users[user_id]
+
+    async def run_scenario(self, scenario, base_user_id):
+        self.latencies.clear()
+        self.harness.reset_counters()
+
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(user_id):
+            async with semaphore:
+                return await self.run_user(scenario, user_id)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(base_user_id + i) for i in range(self.args.users)))
+        duration = time.perf_counter() - started
+
+        completed = sum(results)
+        updates = sum(len(v) for v in self.latencies.values())
+        all_latencies = [x for values in self.latencies.values() for x in values]
+        counters = self.harness.counters()
+        return {
+            'scenario': scenario,
+            'users': self.args.users,
+            'concurrency': self.args.concurrency,
+            'completed': completed,
+            'failed': self.args.users - completed,
+            'duration_s': round(duration, 2),
+            'flows_per_s': round(completed / duration, 2),
+            'updates_per_s': round(updates / duration, 2),
+            'latency': latency_summary(all_latencies),
+            'latency_by_action': {name: latency_summary(values) for name, values in self.latencies.items()},
+            **counters,
+            'bot_api_calls_per_flow': round(sum(counters['bot_api_calls'].values()) / max(completed, 1), 1),
+        }
+
+    async def run(self, scenarios):
+        self.loop = asyncio.get_running_loop()
+        reports = []
+        for index, scenario in enumerate(scenarios):
+            report = await self.run_scenario(scenario, USER_ID_BASE * (index + 1))
+            print_report(report)
+            reports.append(report)
+        return reports
+
+
+
+def print_report(report, out=sys.__stdout__):
+    # Вывод бота может быть заглушен, поэтому пишем напрямую в исходный stdout
+    p = lambda line: print(line, file=out)
+    p(f"\n=== {report['scenario']}: {report['completed']}/{report['users']} flows in {report['duration_s']}s "
+          f"({report['flows_per_s']} flows/s, {report['updates_per_s']} updates/s)")
+    latency = report['latency']
+    p(f"    latency  p50={latency['p50_ms']}ms  p95={latency['p95_ms']}ms  p99={latency['p99_ms']}ms")
+    for name, values in report['latency_by_action'].items():
+        p(f"    {name:<14} p50={values['p50_ms']}ms  p95={values['p95_ms']}ms  p99={values['p99_ms']}ms")
+    p(f"    Bot API calls: {report['bot_api_calls']} ({report['bot_api_calls_per_flow']}/flow)")
+    p(f"    LLM calls: {report['llm_calls']}  STT calls: {report['stt_calls']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all')
+    parser.add_argument('--users', type=int, default=200, help="пользователей на сценарий")
+    parser.add_argument('--concurrency', type=int, default=100, help="одновременно активных пользователей")
+    parser.add_argument('--steps', type=int, default=4, help="шагов в декомпозиции")
+    parser.add_argument('--tasks', type=int, default=0,
+                        help="сколько разных текстов задач у пользователей (0 - у каждого свой)")
+    parser.add_argument('--think', type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument('--llm-latency', default='lognormal:50,0.5')
+    parser.add_argument('--stt-latency', default='lognormal:100,0.3')
+    parser.add_argument('--api-latency', default='const:0')
+    parser.add_argument('--timeout', type=float, default=120.0, help="таймаут ожидания ответа бота, с")
+    parser.add_argument('--out', help="сохранить отчёт в JSON")
+    parser.add_argument('--verbose', action='store_true', help="не глушить вывод бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = SCENARIOS if args.scenario == 'all' else (args.scenario,)
+
+    loadtest = LoadTest(args)
+    harness = loadtest.harness
+    with harness.quiet():
+        harness.start_bot()
+    print(f"Fake Bot API at {harness.api.url}; LLM latency {args.llm_latency}, STT latency {args.stt_latency}")
+
+    try:
+        with harness.quiet():
+            reports = asyncio.run(loadtest.run(scenarios))
+    finally:
+        with harness.quiet():
+            harness.stop()
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    return reports
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Воспроизведение записанного трафика для поиска регрессий производительности.
+
+Трафик записывается ботом при заданной TRAFFIC_CAPTURE_PATH (см. traffic_capture.py).
+Воспроизведение идёт через /webhook и process_updates против заглушек Bot API, Gemini
+и AssemblyAI: в исходном темпе, ускоренно в N раз или без пауз.
+
+Запуск:
+    python benchmarks/replay.py capture.jsonl --speed 10 --out v2.json
+    python benchmarks/replay.py capture.jsonl --speed max --baseline v1.json
+    python benchmarks/replay.py --compare v1.json v2.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from harness import BotHarness
+from loadtest import latency_summary
+from traffic_capture import load_capture
+
+# Метрики, по которым сравниваются отчёты: (путь в отчёте, чем больше - тем хуже)
+COMPARED_METRICS = (
+    (('handler_latency', 'p50_ms'), True),
+    (('handler_latency', 'p95_ms'), True),
+    (('handler_latency', 'p99_ms'), True),
+    (('updates_per_s',), False),
+    (('bot_api_calls_total',), True),
+    (('llm_calls_total',), True),
+)
+
+# Сколько ждать без прогресса при пустой очереди, прежде чем завершить воспроизведение
+STALL_SECONDS = 5.0
+
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.harness = BotHarness(llm_latency=args.llm_latency, stt_latency=args.stt_latency,
+                                  api_latency=args.api_latency, verbose=args.verbose)
+        self.latencies = defaultdict(list)
+        self.processed = 0
+        self.errors = 0
+        self._done = threading.Condition()
+
+    def _instrument(self):
+        """Оборачивает process_update приложения, чтобы замерять время обработчиков"""
+        application = self.harness.bot.application
+        process_update = application.process_update
+
+        async def timed_process_update(update):
+            started = time.perf_counter()
+            try:
+                await process_update(update)
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                self.latencies[self.harness.bot.update_kind(update)].append(time.perf_counter() - started)
+                with self._done:
+                    self.processed += 1
+                    self._done.notify_all()
+
+        application.process_update = timed_process_update
+
+    def _wait_processed(self, total):
+        """Ждёт обработки всех апдейтов; апдейты, упавшие до обработчиков, не дождаться -
+        поэтому выходим и тогда, когда очередь пуста и прогресса нет STALL_SECONDS"""
+        deadline = time.perf_counter() + self.args.timeout
+        last_processed, last_progress = -1, time.perf_counter()
+        with self._done:
+            while self.processed < total and time.perf_counter() < deadline:
+                self._done.wait(timeout=0.5)
+                now = time.perf_counter()
+                if self.processed != last_processed:
+                    last_processed, last_progress = self.processed, now
+                elif self.harness.bot.update_queue.empty() and now - last_progress > STALL_SECONDS:
+                    break
+
+    def run(self, events):
+        with self.harness.quiet():
+            self.harness.start_bot()
+        self._instrument()
+        self.harness.reset_counters()
+
+        speed = self.args.speed
+        started = time.perf_counter()
+        with self.harness.quiet():
+            for t, update in events:
+                if speed != 'max':
+                    delay = started + t / float(speed) - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.harness.post_update(update)
+
+            self._wait_processed(len(events))
+            duration = time.perf_counter() - started
+            self.harness.stop()
+
+        counters = self.harness.counters()
+        all_latencies = [x for values in self.latencies.values() for x in values]
+        return {
+            'capture': self.args.capture,
+            'speed': speed,
+            'updates': len(events),
+            'processed': self.processed,
+            'errors': self.errors,
+            'duration_s': round(duration, 2),
+            'updates_per_s': round(self.processed / duration, 2) if duration else 0.0,
+            'handler_latency': latency_summary(all_latencies),
+            'handler_latency_by_kind': {kind: latency_summary(values) for kind, values in sorted(self.latencies.items())},
+            **counters,
+            'bot_api_calls_total': sum(counters['bot_api_calls'].values()),
+            'llm_calls_total': sum(counters['llm_calls'].values()),
+        }
+
+
+def _get(report, path):
+    value = report
+    for key in path:
+        value = value.get(key, {}) if isinstance(value, dict) else {}
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(baseline, current, max_regression):
+    """Печатает сравнение двух отчётов; возвращает True, если регрессий нет"""
+    ok = True
+    print(f"{'metric':<28}{'baseline':>12}{'current':>12}{'change':>10}")
+    for path, higher_is_worse in COMPARED_METRICS:
+        old, new = _get(baseline, path), _get(current, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        regressed = (change if higher_is_worse else -change) > max_regression
+        ok = ok and not regressed
+        print(f"{'.'.join(path):<28}{old:>12}{new:>12}{change:>+9.1f}%{'  <-- regression' if regressed else ''}")
+
+    kinds = sorted(set(baseline.get('handler_latency_by_kind', {})) | set(current.get('handler_latency_by_kind', {})))
+    for kind in kinds:
+        old = _get(baseline, ('handler_latency_by_kind', kind, 'p95_ms'))
+        new = _get(current, ('handler_latency_by_kind', kind, 'p95_ms'))
+        if old and new is not None:
+            print(f"{'p95_ms.' + kind:<28}{old:>12}{new:>12}{(new - old) / old * 100:>+9.1f}%")
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', nargs='?', help="журнал трафика (JSONL)")
+    parser.add_argument('--speed', default='max', help="1 - исходный темп, N - ускорение в N раз, max - без пауз")
+    parser.add_argument('--out', help="сохранить отчёт в JSON")
+    parser.add_argument('--baseline', help="отчёт предыдущего релиза для сравнения")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="сравнить два готовых отчёта")
+    parser.add_argument('--max-regression', type=float, default=10.0, help="допустимое ухудшение, %%")
+    parser.add_argument('--llm-latency', default='lognormal:300,0.5')
+    parser.add_argument('--stt-latency', default='lognormal:800,0.3')
+    parser.add_argument('--api-latency', default='const:0')
+    parser.add_argument('--timeout', type=float, default=600.0, help="сколько ждать обработки всех апдейтов, с")
+    parser.add_argument('--verbose', action='store_true', help="не глушить вывод бота")
+    args = parser.parse_args(argv)
+    if not args.compare and not args.capture:
+        parser.error("нужен журнал трафика или --compare")
+    if args.speed != 'max':
+        float(args.speed)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            current = json.load(f)
+        sys.exit(0 if compare(baseline, current, args.max_regression) else 1)
+
+    events = load_capture(args.capture)
+    print(f"Replaying {len(events)} updates from {args.capture} at speed {args.speed}")
+    report = Replayer(args).run(events)
+
+    latency = report['handler_latency']
+    print(f"Processed {report['processed']}/{report['updates']} updates in {report['duration_s']}s "
+          f"({report['updates_per_s']} updates/s), handler p50={latency['p50_ms']}ms "
+          f"p95={latency['p95_ms']}ms p99={latency['p99_ms']}ms")
+    print(f"Bot API calls: {report['bot_api_calls']}  LLM calls: {report['llm_calls']}  STT calls: {report['stt_calls']}")
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        sys.exit(0 if compare(baseline, report, args.max_regression) else 1)
+
+
+if __name__ == '__main__':
+    main()
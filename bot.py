@@ -1,16 +1,49 @@
 import os
+import re
 import json
+import time
 import asyncio
+import functools
+import contextlib
 import queue
+import random
+import signal
+import logging
 import threading
-import traceback
+from collections import deque
 from datetime import datetime, timedelta
-from flask import Flask, request
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-import google.generativeai as genai
+from telegram.request import HTTPXRequest
+from telegram.error import TelegramError
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 from dotenv import load_dotenv
-import assemblyai as aai
+from session_store import SessionManager
+from history import UserHistory
+from step_events import StepEventLog, new_task_id, STEP_START, STEP_DONE, STEP_SKIP, STEP_BACK
+from calibration import DurationCalibrator
+from traffic_capture import TrafficRecorder, TRAFFIC_CAPTURE_PATH
+import metrics
+import tracing
+from loop_monitor import LoopMonitor
+from health import HealthState, BackendStatus
+from journal import UpdateJournal, JOURNAL_ENABLED
+from dedup import RecentIds, CallbackGuard
+from alternatives import AlternativesPool, ALTERNATIVES_ENABLED
+from llm_batcher import MicroBatcher, LLM_BATCH_ENABLED
+from llm_router import ModelRouter, LLM_MODELS
+from llm_scheduler import LLMScheduler, REWRITE, current_user as llm_user, priority as llm_priority
+from single_flight import SingleFlight, request_key
+from resilience import CircuitBreaker, RetryBudget, CircuitOpenError, call_with_retries
+from decomposition import (parse_decomposition, parse_overview, DecompositionParseError, DECOMPOSE_JSON,
+                           DECOMPOSITION_SCHEMA, OVERVIEW_SCHEMA, COMBINED_OVERVIEW)
+from degraded import DecompositionCache, FALLBACK_QUESTIONS, DEGRADED_NOTICE, template_steps
+from task_classifier import (TaskClassifier, TaskLabelLog, TASK_CLASSIFIER_PATH, TASK_CLASSIFIER_THRESHOLD,
+                             TASK_CLASSIFIER_EXPLORE, TASK_LABELS_PATH)
+from few_shot import ExampleIndex
+from logging_setup import setup_logging, flush_logging, get_logger
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -20,20 +53,70 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GEMINI_KEY = os.getenv("GEMINI_KEY")
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL", "https://rozysk-avto-bot.onrender.com") + "/webhook"
-
-# Диагностика ключей
-print(f"🔍 TELEGRAM_TOKEN: {'OK' if TELEGRAM_TOKEN else 'MISSING'}")
-print(f"🔍 GEMINI_KEY: {'OK (' + str(len(GEMINI_KEY)) + ' chars)' if GEMINI_KEY else 'MISSING'}")
-print(f"🔍 ASSEMBLYAI_API_KEY: {'OK' if ASSEMBLYAI_API_KEY else 'MISSING'}")
-print(f"🔍 WEBHOOK_URL: {WEBHOOK_URL}")
-
-# Настройка Gemini
-genai.configure(api_key=GEMINI_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash-lite-preview-06-17')
-
-# Настройка AssemblyAI
-if ASSEMBLYAI_API_KEY:
-    aai.settings.api_key = ASSEMBLYAI_API_KEY
+# Адрес Bot API (можно указать локальный Bot API сервер или заглушку для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+setup_logging()
+log = get_logger('')
+webhook_log = get_logger('webhook')
+updates_log = get_logger('updates')
+handlers_log = get_logger('handlers')
+timer_log = get_logger('timer')
+llm_log = get_logger('llm')
+stt_log = get_logger('stt')
+debug_log = get_logger('debug')
+
+# Подгружать SDK Gemini и AssemblyAI в фоне сразу после готовности, не дожидаясь первого запроса
+SDK_WARMUP = os.getenv("SDK_WARMUP", "1") == "1"
+
+# Клиенты Gemini и AssemblyAI создаются при первом обращении (get_model/get_aai):
+# их импорт занимает больше секунды и не должен задерживать холодный старт
+models = {}
+aai = None
+_sdk_lock = threading.Lock()
+
+def get_model(name=LLM_MODELS[0]):
+    """Модель Gemini по имени; SDK импортируется и настраивается при первом вызове"""
+    model = models.get(name)
+    if model is None:
+        with _sdk_lock:
+            model = models.get(name)
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_KEY)
+                model = models[name] = genai.GenerativeModel(name)
+    return model
+
+def get_aai():
+    """Модуль assemblyai с установленным ключом; импортируется при первом вызове"""
+    global aai
+    if aai is None:
+        with _sdk_lock:
+            if aai is None:
+                import assemblyai
+                if ASSEMBLYAI_API_KEY:
+                    assemblyai.settings.api_key = ASSEMBLYAI_API_KEY
+                aai = assemblyai
+    return aai
+
+def warm_up_sdks():
+    """Импортирует SDK заранее (в фоновом потоке), чтобы первый пользователь их не ждал"""
+    started = time.perf_counter()
+    try:
+        get_model()
+        if ASSEMBLYAI_API_KEY:
+            get_aai()
+        log.info("SDK warm-up finished in %.0f ms", (time.perf_counter() - started) * 1000)
+    except Exception:
+        log.exception("SDK warm-up failed")
+
+def log_config():
+    """Диагностика ключей"""
+    log.info("Config: TELEGRAM_TOKEN=%s GEMINI_KEY=%s ASSEMBLYAI_API_KEY=%s WEBHOOK_URL=%s",
+             'OK' if TELEGRAM_TOKEN else 'MISSING',
+             f'OK ({len(GEMINI_KEY)} chars)' if GEMINI_KEY else 'MISSING',
+             'OK' if ASSEMBLYAI_API_KEY else 'MISSING', WEBHOOK_URL)
+    log.info("LLM models: %s", ', '.join(LLM_MODELS))
 
 app = Flask(__name__)
 
@@ -41,9 +124,109 @@ app = Flask(__name__)
 user_tasks = {}
 user_history = {}
 update_queue = queue.Queue()
+# Сколько апдейтов разных пользователей обрабатывать одновременно
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 64))
+# Потоки для синхронных SDK (Gemini, AssemblyAI) и ожидания очереди
+BLOCKING_CALL_THREADS = int(os.getenv("BLOCKING_CALL_THREADS", UPDATE_CONCURRENCY + 8))
+in_flight = set()
 application = None
 bot_loop = None
 timer_tasks = {}
+session_manager = SessionManager(user_tasks, user_history, timer_tasks)
+step_events = StepEventLog()
+
+metrics.QUEUE_DEPTH.set_function(update_queue.qsize)
+metrics.UPDATES_IN_FLIGHT.set_function(lambda: len(in_flight))
+metrics.ACTIVE_TIMERS.set_function(lambda: sum(1 for timer in list(timer_tasks.values()) if not timer.done()))
+metrics.RESIDENT_SESSIONS.set_function(lambda: session_manager.resident_count())
+duration_calibrator = DurationCalibrator()
+# Запись входящего трафика для последующего воспроизведения (benchmarks/replay.py)
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_PATH) if TRAFFIC_CAPTURE_PATH else None
+
+# Оценка шага по умолчанию, если модель не указала время
+DEFAULT_STEP_MINUTES = int(os.getenv("DEFAULT_STEP_MINUTES", 5))
+sweeper_task = None
+loop_monitor = LoopMonitor()
+
+# Журнал апдейтов: /webhook отвечает 200 только после записи апдейта на диск,
+# необработанные апдейты возвращаются в очередь при следующем запуске. Открывается в open_journal()
+journal = None
+# /webhook принимает апдейты только после открытия журнала, до этого отвечает 503 и Telegram повторит доставку
+ingest_ready = threading.Event()
+metrics.JOURNAL_BACKLOG.set_function(lambda: journal.stats()['backlog'] if journal is not None else 0)
+
+# Повторные доставки вебхука отсекаются по update_id, двойные нажатия кнопок - перед обработчиками
+recent_updates = RecentIds()
+callback_guard = CallbackGuard()
+
+def open_journal():
+    """Открывает журнал апдейтов (восстановление после падения) и разрешает приём апдейтов"""
+    global journal
+    if JOURNAL_ENABLED and journal is None:
+        journal = UpdateJournal()
+        # Апдейты из журнала уже приняты - их повторная доставка Telegram тоже дубль
+        for _, payload in journal.recovered:
+            recent_updates.seen(json.loads(payload).get('update_id'))
+    ingest_ready.set()
+
+# Остановка по SIGTERM: /webhook отвечает 503 (Telegram повторит доставку), очередь дообрабатывается
+# не дольше SHUTDOWN_DRAIN_SECONDS, необработанное остаётся в журнале, сессии и таймеры сохраняются на диск
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", 20))
+# Сколько ещё ждать сохранения состояния после дообработки очереди
+SHUTDOWN_SAVE_SECONDS = 10
+TIMERS_CHECKPOINT_PATH = os.path.join(session_manager.storage_dir, 'timers.json')
+STEP_EVENTS_PATH = os.path.join(session_manager.storage_dir, 'step_events.bin')
+CALIBRATION_PATH = os.path.join(session_manager.storage_dir, 'calibration.json')
+shutdown_event = threading.Event()
+# Флаг остановки и постановка в очередь - под одной блокировкой, чтобы после флага ничего не попало в очередь
+ingest_lock = threading.Lock()
+drain_deadline = None
+
+# Готовность и живость для /ready и /live
+LIVENESS_DISPATCHER_TIMEOUT = float(os.getenv("LIVENESS_DISPATCHER_TIMEOUT", 120))
+LIVENESS_LOOP_TIMEOUT = float(os.getenv("LIVENESS_LOOP_TIMEOUT", 30))
+health_state = HealthState(queue_depth=update_queue.qsize)
+health_state.register_heartbeat('dispatcher', LIVENESS_DISPATCHER_TIMEOUT)
+# Таймеры шагов работают на event loop, его пульс и есть пульс планировщика таймеров
+health_state.register_heartbeat('timer_scheduler', LIVENESS_LOOP_TIMEOUT, source=lambda: loop_monitor.last_beat)
+gemini_status = BackendStatus('gemini')
+stt_status = BackendStatus('assemblyai')
+telegram_status = BackendStatus('telegram')
+# Таймаут одной попытки запроса к Gemini и AssemblyAI, с
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 30))
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", 120))
+gemini_breaker = CircuitBreaker('gemini')
+stt_breaker = CircuitBreaker('assemblyai')
+retry_budget = RetryBudget()
+# Удачные декомпозиции - для ответа, когда Gemini недоступен
+decomposition_cache = DecompositionCache()
+
+# Загружаются при старте в load_task_models(), а не при импорте
+task_classifier = None
+question_examples = None
+
+def load_task_classifier():
+    """Классификатор простых задач; без файла модели вопросы задаются всегда"""
+    if not os.path.exists(TASK_CLASSIFIER_PATH):
+        return None
+    try:
+        return TaskClassifier.load(TASK_CLASSIFIER_PATH)
+    except (OSError, ValueError, KeyError) as e:
+        llm_log.warning("Task classifier %s not loaded: %s", TASK_CLASSIFIER_PATH, e)
+        return None
+
+async def load_task_models():
+    """Классификатор простых задач и примеры вопросов для промпта context_questions.txt"""
+    global task_classifier, question_examples
+    task_classifier = await asyncio.to_thread(load_task_classifier)
+    question_examples = await asyncio.to_thread(ExampleIndex.load)
+
+# Решения пользователей (пропустил вопросы или ответил) - данные для обучения классификатора
+task_labels = TaskLabelLog(TASK_LABELS_PATH) if TASK_LABELS_PATH else None
+health_state.register_provider('gemini', lambda: {**gemini_status.status(), 'circuit': gemini_breaker.status()})
+health_state.register_provider('assemblyai', lambda: {**stt_status.status(), 'configured': bool(ASSEMBLYAI_API_KEY),
+                                                      'circuit': stt_breaker.status()})
+health_state.register_provider('telegram', telegram_status.status)
 
 # Функция для загрузки промптов из файлов
 def load_prompt(filename):
@@ -53,11 +236,245 @@ def load_prompt(filename):
         with open(prompt_path, 'r', encoding='utf-8') as f:
             return f.read()
     except FileNotFoundError:
-        print(f"⚠️ Prompt file not found: {filename}")
+        log.warning("Prompt file not found: %s", filename)
         return None
 
+STEP_LINE_RE = re.compile(r'^Шаг (\d+) \(\d+ мин\):')
+
+def parse_step_minutes(step, default=DEFAULT_STEP_MINUTES):
+    """Достаёт оценку времени из шага вида 'Шаг 1 (5 мин): ...'"""
+    if 'мин' in step:
+        try:
+            return int(step.split('(')[1].split('мин')[0].strip())
+        except (IndexError, ValueError):
+            pass
+    return default
+
+def step_estimate_minutes(task_data, index):
+    """Оценка шага без поправки калибратора; для шагов с подставленным временем она хранится отдельно"""
+    raw = task_data.get('raw_minutes', {}).get(index)
+    return raw if raw is not None else parse_step_minutes(task_data['steps'][index])
+
+def set_step(user_id, index, text):
+    """Заменяет шаг; без указанного времени ставит оценку по умолчанию с поправкой пользователя"""
+    task_data = user_tasks[user_id]
+    raw_minutes = task_data.setdefault('raw_minutes', {})
+    if text.startswith('Шаг'):
+        raw_minutes.pop(index, None)
+    else:
+        minutes = duration_calibrator.estimate_minutes(user_id, DEFAULT_STEP_MINUTES)
+        text = f"Шаг {index + 1} ({minutes} мин): {text}"
+        # Таймер и калибровка опираются на исходную оценку, иначе поправка применится дважды
+        raw_minutes[index] = DEFAULT_STEP_MINUTES
+    task_data['steps'][index] = text
+    return text
+
+def record_step_event(user_id, kind):
+    """Записывает событие текущего шага пользователя в журнал step_events"""
+    task_data = user_tasks[user_id]
+    current = task_data['current']
+    steps = task_data['steps']
+    if current >= len(steps):
+        return
+
+    now = time.time()
+    estimate_s = step_estimate_minutes(task_data, current) * 60
+    if kind == STEP_START:
+        task_data['step_started_at'] = now
+        actual_s = float('nan')
+    else:
+        started_at = task_data.get('step_started_at')
+        actual_s = now - started_at if started_at else float('nan')
+
+    step_events.record(user_id, task_data.get('task_id', 0), current, len(steps), kind, estimate_s, actual_s, ts=now)
+
+    # Калибруем таймеры только по выполненным шагам: пропуск ничего не говорит о длительности
+    if kind == STEP_DONE:
+        duration_calibrator.observe(user_id, estimate_s, actual_s)
+
+def _generate_sync(prompt, model_name, generation_config=None):
+    # Таймаут самого HTTP-запроса: отменённый по LLM_TIMEOUT вызов не прерывает поток, и без него
+    # поток продолжал бы ждать Gemini, когда слот планировщика уже отдан другому запросу
+    request_options = {'timeout': LLM_TIMEOUT}
+    if generation_config is None:
+        return get_model(model_name).generate_content(prompt, request_options=request_options).text
+    return get_model(model_name).generate_content(prompt, generation_config=generation_config,
+                                                  request_options=request_options).text
+
+# Выбирает для каждого типа промпта самую быструю здоровую модель из LLM_MODELS и хеджирует медленные запросы
+llm_router = ModelRouter()
+
+# Общий лимит одновременных запросов к Gemini с приоритетами и честной очередью по пользователям
+llm_scheduler = LLMScheduler()
+
+async def _request_llm(prompt, kind, generation_config=None):
+    """Запрос к Gemini с учётом задержки и ошибок в метриках; kind - тип промпта"""
+    if gemini_breaker.is_open:
+        # Не держим запрос в очереди планировщика, если он всё равно будет отклонён
+        metrics.LLM_REQUESTS.labels(kind, 'rejected').inc()
+        raise CircuitOpenError("gemini circuit is open")
+    return await _send_llm(prompt, kind, generation_config)
+
+async def _send_llm(prompt, kind, generation_config=None):
+    started = time.perf_counter()
+    # Ожидание слота планировщика - в bot_llm_queue_wait_seconds, в задержку Gemini не входит
+    queued = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot():
+        nonlocal queued
+        waiting_since = time.perf_counter()
+        async with llm_scheduler.slot(kind):
+            queued += time.perf_counter() - waiting_since
+            yield
+
+    try:
+        metrics.LLM_PROMPT_CHARS.labels(kind).observe(len(prompt))
+        with tracing.span('llm', kind=kind, prompt_chars=len(prompt)) as span:
+            # SDK синхронный - выполняем запрос в пуле потоков, чтобы не останавливать event loop.
+            # Отменённый хедж не прерывает поток: его ответ просто не используется.
+            # Слот планировщика занимает каждая попытка (но не пауза перед повтором), хедж - свой слот
+            text, model_name = await call_with_retries(
+                gemini_breaker, retry_budget,
+                lambda: llm_router.call(kind, lambda name: asyncio.to_thread(_generate_sync, prompt, name, generation_config),
+                                        reserve=llm_scheduler.try_reserve),
+                timeout=LLM_TIMEOUT, slot=slot)
+            if span is not None:
+                span.attrs['model'] = model_name
+    except CircuitOpenError:
+        metrics.LLM_REQUESTS.labels(kind, 'rejected').inc()
+        raise
+    except Exception as e:
+        gemini_status.record(False, type(e).__name__)
+        metrics.LLM_REQUESTS.labels(kind, 'error').inc()
+        llm_log.warning("Gemini %s request failed", kind, exc_info=True)
+        raise
+    finally:
+        metrics.LLM_DURATION.labels(kind).observe(time.perf_counter() - started - queued)
+    gemini_status.record(True)
+    metrics.LLM_REQUESTS.labels(kind, 'ok').inc()
+    return text
+
+# Одинаковые промпты (популярная задача, двойная отправка), которые уже ждут ответа Gemini
+llm_flights = SingleFlight()
+
+def _flight_key(prompt, kind, generation_config=None):
+    # Тип промпта влияет на выбор модели, поэтому входит в ключ вместе со списком моделей и параметрами генерации
+    return request_key(kind, ','.join(llm_router.models), json.dumps(generation_config, sort_keys=True), prompt)
+
+async def generate_text(prompt, kind, generation_config=None):
+    """Запрос к Gemini; такой же одновременный запрос отправляется один раз, ответ получают все"""
+    return await llm_flights.do(_flight_key(prompt, kind, generation_config),
+                                lambda: _request_llm(prompt, kind, generation_config), kind)
+
+# Structured output: Gemini возвращает декомпозицию JSON-объектом по схеме
+DECOMPOSE_GENERATION_CONFIG = {'response_mime_type': 'application/json', 'response_schema': DECOMPOSITION_SCHEMA}
+OVERVIEW_GENERATION_CONFIG = {'response_mime_type': 'application/json', 'response_schema': OVERVIEW_SCHEMA}
+
+# Однотипные запросы разных пользователей, которые можно отправлять одним промптом
+LLM_BATCH_KINDS = ('rewrite', 'questions')
+llm_batcher = MicroBatcher(_request_llm, lambda: load_prompt('batch.txt')) if LLM_BATCH_ENABLED else None
+
+async def generate_batched(prompt, kind):
+    """Как generate_text, но запрос может уйти в одном промпте с однотипными запросами других пользователей"""
+    if llm_batcher is None or kind not in LLM_BATCH_KINDS:
+        return await generate_text(prompt, kind)
+    return await llm_flights.do(_flight_key(prompt, kind), lambda: llm_batcher.submit(prompt, kind), kind)
+
+async def generate_alternatives(task_name, steps, count):
+    """Один запрос к Gemini за вариантами нескольких шагов: {номер шага: [варианты]}"""
+    prompt_template = load_prompt('rewrite_alternatives.txt')
+    if not prompt_template:
+        return {}
+    steps_text = '\n'.join(f"Шаг {index + 1}: {step.split(':', 1)[-1].strip()}" for index, step in steps.items())
+    prompt = (prompt_template.replace('{task}', task_name).replace('{steps}', steps_text)
+              .replace('{count}', str(count)))
+
+    text = await generate_text(prompt, 'alternatives')
+    result = {index: [] for index in steps}
+    for line in text.split('\n'):
+        match = STEP_LINE_RE.match(line.strip())
+        if not match:
+            continue
+        index = int(match.group(1)) - 1
+        if index in result and len(result[index]) < count:
+            # Номер в тексте - номер исходного шага, так шаг и будет показан
+            result[index].append(line.strip())
+    return result
+
+# Пул заранее сгенерированных вариантов для кнопки "🔄 Переписать"
+alternatives_pool = AlternativesPool(generate_alternatives) if ALTERNATIVES_ENABLED else None
+
+def _transcribe_sync(voice_path):
+    aai = get_aai()
+    transcriber = aai.Transcriber()
+    config = aai.TranscriptionConfig(language_code="ru")  # Русский язык
+    return transcriber.transcribe(voice_path, config=config)
+
+async def transcribe_voice(voice_path):
+    """Распознаёт голосовое сообщение через AssemblyAI с учётом в метриках"""
+    started = time.perf_counter()
+    try:
+        with tracing.span('stt'):
+            # transcribe() ждёт результата опросом - тоже в пуле потоков
+            # AssemblyAI сообщает о сбое распознавания статусом, а не исключением
+            transcript = await call_with_retries(stt_breaker, retry_budget,
+                                                 lambda: asyncio.to_thread(_transcribe_sync, voice_path),
+                                                 timeout=STT_TIMEOUT,
+                                                 failed=lambda result: result.status == get_aai().TranscriptStatus.error)
+    except CircuitOpenError:
+        metrics.STT_REQUESTS.labels('rejected').inc()
+        raise
+    except Exception as e:
+        stt_status.record(False, type(e).__name__)
+        metrics.STT_REQUESTS.labels('error').inc()
+        stt_log.warning("AssemblyAI request failed", exc_info=True)
+        raise
+    finally:
+        metrics.STT_DURATION.observe(time.perf_counter() - started)
+    failed = transcript.status == get_aai().TranscriptStatus.error
+    stt_status.record(not failed, transcript.error if failed else None)
+    metrics.STT_REQUESTS.labels('error' if failed else 'ok').inc()
+    return transcript
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, записывающий задержку и коды ответов Bot API в метрики и трассу"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        # Скачивания файлов идут по /file/bot<token>/<путь>, метку по пути не заводим
+        api_method = 'file_download' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        code = 'error'
+        try:
+            with tracing.span('telegram', method=api_method) as span:
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+                if span is not None:
+                    span.attrs['code'] = code
+            return code, payload
+        finally:
+            metrics.TELEGRAM_DURATION.labels(api_method).observe(time.perf_counter() - started)
+            metrics.TELEGRAM_REQUESTS.labels(api_method, str(code)).inc()
+            if code == 429:
+                metrics.TELEGRAM_RATE_LIMITED.labels(api_method).inc()
+            # Ответы 4xx - ошибки запроса, а не недоступность Bot API
+            telegram_status.record(code != 'error' and code < 500, None if code != 'error' else 'network')
+
+def update_kind(update):
+    """Тип апдейта для метрик: данные кнопки без номера шага, voice, command или text"""
+    if update.callback_query:
+        data = update.callback_query.data or 'callback'
+        return data.rstrip('0123456789').rstrip('_')
+    message = update.message
+    if message is None:
+        return 'other'
+    if message.voice:
+        return 'voice'
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    return 'text'
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(f"📥 /start command from user {update.effective_user.id}")
+    handlers_log.info("/start from user %s", update.effective_user.id)
     await update.message.reply_text(
         "Бывает, большая задача ставит в тупик, и непонятно, с чего начать. Хочется отложить её на потом, но лучший способ обрести ясность — просто начать действовать\n\n"
         "Я помогу тебе сделать первый шаг, до крайности простой, чтобы не было соблазна его отложить\n\n"
@@ -68,17 +485,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    # Debug: выводим информацию о типе сообщения
-    print(f"🔍 handle_task called from user {user_id}")
-    print(f"🔍 Message type - text: {update.message.text is not None}, voice: {update.message.voice is not None}, audio: {update.message.audio is not None}")
-
     task_text = update.message.text
-    print(f"📥 Task received from user {user_id}: {task_text}")
+    handlers_log.info("Text message from user %s", user_id)
+    handlers_log.debug("Text from user %s: %s", user_id, task_text)
 
     # Проверяем режим ожидания обратной связи
     if context.user_data.get('waiting_for_feedback'):
         feedback_text = task_text.strip()
-        print(f"💬 Feedback received from user {user_id}: {feedback_text}")
+        handlers_log.info("Feedback received from user %s", user_id)
 
         # Сохраняем обратную связь
         context.user_data['user_feedback'] = feedback_text
@@ -95,11 +509,13 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_context = task_text.strip()
         task_to_decompose = context.user_data.get('pending_task')
 
-        print(f"📝 Context received from user {user_id}: {user_context}")
+        handlers_log.info("Context received from user %s", user_id)
+        record_task_label(task_to_decompose, simple=False)
 
         # Сбрасываем флаг
         context.user_data['waiting_for_context'] = False
         context.user_data['pending_task'] = None
+        context.user_data.pop('draft_steps', None)
 
         # Запускаем декомпозицию с контекстом
         await decompose_task_with_context(update, task_to_decompose, user_context, user_id, context_obj=context)
@@ -109,15 +525,10 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get('editing_single_step') is not None and user_id in user_tasks:
         step_num = context.user_data['editing_single_step']
 
-        # Парсим новый текст шага
-        new_step = task_text.strip()
-
-        # Если не начинается с "Шаг", форматируем
-        if not new_step.startswith('Шаг'):
-            new_step = f"Шаг {step_num + 1} (5 мин): {new_step}"
-
-        # Обновляем шаг
-        user_tasks[user_id]['steps'][step_num] = new_step
+        # Обновляем шаг; если он не начинается с "Шаг", форматируем
+        new_step = set_step(user_id, step_num, task_text.strip())
+        if alternatives_pool is not None:
+            alternatives_pool.invalidate_step(user_id, step_num, new_step)
 
         keyboard = [[InlineKeyboardButton("▶️ Продолжить", callback_data="start_steps")]]
         await update.message.reply_text(
@@ -135,6 +546,9 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if steps:
             user_tasks[user_id]['steps'] = steps
+            user_tasks[user_id].pop('raw_minutes', None)
+            if alternatives_pool is not None:
+                alternatives_pool.discard(user_id)
             steps_list = '\n'.join(steps)
             keyboard = [[InlineKeyboardButton("▶️ Начать", callback_data="start_steps")]]
             await update.message.reply_text(
@@ -147,35 +561,19 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Не смог распарсить шаги. Используй формат: Шаг 1 (5 мин): действие")
             return
 
+    # Простая задача - декомпозируем сразу, без вопросов и ожидания ответа
+    if not needs_context_questions(task_text):
+        handlers_log.info("Task from user %s classified as simple, skipping context questions", user_id)
+        context.user_data.pop('draft_steps', None)
+        await update.message.reply_text("⏳ Декомпозирую задачу...")
+        await decompose_task_with_context(update, task_text, "Стандартная ситуация", user_id, skip_status_message=True, context_obj=context)
+        return
+
     # Отправляем статусное сообщение
     status_msg = await update.message.reply_text("✍🏻 Хочу уточнить...")
 
     # Генерируем персонализированные вопросы для контекста
-    print(f"🤖 Generating context questions for task: {task_text[:50]}...")
-
-    prompt_template = load_prompt('context_questions.txt')
-    if not prompt_template:
-        # Fallback на стандартные вопросы
-        questions_text = (
-            "• Где ты сейчас находишься?\n"
-            "• Сколько у тебя времени?\n"
-            "• Какие ресурсы доступны?\n"
-            "• Твоё текущее состояние?"
-        )
-    else:
-        try:
-            prompt = prompt_template.replace('{task}', task_text)
-            response = model.generate_content(prompt)
-            questions_text = response.text.strip()
-            print(f"✅ Generated personalized questions")
-        except Exception as e:
-            print(f"⚠️ Error generating questions: {e}, using fallback")
-            questions_text = (
-                "• Где ты сейчас находишься?\n"
-                "• Сколько у тебя времени?\n"
-                "• Какие ресурсы доступны?\n"
-                "• Твоё текущее состояние?"
-            )
+    questions_text = await ask_context_questions(task_text, context.user_data)
 
     # Запрашиваем контекст перед декомпозицией
     context.user_data['waiting_for_context'] = True
@@ -194,7 +592,57 @@ async def handle_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return
 
-async def decompose_task_with_context(update: Update, task_text: str, user_context: str, user_id: int, message=None, skip_status_message=False, feedback=None, context_obj=None):
+def needs_context_questions(task_text):
+    """False, если по мнению классификатора задача простая и уточняющие вопросы можно пропустить"""
+    if task_classifier is None:
+        return True
+    if task_classifier.simple_probability(task_text) < TASK_CLASSIFIER_THRESHOLD:
+        decision = 'ask'
+    elif random.random() < TASK_CLASSIFIER_EXPLORE:
+        # Иногда спрашиваем и простые по мнению модели задачи, чтобы видеть её ошибки в журнале
+        decision = 'explore'
+    else:
+        decision = 'skip'
+    metrics.CLASSIFIER_DECISIONS.labels(decision).inc()
+    return decision != 'skip'
+
+def record_task_label(task_text, simple):
+    if task_labels is None or not task_text:
+        return
+    try:
+        task_labels.record(task_text, simple)
+    except OSError as e:
+        handlers_log.warning("Task label not recorded: %s", e)
+
+async def ask_context_questions(task_text, user_data):
+    """Вопросы по задаче; в режиме COMBINED_OVERVIEW тем же запросом - черновик декомпозиции в user_data"""
+    llm_log.debug("Generating context questions for task: %.50s", task_text)
+    user_data.pop('draft_steps', None)
+
+    prompt_template = load_prompt('task_overview.txt' if COMBINED_OVERVIEW else 'context_questions.txt')
+    if not prompt_template:
+        # Fallback на стандартные вопросы
+        return FALLBACK_QUESTIONS
+    prompt = prompt_template.replace('{task}', task_text)
+    if not COMBINED_OVERVIEW:
+        prompt = prompt.replace('{examples}', question_examples.render(task_text) if question_examples is not None else '')
+    try:
+        if not COMBINED_OVERVIEW:
+            questions_text = (await generate_batched(prompt, 'questions')).strip()
+        else:
+            questions, draft = parse_overview(await generate_text(prompt, 'overview', OVERVIEW_GENERATION_CONFIG))
+            questions_text = '\n'.join(f"• {question}" for question in questions)
+            if draft:
+                # Понадобится, если пользователь пропустит контекст: тогда второй запрос к Gemini не нужен
+                user_data['draft_steps'] = {'task': task_text, 'steps': draft}
+        llm_log.debug("Generated personalized questions")
+        return questions_text
+    except Exception as e:
+        llm_log.warning("Error generating questions: %s, using fallback", e)
+        metrics.DEGRADED_RESPONSES.labels('questions').inc()
+        return FALLBACK_QUESTIONS
+
+async def decompose_task_with_context(update: Update, task_text: str, user_context: str, user_id: int, message=None, skip_status_message=False, feedback=None, context_obj=None, draft_steps=None):
     """Декомпозирует задачу с учетом контекста пользователя и опциональной обратной связи"""
     # Определяем откуда отправлять сообщения - из update.message или переданный message
     msg = message if message else update.message
@@ -206,7 +654,7 @@ async def decompose_task_with_context(update: Update, task_text: str, user_conte
         context_obj.user_data['user_context'] = user_context
 
     # Загружаем промпт из файла
-    prompt_template = load_prompt('decompose_task.txt')
+    prompt_template = load_prompt('decompose_task_json.txt' if DECOMPOSE_JSON else 'decompose_task.txt')
     if not prompt_template:
         await msg.reply_text("Ошибка: не найден файл с инструкциями для AI")
         return
@@ -216,23 +664,41 @@ async def decompose_task_with_context(update: Update, task_text: str, user_conte
     if feedback:
         prompt += f"\n\nВАЖНО: Пользователь оставил обратную связь о предыдущих вариантах:\n{feedback}\n\nУчти эту обратную связь и создай СОВЕРШЕННО НОВЫЙ подход к решению задачи."
 
-    try:
-        print(f"🤖 Sending request to Gemini API with context...")
-        response = model.generate_content(prompt)
-        print(f"✅ Gemini API response received")
-
-        steps_text = response.text
-        print(f"📝 Response text: {steps_text[:200]}...")
-
-        steps = [line.strip() for line in steps_text.split('\n') if line.strip().startswith('Шаг')]
-        print(f"📋 Parsed {len(steps)} steps")
+    degraded = False
+    if draft_steps:
+        # Черновик пришёл вместе с вопросами - без запроса к Gemini
+        steps = draft_steps
+    else:
+        try:
+            steps_text = await generate_text(prompt, 'decompose', DECOMPOSE_GENERATION_CONFIG if DECOMPOSE_JSON else None)
+            llm_log.debug("Decomposition response: %.200s", steps_text)
+            steps, parsed_as = parse_decomposition(steps_text)
+            metrics.DECOMPOSE_PARSED.labels(parsed_as).inc()
+        except DecompositionParseError:
+            metrics.DECOMPOSE_PARSED.labels('failed').inc()
+            steps = []
+        except Exception as e:
+            # Упрощённый режим: прошлая декомпозиция этой задачи или универсальный шаблон, без ожидания Gemini
+            (llm_log.info if isinstance(e, CircuitOpenError) else llm_log.warning)(
+                "Decomposition failed for user %s, answering in degraded mode: %s", user_id, e)
+            metrics.DEGRADED_RESPONSES.labels('decompose').inc()
+            steps = decomposition_cache.get(task_text, user_id) or template_steps(task_text)
+            degraded = True
+
+    if not steps:
+        llm_log.warning("No steps parsed from decomposition response")
+        await msg.reply_text("Не смог распарсить шаги. Попробуй переформулировать задачу.")
+        return
+    if not degraded and not feedback:
+        # С ответами на вопросы декомпозиция личная - другим пользователям её не показываем
+        decomposition_cache.put(task_text, steps, None if user_context == "Стандартная ситуация" else user_id)
 
-        if not steps:
-            print(f"⚠️ No steps parsed from response")
-            await msg.reply_text("Не смог распарсить шаги. Попробуй переформулировать задачу.")
-            return
+    try:
+        if degraded:
+            await msg.reply_text(DEGRADED_NOTICE)
 
         user_tasks[user_id] = {
+            'task_id': new_task_id(),
             'steps': steps,
             'current': 0,
             'task_name': task_text,
@@ -271,12 +737,14 @@ async def decompose_task_with_context(update: Update, task_text: str, user_conte
         if context_obj:
             context_obj.user_data['step_messages'] = step_messages
 
-        print(f"✅ Steps sent to user {user_id}")
+        handlers_log.info("Sent %d steps to user %s", len(steps), user_id)
+
+        if alternatives_pool is not None and not degraded:
+            alternatives_pool.fill(user_id, user_tasks[user_id]['task_id'], task_text, steps)
 
     except Exception as e:
-        print(f"❌ ERROR in decompose_task_with_context: {type(e).__name__}: {str(e)}")
-        traceback.print_exc()
-        await msg.reply_text(f"Произошла ошибка: {type(e).__name__}: {str(e)}")
+        handlers_log.exception("Error in decompose_task_with_context")
+        await msg.reply_text("Произошла ошибка, попробуй ещё раз.")
 
 async def edit_steps(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -319,22 +787,29 @@ async def skip_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Задача не найдена.", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
-    print(f"⏭ User {user_id} skipped context")
+    handlers_log.info("User %s skipped context", user_id)
+    record_task_label(task_text, simple=True)
 
     # Сбрасываем флаги
     context.user_data['waiting_for_context'] = False
     context.user_data['pending_task'] = None
 
+    # Черновик декомпозиции, полученный вместе с вопросами (COMBINED_OVERVIEW), - только для этой же задачи
+    draft = context.user_data.pop('draft_steps', None)
+    draft_steps = draft['steps'] if draft and draft['task'] == task_text else None
+    if draft_steps:
+        metrics.DRAFTS_USED.inc()
+
     # Декомпозируем без контекста (используем дефолтный контекст)
     await query.edit_message_text("⏳ Декомпозирую задачу...")
-    await decompose_task_with_context(update, task_text, "Стандартная ситуация", user_id, message=query.message, skip_status_message=True, context_obj=context)
+    await decompose_task_with_context(update, task_text, "Стандартная ситуация", user_id, message=query.message, skip_status_message=True, context_obj=context, draft_steps=draft_steps)
 
 async def start_steps(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
 
-    print(f"▶️ User {user_id} started steps")
+    handlers_log.info("User %s started steps", user_id)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -352,15 +827,15 @@ async def send_current_step(query, user_id, context):
     steps = task_data['steps']
 
     if current >= len(steps):
-        print(f"🎉 User {user_id} completed all steps")
+        handlers_log.info("User %s completed all steps", user_id)
 
         # Сохраняем в историю
         if user_id not in user_history:
-            user_history[user_id] = []
+            user_history[user_id] = UserHistory()
 
         task_data['completed'] = True
         task_data['completed_at'] = datetime.now()
-        user_history[user_id].append(task_data.copy())
+        user_history[user_id].add(task_data['task_name'], len(steps), task_data['completed_at'])
 
         keyboard = [
             [InlineKeyboardButton("➕ Новая задача", callback_data="new_task")]
@@ -372,18 +847,18 @@ async def send_current_step(query, user_id, context):
         )
 
         del user_tasks[user_id]
+        if alternatives_pool is not None:
+            alternatives_pool.discard(user_id)
         return
 
     step = steps[current]
-    minutes = 5
+    minutes = step_estimate_minutes(task_data, current)
+    record_step_event(user_id, STEP_START)
 
-    if 'мин' in step:
-        try:
-            minutes = int(step.split('(')[1].split('мин')[0].strip())
-        except:
-            pass
+    # Поправляем оценку модели по реальным длительностям шагов
+    timer_seconds = duration_calibrator.calibrate(user_id, minutes * 60)
 
-    print(f"📤 Sending step {current + 1}/{len(steps)} to user {user_id}, timer: {minutes} min")
+    handlers_log.debug("Sending step %d/%d to user %s, timer: %d min -> %ds", current + 1, len(steps), user_id, minutes, timer_seconds)
 
     # Кнопки для управления шагом
     keyboard = [
@@ -394,23 +869,31 @@ async def send_current_step(query, user_id, context):
     ]
 
     # Запускаем таймер в реальном времени
-    end_time = datetime.now() + timedelta(minutes=minutes)
+    end_time = datetime.now() + timedelta(seconds=timer_seconds)
     task_data['current_step_end_time'] = end_time
 
     await query.edit_message_text(
-        f"Шаг {current + 1}/{len(steps)}:\n\n{step}\n\n⏱ Осталось: {minutes:02d}:00",
+        f"Шаг {current + 1}/{len(steps)}:\n\n{step}\n\n⏱ Осталось: {timer_seconds // 60:02d}:{timer_seconds % 60:02d}",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-    # Создаем задачу обновления таймера
+    # Запоминаем сообщение шага, чтобы таймер можно было возобновить после перезапуска
+    task_data['step_message'] = (query.message.chat_id, query.message.message_id)
+    start_step_timer(context.bot, query.message.chat_id, query.message.message_id, user_id, current)
+
+def start_step_timer(bot, chat_id, message_id, user_id, step_num):
+    """Создаем задачу обновления таймера в сообщении шага"""
     if user_id in timer_tasks:
         timer_tasks[user_id].cancel()
 
-    timer_tasks[user_id] = asyncio.create_task(
-        update_timer(query, user_id, minutes, current, context)
+    timer = asyncio.create_task(
+        update_timer(bot, chat_id, message_id, user_id, step_num)
     )
+    timer_tasks[user_id] = timer
+    # Убираем ссылку на завершившийся таймер, если его не сменил новый
+    timer.add_done_callback(lambda t: timer_tasks.pop(user_id, None) if timer_tasks.get(user_id) is t else None)
 
-async def update_timer(query, user_id, total_minutes, step_num, context):
+async def update_timer(bot, chat_id, message_id, user_id, step_num):
     # Обновляет таймер в реальном времени каждую секунду, используя реальное время
     try:
         if user_id not in user_tasks:
@@ -443,8 +926,9 @@ async def update_timer(query, user_id, total_minutes, step_num, context):
                     [InlineKeyboardButton("◀️ Назад", callback_data="prev_step"),
                      InlineKeyboardButton("❌ Отменить", callback_data="cancel_task")]
                 ]
-                await query.message.reply_text(
-                    "⏰ Время вышло! Готово?",
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text="⏰ Время вышло! Готово?",
                     reply_markup=InlineKeyboardMarkup(keyboard)
                 )
                 return
@@ -465,27 +949,29 @@ async def update_timer(query, user_id, total_minutes, step_num, context):
             ]
 
             try:
-                await query.message.edit_text(
+                await bot.edit_message_text(
                     f"Шаг {step_num + 1}/{len(steps)}:\n\n{step}\n\n"
                     f"⏱ Осталось: {mins:02d}:{secs:02d}",
+                    chat_id=chat_id,
+                    message_id=message_id,
                     reply_markup=InlineKeyboardMarkup(keyboard)
                 )
             except Exception as e:
                 # Игнорируем ошибки "message is not modified"
                 if "message is not modified" not in str(e).lower():
-                    print(f"⚠️ Could not update timer: {e}")
+                    timer_log.warning("Could not update timer: %s", e)
 
     except asyncio.CancelledError:
-        print(f"⏱ Timer cancelled for user {user_id}")
+        timer_log.debug("Timer cancelled for user %s", user_id)
     except Exception as e:
-        print(f"❌ Error in timer: {e}")
+        timer_log.exception("Error in timer")
 
 async def next_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
 
-    print(f"➡️ User {user_id} clicked next step")
+    handlers_log.info("User %s finished step", user_id)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -496,6 +982,7 @@ async def next_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in timer_tasks:
         timer_tasks[user_id].cancel()
 
+    record_step_event(user_id, STEP_DONE)
     user_tasks[user_id]['current'] += 1
     await send_current_step(query, user_id, context)
 
@@ -504,7 +991,7 @@ async def skip_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer("⏭ Шаг пропущен")
     user_id = update.effective_user.id
 
-    print(f"⏭ User {user_id} skipped step")
+    handlers_log.info("User %s skipped step", user_id)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -515,6 +1002,7 @@ async def skip_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in timer_tasks:
         timer_tasks[user_id].cancel()
 
+    record_step_event(user_id, STEP_SKIP)
     user_tasks[user_id]['current'] += 1
     await send_current_step(query, user_id, context)
 
@@ -537,12 +1025,13 @@ async def prev_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     await query.answer("◀️ Возврат к предыдущему шагу")
-    print(f"◀️ User {user_id} went back to previous step")
+    handlers_log.info("User %s went back to previous step", user_id)
 
     # Отменяем таймер текущего шага
     if user_id in timer_tasks:
         timer_tasks[user_id].cancel()
 
+    record_step_event(user_id, STEP_BACK)
     user_tasks[user_id]['current'] -= 1
     await send_current_step(query, user_id, context)
 
@@ -551,7 +1040,7 @@ async def cancel_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = update.effective_user.id
 
-    print(f"❌ User {user_id} cancelled task")
+    handlers_log.info("User %s cancelled task", user_id)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -565,6 +1054,8 @@ async def cancel_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     task_name = user_tasks[user_id]['task_name']
     del user_tasks[user_id]
+    if alternatives_pool is not None:
+        alternatives_pool.discard(user_id)
 
     keyboard = [[InlineKeyboardButton("➕ Новая задача", callback_data="new_task")]]
 
@@ -579,7 +1070,7 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = update.effective_user.id
 
-    print(f"🔄 User {user_id} requested full rewrite")
+    handlers_log.info("User %s requested full rewrite", user_id)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -589,11 +1080,9 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Получаем счётчик нажатий
     rewrite_count = context.user_data.get('rewrite_all_count', 0)
 
-    print(f"📊 Rewrite count: {rewrite_count}/5")
-
     # Если достигнут лимит - запрашиваем обратную связь
     if rewrite_count >= 5:
-        print(f"⚠️ Rewrite limit reached, requesting feedback")
+        handlers_log.info("Rewrite limit reached for user %s, requesting feedback", user_id)
 
         # Удаляем все сообщения со шагами
         step_messages = context.user_data.get('step_messages', [])
@@ -601,7 +1090,7 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
             except Exception as e:
-                print(f"⚠️ Could not delete message {msg_id}: {e}")
+                handlers_log.warning("Could not delete message %s: %s", msg_id, e)
 
         # Сбрасываем счётчик
         context.user_data['rewrite_all_count'] = 0
@@ -618,7 +1107,7 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Увеличиваем счётчик
     context.user_data['rewrite_all_count'] = rewrite_count + 1
-    print(f"📈 Rewrite count increased to {rewrite_count + 1}")
+    handlers_log.debug("Rewrite count for user %s: %d/5", user_id, rewrite_count + 1)
 
     # Получаем оригинальную задачу и контекст
     task_text = user_tasks[user_id]['task_name']
@@ -633,7 +1122,7 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
         except Exception as e:
-            print(f"⚠️ Could not delete message {msg_id}: {e}")
+            handlers_log.warning("Could not delete message %s: %s", msg_id, e)
 
     context.user_data['step_messages'] = []
 
@@ -641,7 +1130,7 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await query.message.delete()
     except Exception as e:
-        print(f"⚠️ Could not delete final message: {e}")
+        handlers_log.warning("Could not delete final message: %s", e)
 
     # Отправляем новое сообщение (не редактируем, т.к. старое удалено)
     status_msg = await context.bot.send_message(
@@ -649,17 +1138,18 @@ async def rewrite_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text="⏳ Полностью переписываю задачу с новым подходом..."
     )
 
-    # Регенерируем задачу с обратной связью
-    await decompose_task_with_context(
-        update,
-        task_text,
-        user_context,
-        user_id,
-        message=status_msg,
-        skip_status_message=True,
-        feedback=feedback,
-        context_obj=context
-    )
+    # Регенерируем задачу с обратной связью; в очереди к Gemini - после первых декомпозиций других пользователей
+    with llm_priority(REWRITE):
+        await decompose_task_with_context(
+            update,
+            task_text,
+            user_context,
+            user_id,
+            message=status_msg,
+            skip_status_message=True,
+            feedback=feedback,
+            context_obj=context
+        )
 
 async def rewrite_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -669,7 +1159,7 @@ async def rewrite_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Извлекаем номер шага из callback_data
     step_num = int(query.data.split('_')[-1])
 
-    print(f"🔄 User {user_id} requested rewrite for step {step_num}")
+    handlers_log.info("User %s requested rewrite for step %d", user_id, step_num)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -689,28 +1179,41 @@ async def rewrite_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id in timer_tasks:
         timer_tasks[user_id].cancel()
 
-    await query.edit_message_text("⏳ Переписываю шаг...")
-
     try:
-        # Загружаем промпт из файла
-        prompt_template = load_prompt('rewrite_step.txt')
-        if not prompt_template:
-            await query.edit_message_text("Ошибка: не найден файл с инструкциями для AI")
-            return
-
-        prompt = prompt_template.replace('{step}', current_step).replace('{step_number}', str(step_num + 1))
+        # Сначала - заранее сгенерированный вариант, запрос к LLM - только если их нет
+        new_step = None
+        progress_shown = False
+
+        async def show_progress():
+            # Повторная правка тем же текстом вызвала бы ошибку "message is not modified"
+            nonlocal progress_shown
+            if not progress_shown:
+                progress_shown = True
+                await query.edit_message_text("⏳ Переписываю шаг...")
+
+        if alternatives_pool is not None:
+            # Если варианты шага ещё генерируются, пользователь видит статус, пока мы их ждём
+            new_step = await alternatives_pool.take(user_id, task_data.get('task_id'), step_num,
+                                                    on_wait=show_progress)
+        metrics.REWRITES_SERVED.labels('pool' if new_step is not None else 'llm').inc()
+
+        if new_step is None:
+            await show_progress()
+
+            # Загружаем промпт из файла
+            prompt_template = load_prompt('rewrite_step.txt')
+            if not prompt_template:
+                await query.edit_message_text("Ошибка: не найден файл с инструкциями для AI")
+                return
 
-        response = model.generate_content(prompt)
-        new_step = response.text.strip()
+            prompt = prompt_template.replace('{step}', current_step).replace('{step_number}', str(step_num + 1))
 
-        # Проверяем, что ответ начинается с "Шаг"
-        if not new_step.startswith('Шаг'):
-            new_step = f"Шаг {step_num + 1} (5 мин): {new_step}"
+            new_step = (await generate_batched(prompt, 'rewrite')).strip()
 
-        # Обновляем шаг
-        user_tasks[user_id]['steps'][step_num] = new_step
+        # Обновляем шаг; если ответ не начинается с "Шаг", форматируем
+        new_step = set_step(user_id, step_num, new_step)
 
-        print(f"✅ Step rewritten for user {user_id}")
+        handlers_log.debug("Step rewritten for user %s", user_id)
 
         # Обновляем сообщение с новым текстом шага и теми же кнопками
         keyboard = [
@@ -721,8 +1224,19 @@ async def rewrite_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(new_step, reply_markup=InlineKeyboardMarkup(keyboard))
 
     except Exception as e:
-        print(f"❌ Error in rewrite_step: {e}")
-        await query.edit_message_text(f"Произошла ошибка при переписывании: {str(e)}")
+        if isinstance(e, CircuitOpenError):
+            handlers_log.info("Gemini circuit is open, step %d of user %s left as is", step_num, user_id)
+        else:
+            handlers_log.exception("Error in rewrite_step")
+        metrics.DEGRADED_RESPONSES.labels('rewrite').inc()
+        # Шаг остаётся прежним, с теми же кнопками - переписать можно будет позже
+        keyboard = [
+            [InlineKeyboardButton("🔄 Переписать", callback_data=f"rewrite_step_{step_num}"),
+             InlineKeyboardButton("✏️ Редактировать", callback_data=f"edit_single_step_{step_num}")],
+            [InlineKeyboardButton("❌ Отменить", callback_data="cancel_task")]
+        ]
+        await query.edit_message_text(f"{current_step}\n\n⚠️ Сейчас не получается переписать шаг, попробуй чуть позже.",
+                                      reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def edit_single_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -732,7 +1246,7 @@ async def edit_single_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Извлекаем номер шага из callback_data
     step_num = int(query.data.split('_')[-1])
 
-    print(f"✏️ User {user_id} requested edit for step {step_num}")
+    handlers_log.info("User %s requested edit for step %d", user_id, step_num)
 
     if user_id not in user_tasks:
         keyboard = [[InlineKeyboardButton("📝 Описать задачу", callback_data="new_task")]]
@@ -770,7 +1284,7 @@ async def cancel_edit_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = update.effective_user.id
 
-    print(f"❌ User {user_id} cancelled step edit")
+    handlers_log.info("User %s cancelled step edit", user_id)
 
     step_num = context.user_data.get('editing_single_step')
     context.user_data['editing_single_step'] = None
@@ -805,18 +1319,7 @@ async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    history = user_history[user_id]
-    history_text = "📊 История выполненных задач:\n\n"
-
-    for i, task in enumerate(history[-5:], 1):
-        task_name = task['task_name']
-        steps_count = len(task['steps'])
-        completed_at = task.get('completed_at', 'неизвестно')
-
-        if isinstance(completed_at, datetime):
-            completed_at = completed_at.strftime('%d.%m.%Y %H:%M')
-
-        history_text += f"{i}. {task_name}\n   Шагов: {steps_count} | {completed_at}\n\n"
+    history_text = user_history[user_id].render(5)
 
     keyboard = [[InlineKeyboardButton("➕ Новая задача", callback_data="new_task")]]
 
@@ -841,18 +1344,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    history = user_history[user_id]
-    history_text = "📊 История выполненных задач:\n\n"
-
-    for i, task in enumerate(history[-10:], 1):
-        task_name = task['task_name']
-        steps_count = len(task['steps'])
-        completed_at = task.get('completed_at', 'неизвестно')
-
-        if isinstance(completed_at, datetime):
-            completed_at = completed_at.strftime('%d.%m.%Y %H:%M')
-
-        history_text += f"{i}. {task_name}\n   Шагов: {steps_count} | {completed_at}\n\n"
+    history_text = user_history[user_id].render(10)
 
     keyboard = [[InlineKeyboardButton("➕ Новая задача", callback_data="new_task")]]
 
@@ -861,12 +1353,18 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает голосовые сообщения и транскрибирует их"""
     user_id = update.effective_user.id
-    print(f"🎤 Voice message received from user {user_id}")
+    handlers_log.info("Voice message from user %s", user_id)
 
     if not ASSEMBLYAI_API_KEY:
         await update.message.reply_text("⚠️ Функция распознавания голоса временно недоступна. API ключ не настроен.")
         return
 
+    if stt_breaker.is_open:
+        # AssemblyAI недоступен - не заставляем ждать таймаута
+        metrics.DEGRADED_RESPONSES.labels('voice').inc()
+        await update.message.reply_text("⚠️ Распознавание голоса сейчас недоступно. Напиши задачу текстом.")
+        return
+
     # Отправляем статус "печатает"
     status_msg = await update.message.reply_text("🎤 Расшифровываю голосовое сообщение...")
 
@@ -879,26 +1377,22 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         voice_path = f"temp_voice_{user_id}_{voice.file_id}.oga"
         await file.download_to_drive(voice_path)
 
-        print(f"📥 Voice file downloaded: {voice_path}")
+        stt_log.debug("Voice file downloaded: %s", voice_path)
 
         # Транскрибируем с помощью AssemblyAI
-        transcriber = aai.Transcriber()
-        config = aai.TranscriptionConfig(language_code="ru")  # Русский язык
-
-        print(f"🔄 Starting transcription...")
-        transcript = transcriber.transcribe(voice_path, config=config)
+        transcript = await transcribe_voice(voice_path)
 
         # Удаляем временный файл
         if os.path.exists(voice_path):
             os.remove(voice_path)
 
-        if transcript.status == aai.TranscriptStatus.error:
-            print(f"❌ Transcription error: {transcript.error}")
+        if transcript.status == get_aai().TranscriptStatus.error:
+            stt_log.warning("Transcription error: %s", transcript.error)
             await status_msg.edit_text(f"❌ Ошибка при расшифровке: {transcript.error}")
             return
 
         transcribed_text = transcript.text
-        print(f"✅ Transcription successful: {transcribed_text[:100]}...")
+        stt_log.debug("Transcription: %.100s", transcribed_text)
 
         # Обновляем сообщение с расшифровкой
         await status_msg.edit_text(
@@ -912,8 +1406,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_task_from_text(update, context, transcribed_text, status_msg)
 
     except Exception as e:
-        print(f"❌ Error in handle_voice: {type(e).__name__}: {str(e)}")
-        traceback.print_exc()
+        handlers_log.exception("Error in handle_voice")
         await status_msg.edit_text(f"❌ Произошла ошибка при обработке голосового сообщения: {str(e)}")
 
         # Удаляем временный файл если он существует
@@ -932,42 +1425,30 @@ async def handle_task_from_text(update: Update, context: ContextTypes.DEFAULT_TY
         user_context = task_text.strip()
         task_to_decompose = context.user_data.get('pending_task')
 
-        print(f"📝 Context received from user {user_id} (voice): {user_context}")
+        handlers_log.info("Context received from user %s (voice)", user_id)
+        record_task_label(task_to_decompose, simple=False)
 
         # Сбрасываем флаг
         context.user_data['waiting_for_context'] = False
         context.user_data['pending_task'] = None
+        context.user_data.pop('draft_steps', None)
 
         # Запускаем декомпозицию с контекстом
         await decompose_task_with_context(update, task_to_decompose, user_context, user_id, context_obj=context)
         return
 
-    # Генерируем персонализированные вопросы для контекста
-    print(f"🤖 Generating context questions for task: {task_text[:50]}...")
+    if not needs_context_questions(task_text):
+        handlers_log.info("Task from user %s classified as simple, skipping context questions", user_id)
+        context.user_data.pop('draft_steps', None)
+        if status_msg:
+            await status_msg.edit_text("⏳ Декомпозирую задачу...")
+        else:
+            await update.message.reply_text("⏳ Декомпозирую задачу...")
+        await decompose_task_with_context(update, task_text, "Стандартная ситуация", user_id, skip_status_message=True, context_obj=context)
+        return
 
-    prompt_template = load_prompt('context_questions.txt')
-    if not prompt_template:
-        # Fallback на стандартные вопросы
-        questions_text = (
-            "• Где ты сейчас находишься?\n"
-            "• Сколько у тебя времени?\n"
-            "• Какие ресурсы доступны?\n"
-            "• Твоё текущее состояние?"
-        )
-    else:
-        try:
-            prompt = prompt_template.replace('{task}', task_text)
-            response = model.generate_content(prompt)
-            questions_text = response.text.strip()
-            print(f"✅ Generated personalized questions")
-        except Exception as e:
-            print(f"⚠️ Error generating questions: {e}, using fallback")
-            questions_text = (
-                "• Где ты сейчас находишься?\n"
-                "• Сколько у тебя времени?\n"
-                "• Какие ресурсы доступны?\n"
-                "• Твоё текущее состояние?"
-            )
+    # Генерируем персонализированные вопросы для контекста
+    questions_text = await ask_context_questions(task_text, context.user_data)
 
     # Запрашиваем контекст перед декомпозицией
     context.user_data['waiting_for_context'] = True
@@ -998,138 +1479,441 @@ async def handle_task_from_text(update: Update, context: ContextTypes.DEFAULT_TY
 async def debug_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Логирует все входящие сообщения для отладки"""
     msg = update.message
-    user_id = update.effective_user.id
+    if msg is None:
+        return
+    debug_log.debug(
+        "Message from user %s: text=%s voice=%s audio=%s document=%s photo=%s",
+        update.effective_user.id, msg.text is not None, msg.voice is not None, msg.audio is not None,
+        msg.document is not None, bool(msg.photo),
+        extra={'text_preview': msg.text[:50] if msg.text else None,
+               'voice_duration': msg.voice.duration if msg.voice else None},
+    )
 
-    print(f"\n🔍 DEBUG: Message received from user {user_id}")
-    print(f"🔍 Has text: {msg.text is not None}")
-    print(f"🔍 Has voice: {msg.voice is not None}")
-    print(f"🔍 Has audio: {msg.audio is not None}")
-    print(f"🔍 Has document: {msg.document is not None}")
-    print(f"🔍 Has photo: {msg.photo is not None if msg.photo else False}")
-    print(f"🔍 Content type: {msg.content_type if hasattr(msg, 'content_type') else 'unknown'}")
-
-    if msg.text:
-        print(f"🔍 Text content: {msg.text[:50]}")
-    if msg.voice:
-        print(f"🔍 Voice file_id: {msg.voice.file_id}")
-        print(f"🔍 Voice duration: {msg.voice.duration}s")
-    print()
+async def drop_duplicate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отбрасывает повторное нажатие кнопки, пока сообщение не изменилось после первого"""
+    query = update.callback_query
+    if not callback_guard.is_duplicate(query):
+        return
+    handlers_log.info("Dropped duplicate callback %s from user %s", query.data, query.from_user.id)
+    metrics.DUPLICATES_DROPPED.labels('callback').inc()
+    try:
+        # Убираем часики на кнопке, ничего не выполняя повторно
+        await query.answer()
+    except TelegramError as e:
+        handlers_log.debug("Could not answer duplicate callback: %s", e)
+    raise ApplicationHandlerStop
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмечает активность пользователя и поднимает выгруженную сессию с диска"""
+    if update.effective_user:
+        session_manager.touch(update.effective_user.id, context.user_data)
+
+def register_handlers(app):
+    """Регистрирует все обработчики бота в приложении"""
+    # Учёт активности сессий (группа -2 = выполняется раньше всех)
+    app.add_handler(TypeHandler(Update, touch_session), group=-2)
+
+    # Повторные нажатия кнопок не доходят до обработчиков
+    app.add_handler(CallbackQueryHandler(drop_duplicate_callback), group=-1)
+
+    # DEBUG: универсальный handler для логирования всех сообщений (группа -1 = выполняется первым).
+    # Регистрируется только при включённом уровне DEBUG для bot.debug, иначе ничего не стоит
+    if debug_log.isEnabledFor(logging.DEBUG):
+        app.add_handler(MessageHandler(filters.ALL, debug_handler), group=-1)
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("history", history_command))
+    app.add_handler(MessageHandler(filters.VOICE, handle_voice))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_task))
+    app.add_handler(CallbackQueryHandler(skip_context, pattern="^skip_context$"))
+    app.add_handler(CallbackQueryHandler(start_steps, pattern="^start_steps$"))
+    app.add_handler(CallbackQueryHandler(edit_steps, pattern="^edit_steps$"))
+    app.add_handler(CallbackQueryHandler(next_step, pattern="^next_step$"))
+    app.add_handler(CallbackQueryHandler(skip_step, pattern="^skip_step$"))
+    app.add_handler(CallbackQueryHandler(prev_step, pattern="^prev_step$"))
+    app.add_handler(CallbackQueryHandler(cancel_task, pattern="^cancel_task$"))
+    app.add_handler(CallbackQueryHandler(rewrite_all, pattern="^rewrite_all$"))
+    app.add_handler(CallbackQueryHandler(rewrite_step, pattern="^rewrite_step_"))
+    app.add_handler(CallbackQueryHandler(edit_single_step, pattern="^edit_single_step_"))
+    app.add_handler(CallbackQueryHandler(cancel_edit_step, pattern="^cancel_edit_step$"))
+    app.add_handler(CallbackQueryHandler(show_history, pattern="^show_history$"))
+    app.add_handler(CallbackQueryHandler(new_task, pattern="^new_task$"))
+
+async def start_background_tasks(app):
+    """Запускает фоновые задачи бота (вытеснение неактивных сессий, контроль event loop)"""
+    global sweeper_task
+    loop_monitor.start()
+    session_manager.attach(app)
+    await load_task_models()
+    await restore_state(app)
+    sweeper_task = asyncio.create_task(session_manager.run_sweeper())
+
+def checkpoint_timers():
+    """Сохраняет сроки работающих таймеров шагов; возвращает их число"""
+    timers = {}
+    for user_id, timer in list(timer_tasks.items()):
+        task_data = user_tasks.get(user_id)
+        if timer.done() or not task_data or 'step_message' not in task_data or not task_data.get('current_step_end_time'):
+            continue
+        chat_id, message_id = task_data['step_message']
+        timers[str(user_id)] = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'step': task_data['current'],
+            'end_ts': task_data['current_step_end_time'].timestamp(),
+        }
+    tmp_path = TIMERS_CHECKPOINT_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(timers, f)
+    os.replace(tmp_path, TIMERS_CHECKPOINT_PATH)
+    return len(timers)
+
+def resume_timers(app):
+    """Возобновляет таймеры, сохранённые при прошлой остановке; возвращает их число"""
+    try:
+        with open(TIMERS_CHECKPOINT_PATH, 'r', encoding='utf-8') as f:
+            timers = json.load(f)
+        os.remove(TIMERS_CHECKPOINT_PATH)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        log.warning("Could not load timers checkpoint: %s", e)
+        return 0
+
+    resumed = 0
+    for key, saved in timers.items():
+        user_id = int(key)
+        # Поднимаем сессию с диска: она выгружена при остановке
+        session_manager.touch(user_id, app.user_data[user_id])
+        task_data = user_tasks.get(user_id)
+        if not task_data or task_data['current'] != saved['step']:
+            continue
+        task_data['current_step_end_time'] = datetime.fromtimestamp(saved['end_ts'])
+        task_data['step_message'] = (saved['chat_id'], saved['message_id'])
+        start_step_timer(app.bot, saved['chat_id'], saved['message_id'], user_id, saved['step'])
+        resumed += 1
+    return resumed
+
+async def save_state(app=None):
+    """Сохраняет таймеры, сессии, журнал шагов и калибровку таймеров на диск (при остановке)"""
+    timers = checkpoint_timers()
+    sessions = await session_manager.checkpoint()
+    await asyncio.to_thread(step_events.dump, STEP_EVENTS_PATH)
+    await asyncio.to_thread(duration_calibrator.dump, CALIBRATION_PATH, duration_calibrator.snapshot())
+    log.info("State saved: %d sessions, %d timers, %d step events", sessions, timers, len(step_events))
+
+async def restore_state(app):
+    """Загружает журнал шагов и калибровку, возобновляет таймеры после перезапуска"""
+    global step_events, duration_calibrator
+    if os.path.exists(STEP_EVENTS_PATH):
+        try:
+            step_events = await asyncio.to_thread(StepEventLog.load, STEP_EVENTS_PATH)
+        except (OSError, ValueError) as e:
+            log.warning("Could not load step events: %s", e)
+    if os.path.exists(CALIBRATION_PATH):
+        try:
+            duration_calibrator = await asyncio.to_thread(DurationCalibrator.load, CALIBRATION_PATH)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Could not load duration calibration: %s", e)
+    timers = resume_timers(app)
+    if timers or len(step_events):
+        log.info("State restored: %d timers, %d step events", timers, len(step_events))
+
+def requeue_journal():
+    """Ставит в очередь апдейты из журнала, не обработанные до остановки или падения, - раньше новых"""
+    if journal is None or not journal.recovered:
+        return 0
+
+    newer = []
+    while True:
+        try:
+            newer.append(update_queue.get_nowait())
+        except queue.Empty:
+            break
+    now = time.monotonic()
+    for seq, payload in journal.recovered:
+        update_queue.put((now, json.loads(payload), None, seq))
+    for item in newer:
+        update_queue.put(item)
+
+    count = len(journal.recovered)
+    journal.recovered = []
+    return count
+
+def request_shutdown(drain_seconds=SHUTDOWN_DRAIN_SECONDS):
+    """Начинает остановку: /webhook больше не принимает апдейты, очередь дообрабатывается до дедлайна"""
+    global drain_deadline
+    with ingest_lock:
+        if shutdown_event.is_set():
+            return
+        drain_deadline = time.monotonic() + drain_seconds
+        shutdown_event.set()
+    health_state.mark_not_ready('shutting down')
+    update_queue.put(None)
+
+async def shutdown_bot():
+    """Сохраняет состояние и останавливает приложение; необработанные апдейты остаются в журнале"""
+    pending = update_queue.qsize()
+    if sweeper_task:
+        sweeper_task.cancel()
+    loop_monitor.stop()
+    await save_state(application)
+    if application is not None:
+        await application.stop()
+        await application.shutdown()
+    if traffic_recorder:
+        traffic_recorder.close()
+    tracing.exporter.close()
+    if journal is not None:
+        journal.close()
+
+    # Дожидаемся отменённых задач, чтобы loop закрылся без незавершённых задач
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    log.info("Bot stopped, %d queued updates left in journal for the next start", pending)
 
 # Настройка приложения Telegram
 async def setup_application():
     global application
-    print("🔧 Setting up Telegram application...")
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-
-    # DEBUG: универсальный handler для логирования всех сообщений (группа -1 = выполняется первым)
-    application.add_handler(MessageHandler(filters.ALL, debug_handler), group=-1)
-
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("history", history_command))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_task))
-    application.add_handler(CallbackQueryHandler(skip_context, pattern="^skip_context$"))
-    application.add_handler(CallbackQueryHandler(start_steps, pattern="^start_steps$"))
-    application.add_handler(CallbackQueryHandler(edit_steps, pattern="^edit_steps$"))
-    application.add_handler(CallbackQueryHandler(next_step, pattern="^next_step$"))
-    application.add_handler(CallbackQueryHandler(skip_step, pattern="^skip_step$"))
-    application.add_handler(CallbackQueryHandler(prev_step, pattern="^prev_step$"))
-    application.add_handler(CallbackQueryHandler(cancel_task, pattern="^cancel_task$"))
-    application.add_handler(CallbackQueryHandler(rewrite_all, pattern="^rewrite_all$"))
-    application.add_handler(CallbackQueryHandler(rewrite_step, pattern="^rewrite_step_"))
-    application.add_handler(CallbackQueryHandler(edit_single_step, pattern="^edit_single_step_"))
-    application.add_handler(CallbackQueryHandler(cancel_edit_step, pattern="^cancel_edit_step$"))
-    application.add_handler(CallbackQueryHandler(show_history, pattern="^show_history$"))
-    application.add_handler(CallbackQueryHandler(new_task, pattern="^new_task$"))
+    log.info("Setting up Telegram application")
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .build()
+    )
+
+    register_handlers(application)
 
     await application.initialize()
     await application.start()
-    print("✅ Telegram application initialized")
+    await start_background_tasks(application)
+    log.info("Telegram application initialized")
 
 async def setup_webhook():
+    """Регистрирует вебхук; возвращает True при успехе"""
     try:
-        print("🔧 Setting up webhook...")
-        bot = Bot(token=TELEGRAM_TOKEN)
+        log.info("Setting up webhook")
+        bot = Bot(token=TELEGRAM_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot", base_file_url=f"{TELEGRAM_API_URL}/file/bot")
         await bot.initialize()
         result = await bot.set_webhook(url=WEBHOOK_URL)
         await bot.shutdown()
-        print(f"✅ Webhook set: {WEBHOOK_URL} -> {result}")
-    except Exception as e:
-        print(f"❌ Error setting webhook: {e}")
-        traceback.print_exc()
+        log.info("Webhook set: %s -> %s", WEBHOOK_URL, result)
+        return bool(result)
+    except Exception:
+        log.exception("Error setting webhook")
+        return False
+
+def update_owner(update_data):
+    """id пользователя (или чата), чьи апдейты должны обрабатываться по порядку"""
+    for value in update_data.values():
+        if isinstance(value, dict):
+            owner = value.get('from') or value.get('user') or value.get('chat')
+            if isinstance(owner, dict) and 'id' in owner:
+                return owner['id']
+    return None
+
+async def process_queued_update(item):
+    """Обрабатывает апдейт из очереди"""
+    enqueued_at, update_data, trace, seq = item
+    # Запросы к LLM из этого апдейта попадают в очередь планировщика этого пользователя
+    llm_user.set(update_owner(update_data))
+    try:
+        queue_wait = time.monotonic() - enqueued_at
+        metrics.QUEUE_WAIT.observe(queue_wait)
+
+        error = None
+        with tracing.activate(trace):
+            if trace:
+                trace.add_span('queue_wait', queue_wait)
+            update = Update.de_json(update_data, application.bot)
+            kind = update_kind(update)
+            started = time.perf_counter()
+            status = 'ok'
+            try:
+                with tracing.span('process_update', kind=kind):
+                    await application.process_update(update)
+            except Exception as e:
+                status = 'error'
+                error = type(e).__name__
+                raise
+            finally:
+                metrics.UPDATE_DURATION.labels(kind).observe(time.perf_counter() - started)
+                metrics.UPDATES_PROCESSED.labels(kind, status).inc()
+                if trace:
+                    trace.finish(error)
+        updates_log.debug("Processed update %s (%s)", update.update_id, kind)
+    except Exception:
+        updates_log.exception("Error processing update", extra={'trace_id': trace.trace_id if trace else None})
+    # Подтверждаем и упавший апдейт: при повторе после перезапуска он упал бы так же.
+    # Прерванный при остановке (CancelledError) не подтверждается и будет обработан после перезапуска
+    if seq is not None:
+        journal.ack(seq)
 
 async def process_updates():
+    """Разбирает очередь: апдейты разных пользователей обрабатываются параллельно
+    (не больше UPDATE_CONCURRENCY), апдейты одного пользователя - строго по порядку"""
     global application, update_queue
-    print("🚀 Starting update processor...")
+    updates_log.info("Starting update processor (concurrency %d)", UPDATE_CONCURRENCY)
+    slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+    # Пользователи с апдейтом в обработке -> их следующие апдейты. Слот занимает только
+    # обрабатываемый апдейт: ждущие своей очереди не отнимают слоты у других пользователей
+    waiting_by_owner = {}
+    interrupted = False
+
+    def start(owner, item):
+        task = asyncio.create_task(process_queued_update(item))
+        in_flight.add(task)
+        task.add_done_callback(functools.partial(on_done, owner))
+
+    def on_done(owner, task):
+        in_flight.discard(task)
+        waiting = waiting_by_owner[owner]
+        if waiting and not interrupted:
+            # Слот переходит следующему апдейту того же пользователя
+            start(owner, waiting.popleft())
+        else:
+            # Прерванные при остановке апдейты пользователя остаются в журнале
+            del waiting_by_owner[owner]
+            slots.release()
+
     while True:
+        health_state.beat('dispatcher')
+        if drain_deadline is not None and time.monotonic() > drain_deadline:
+            updates_log.warning("Drain deadline reached, %d updates left in queue", update_queue.qsize())
+            break
         try:
+            item = update_queue.get_nowait()
+        except queue.Empty:
+            # Ждём апдейт в пуле потоков: блокирующий get() остановил бы таймеры
             try:
-                update_data = update_queue.get(timeout=1)
+                item = await asyncio.to_thread(update_queue.get, timeout=1)
             except queue.Empty:
                 continue
 
-            if update_data is None:
-                break
+        if item is None:
+            break
 
-            update = Update.de_json(update_data, application.bot)
-            await application.process_update(update)
-            print(f"✅ Processed update: {update.update_id}")
-        except Exception as e:
-            print(f"❌ Error processing update: {e}")
-            traceback.print_exc()
-
-        await asyncio.sleep(0.01)
+        owner = update_owner(item[1])
+        if owner in waiting_by_owner:
+            # Апдейт пользователя уже обрабатывается - этот начнётся сразу после него
+            waiting_by_owner[owner].append(item)
+            continue
+        # Все слоты заняты - новые апдейты ждут в очереди. Ожидание слота - нормальная работа
+        # под нагрузкой, а не зависание: heartbeat обновляется и пока слот не освободился
+        while True:
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout=1)
+                break
+            except asyncio.TimeoutError:
+                health_state.beat('dispatcher')
+        waiting_by_owner[owner] = deque()
+        start(owner, item)
+
+    # Дообрабатываем начатое вместе с ждущими апдейтами тех же пользователей;
+    # не успевшее к дедлайну прерываем - оно останется в журнале
+    while in_flight:
+        timeout = None if drain_deadline is None else drain_deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            break
+        await asyncio.wait(set(in_flight), timeout=timeout)
+    interrupted = True
+    unfinished = set(in_flight)
+    for task in unfinished:
+        task.cancel()
+    await asyncio.gather(*unfinished, return_exceptions=True)
+    if unfinished:
+        updates_log.warning("Interrupted %d updates at drain deadline", len(unfinished))
 
 def run_bot_polling():
     """Запуск бота в режиме polling (для локального тестирования)"""
     try:
-        print("🔄 Starting polling mode...")
-        application_builder = Application.builder().token(TELEGRAM_TOKEN)
+        log.info("Starting polling mode")
+        application_builder = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .base_url(f"{TELEGRAM_API_URL}/bot")
+            .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .post_init(start_background_tasks)
+            .post_stop(save_state)
+        )
         application_instance = application_builder.build()
 
-        # DEBUG: универсальный handler для логирования всех сообщений (группа -1 = выполняется первым)
-        application_instance.add_handler(MessageHandler(filters.ALL, debug_handler), group=-1)
-
-        application_instance.add_handler(CommandHandler("start", start))
-        application_instance.add_handler(CommandHandler("history", history_command))
-        application_instance.add_handler(MessageHandler(filters.VOICE, handle_voice))
-        application_instance.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_task))
-        application_instance.add_handler(CallbackQueryHandler(skip_context, pattern="^skip_context$"))
-        application_instance.add_handler(CallbackQueryHandler(start_steps, pattern="^start_steps$"))
-        application_instance.add_handler(CallbackQueryHandler(edit_steps, pattern="^edit_steps$"))
-        application_instance.add_handler(CallbackQueryHandler(next_step, pattern="^next_step$"))
-        application_instance.add_handler(CallbackQueryHandler(skip_step, pattern="^skip_step$"))
-        application_instance.add_handler(CallbackQueryHandler(prev_step, pattern="^prev_step$"))
-        application_instance.add_handler(CallbackQueryHandler(cancel_task, pattern="^cancel_task$"))
-        application_instance.add_handler(CallbackQueryHandler(rewrite_all, pattern="^rewrite_all$"))
-        application_instance.add_handler(CallbackQueryHandler(rewrite_step, pattern="^rewrite_step_"))
-        application_instance.add_handler(CallbackQueryHandler(edit_single_step, pattern="^edit_single_step_"))
-        application_instance.add_handler(CallbackQueryHandler(cancel_edit_step, pattern="^cancel_edit_step$"))
-        application_instance.add_handler(CallbackQueryHandler(show_history, pattern="^show_history$"))
-        application_instance.add_handler(CallbackQueryHandler(new_task, pattern="^new_task$"))
-
-        print("✅ Bot handlers registered")
-        print("🚀 Bot is running in polling mode...")
+        register_handlers(application_instance)
+
+        log.info("Bot handlers registered, running in polling mode")
 
         # Запуск polling
         application_instance.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
-        print(f"❌ Error in bot: {e}")
-        traceback.print_exc()
+        log.exception("Error in bot")
+
+async def startup():
+    """Настраивает приложение и регистрирует вебхук параллельно; True, если вебхук зарегистрирован"""
+    started = time.perf_counter()
+    _, webhook_ok = await asyncio.gather(setup_application(), setup_webhook())
+    log.info("Startup finished in %.0f ms", (time.perf_counter() - started) * 1000)
+    return webhook_ok
+
+# Повторная регистрация вебхука, если при старте она не удалась: пауза растёт до WEBHOOK_RETRY_MAX_DELAY
+WEBHOOK_RETRY_BASE_DELAY = float(os.getenv("WEBHOOK_RETRY_BASE_DELAY", 1))
+WEBHOOK_RETRY_MAX_DELAY = float(os.getenv("WEBHOOK_RETRY_MAX_DELAY", 60))
+
+def on_webhook_ready():
+    health_state.mark_ready()
+    if SDK_WARMUP:
+        threading.Thread(target=warm_up_sdks, name='sdk-warmup', daemon=True).start()
+
+async def retry_setup_webhook():
+    """Повторяет регистрацию вебхука в фоне и открывает инстанс для трафика, когда она удалась"""
+    delay = WEBHOOK_RETRY_BASE_DELAY
+    attempt = 1
+    while not shutdown_event.is_set():
+        # Полный джиттер, чтобы инстансы после общего сбоя не повторяли синхронно
+        await asyncio.sleep(random.uniform(0, delay))
+        attempt += 1
+        if await setup_webhook():
+            log.info("Webhook set on attempt %d", attempt)
+            if not shutdown_event.is_set():
+                on_webhook_ready()
+            return
+        delay = min(delay * 2, WEBHOOK_RETRY_MAX_DELAY)
 
 def run_bot_webhook():
     """Запуск бота в режиме webhook (для продакшена)"""
     global bot_loop
     try:
+        open_journal()
         bot_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(bot_loop)
-        bot_loop.run_until_complete(setup_application())
-        bot_loop.run_until_complete(setup_webhook())
+        # Запросы к Gemini и AssemblyAI блокируют поток пула на всё время ответа: пул по умолчанию
+        # (число CPU + 4) ограничил бы число одновременных запросов сильнее, чем UPDATE_CONCURRENCY
+        bot_loop.set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_CALL_THREADS,
+                                                         thread_name_prefix='blocking'))
+        webhook_retry = None
+        if bot_loop.run_until_complete(startup()):
+            on_webhook_ready()
+        else:
+            # Без вебхука Telegram не пришлёт апдейты - трафик на этот инстанс не направляем, пока не повторим
+            health_state.mark_not_ready('webhook not set')
+            webhook_retry = bot_loop.create_task(retry_setup_webhook())
+        requeued = requeue_journal()
+        if requeued:
+            log.info("Requeued %d unprocessed updates from journal", requeued)
         bot_loop.run_until_complete(process_updates())
-    except Exception as e:
-        print(f"❌ Error in bot thread: {e}")
-        traceback.print_exc()
+        if webhook_retry is not None:
+            webhook_retry.cancel()
+        bot_loop.run_until_complete(shutdown_bot())
+    except Exception:
+        log.exception("Error in bot thread")
     finally:
+        health_state.mark_not_ready('bot thread stopped')
+        health_state.stop_heartbeat('dispatcher')
         if bot_loop:
             bot_loop.close()
 
@@ -1140,40 +1924,131 @@ def index():
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    started = time.perf_counter()
+    status = 'error'
+    error = None
+    # Трасса апдейта начинается здесь и завершается в process_updates
+    trace = tracing.start_trace('update')
     try:
-        json_data = request.get_json()
-        if not json_data:
-            return "No data", 400
-
-        update_queue.put(json_data)
-        print(f"📨 Update queued: {json_data.get('update_id', 'unknown')}")
+        with tracing.activate(trace), tracing.span('webhook'):
+            json_data = request.get_json()
+            if not json_data:
+                status = 'empty'
+                return "No data", 400
+
+            update_id = json_data.get('update_id')
+            if trace:
+                trace.root.attrs['update_id'] = update_id
+            with ingest_lock:
+                if not ingest_ready.is_set():
+                    # Журнал ещё восстанавливается после перезапуска
+                    status = 'starting'
+                    return "Starting", 503
+                if shutdown_event.is_set():
+                    # Telegram повторит доставку, апдейт обработает уже новый инстанс
+                    status = 'shutting_down'
+                    return "Shutting down", 503
+                if update_id is not None and update_id in recent_updates:
+                    # Telegram повторил доставку - отвечаем 200, чтобы он перестал
+                    status = 'duplicate'
+                    metrics.DUPLICATES_DROPPED.labels('update').inc()
+                    webhook_log.info("Dropped duplicate update %s", update_id)
+                    return "OK", 200
+                seq = journal.append(request.get_data()) if journal is not None else None
+                update_queue.put((time.monotonic(), json_data, trace, seq))
+                # Отмечаем только попавший в очередь апдейт: если запись в журнал не удалась, повторная
+                # доставка не должна отсеяться. Проверка и отметка под ingest_lock, повтор между ними не проскочит
+                if update_id is not None:
+                    recent_updates.add(update_id)
+            # Отвечаем 200 только после записи на диск: иначе Telegram не доставит апдейт повторно
+            if seq is not None:
+                journal.commit(seq)
+            status = 'ok'
+
+            if traffic_recorder:
+                traffic_recorder.record(json_data)
+        webhook_log.debug("Update queued: %s", update_id)
         return "OK", 200
     except Exception as e:
-        print(f"❌ Error in webhook: {e}")
-        traceback.print_exc()
+        error = type(e).__name__
+        webhook_log.exception("Error in webhook")
         return "Error", 500
+    finally:
+        metrics.WEBHOOK_REQUESTS.labels(status).inc()
+        metrics.WEBHOOK_DURATION.observe(time.perf_counter() - started)
+        if trace and status != 'ok':
+            # Повтор, пустой запрос и остановка - штатные исходы, ошибкой трасса помечается только при исключении
+            trace.root.attrs['status'] = status
+            trace.finish(error)
 
 @app.route('/health')
 def health():
-    return "OK", 200
+    return jsonify({'status': 'stalled' if loop_monitor.stalled() else 'ok', 'event_loop': loop_monitor.stats()})
+
+@app.route('/ready')
+def ready():
+    is_ready, body = health_state.readiness()
+    return jsonify(body), 200 if is_ready else 503
+
+@app.route('/live')
+def live():
+    is_alive, body = health_state.liveness()
+    return jsonify(body), 200 if is_alive else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.REGISTRY.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/stats')
+def stats():
+    return jsonify({**session_manager.stats(), 'calibration': duration_calibrator.stats(),
+                    'tracing': tracing.exporter.stats(),
+                    'journal': journal.stats() if journal is not None else None,
+                    'dedup': {'recent_updates': len(recent_updates), 'recent_callbacks': len(callback_guard)},
+                    'alternatives': alternatives_pool.stats() if alternatives_pool is not None else None,
+                    'llm_models': llm_router.snapshot(),
+                    'resilience': {'gemini': gemini_breaker.status(), 'assemblyai': stt_breaker.status(),
+                                   'retry_budget': retry_budget.stats(),
+                                   'cached_decompositions': len(decomposition_cache)},
+                    'llm_scheduler': llm_scheduler.stats()})
+
+@app.route('/analytics')
+def analytics_report():
+    # numpy подгружается только при первом запросе отчёта
+    from analytics import summarize
+    return jsonify(summarize(step_events))
 
 if __name__ == '__main__':
     # Определяем режим работы: если RENDER_EXTERNAL_URL пустой - локальный режим (polling)
     is_local = not WEBHOOK_URL or WEBHOOK_URL == "/webhook"
+    log_config()
 
     if is_local:
-        print("🚀 Starting bot in LOCAL mode (polling)...")
+        log.info("Starting bot in LOCAL mode (polling)")
         run_bot_polling()
     else:
-        print("🚀 Starting bot in PRODUCTION mode (webhook)...")
+        log.info("Starting bot in PRODUCTION mode (webhook)")
         # Запускаем бота в отдельном потоке
         bot_thread = threading.Thread(target=run_bot_webhook, daemon=True)
         bot_thread.start()
 
-        import time
-        time.sleep(3)
-
-        # Запуск Flask
+        # Flask стартует сразу: /live отвечает во время запуска, а /ready - только после настройки
+        # приложения и вебхука. Пришедшие раньше апдейты ждут в update_queue
         port = int(os.environ.get('PORT', 10000))
-        print(f"🌐 Starting Flask server on port {port}")
-        app.run(host='0.0.0.0', port=port, debug=False, threaded=True, use_reloader=False)
+        server = make_server('0.0.0.0', port, app, threaded=True)
+
+        def graceful_shutdown():
+            request_shutdown()
+            bot_thread.join(SHUTDOWN_DRAIN_SECONDS + SHUTDOWN_SAVE_SECONDS)
+            server.shutdown()
+
+        def on_signal(signum, frame):
+            log.info("Received signal %d, shutting down", signum)
+            threading.Thread(target=graceful_shutdown, name='shutdown', daemon=True).start()
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        log.info("Starting Flask server on port %d", port)
+        server.serve_forever()
+        flush_logging()
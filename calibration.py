@@ -0,0 +1,114 @@
+import os
+import json
+import math
+from collections import OrderedDict
+
+# Скорость онлайн-обучения (EWMA по логарифму отношения факт/оценка)
+CALIBRATION_GLOBAL_ALPHA = float(os.getenv("CALIBRATION_GLOBAL_ALPHA", 0.02))
+CALIBRATION_USER_ALPHA = float(os.getenv("CALIBRATION_USER_ALPHA", 0.2))
+# Сколько наблюдений нужно, чтобы поправке пользователя доверяли наравне с глобальной
+CALIBRATION_PRIOR = float(os.getenv("CALIBRATION_PRIOR", 5))
+CALIBRATION_MAX_USERS = int(os.getenv("CALIBRATION_MAX_USERS", 100000))
+
+# Границы поправочного коэффициента таймера
+MIN_FACTOR = 0.5
+MAX_FACTOR = 2.0
+# Отношения факт/оценка за этими пределами - выбросы (пользователь отошёл или нажал сразу)
+MIN_RATIO = 0.1
+MAX_RATIO = 5.0
+# Таймер округляется до этого шага в секундах
+ROUND_TO_SECONDS = 30
+
+
+class DurationCalibrator:
+    """Учится поправлять оценки длительности шагов по реальным длительностям.
+
+    Поправка хранится как экспоненциальное скользящее среднее log(факт / оценка):
+    одно глобальное и по одному на пользователя. Поправка пользователя смешивается
+    с глобальной пропорционально числу его наблюдений, поэтому у новых пользователей
+    таймер опирается на общую статистику.
+    """
+
+    def __init__(self, max_users=CALIBRATION_MAX_USERS):
+        self.max_users = max_users
+        self.global_log = 0.0
+        self.global_count = 0
+        # user_id -> [ewma log-отношения, число наблюдений], в порядке LRU
+        self.users = OrderedDict()
+
+    def observe(self, user_id, estimate_s, actual_s):
+        """Учитывает реальную длительность выполненного шага"""
+        if not estimate_s or estimate_s <= 0 or not actual_s or not actual_s > 0:
+            return
+
+        ratio = min(max(actual_s / estimate_s, MIN_RATIO), MAX_RATIO)
+        log_ratio = math.log(ratio)
+
+        self.global_count += 1
+        alpha = max(CALIBRATION_GLOBAL_ALPHA, 1.0 / self.global_count)
+        self.global_log += alpha * (log_ratio - self.global_log)
+
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = [log_ratio, 1]
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            state[1] += 1
+            alpha = max(CALIBRATION_USER_ALPHA, 1.0 / state[1])
+            state[0] += alpha * (log_ratio - state[0])
+            self.users.move_to_end(user_id)
+
+    def factor(self, user_id):
+        """Поправочный коэффициент для пользователя"""
+        global_weight = self.global_count / (self.global_count + CALIBRATION_PRIOR)
+        log_factor = self.global_log * global_weight
+
+        state = self.users.get(user_id)
+        if state is not None:
+            user_weight = state[1] / (state[1] + CALIBRATION_PRIOR)
+            log_factor = user_weight * state[0] + (1 - user_weight) * log_factor
+
+        return min(max(math.exp(log_factor), MIN_FACTOR), MAX_FACTOR)
+
+    def calibrate(self, user_id, estimate_s):
+        """Возвращает длительность таймера в секундах с учётом поправки"""
+        seconds = estimate_s * self.factor(user_id)
+        return max(ROUND_TO_SECONDS, int(round(seconds / ROUND_TO_SECONDS)) * ROUND_TO_SECONDS)
+
+    def estimate_minutes(self, user_id, minutes):
+        """Оценка в минутах с поправкой пользователя - для шагов, где модель не указала время"""
+        return max(1, round(self.calibrate(user_id, minutes * 60) / 60))
+
+    def snapshot(self):
+        """Копия состояния для dump (снимается в потоке event loop)"""
+        return {'global_log': self.global_log, 'global_count': self.global_count,
+                'users': [[user_id, log_ratio, count] for user_id, (log_ratio, count) in self.users.items()]}
+
+    def dump(self, path, state=None):
+        """Сохраняет состояние в JSON, чтобы калибровка переживала перезапуск"""
+        state = state or self.snapshot()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_users=CALIBRATION_MAX_USERS):
+        """Загружает состояние, сохранённое методом dump"""
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        calibrator = cls(max_users)
+        calibrator.global_log = float(state['global_log'])
+        calibrator.global_count = int(state['global_count'])
+        # Порядок LRU сохранён: последние - самые недавние
+        for user_id, log_ratio, count in state['users'][-max_users:]:
+            calibrator.users[user_id] = [float(log_ratio), int(count)]
+        return calibrator
+
+    def stats(self):
+        return {
+            'global_factor': round(math.exp(self.global_log), 3),
+            'observations': self.global_count,
+            'users': len(self.users),
+        }
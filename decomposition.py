@@ -0,0 +1,203 @@
+"""Разбор ответа модели на запрос декомпозиции.
+
+Модель просят вернуть JSON по схеме DECOMPOSITION_SCHEMA: {"steps": [{"minutes",
+"text"}]}. Строгий путь - json.loads и проверка схемы одним проходом. Если
+ответ почти правильный (markdown-ограда вокруг JSON, висячие запятые, список
+шагов без обёртки, другие названия полей, минуты строкой), его чинит
+восстанавливающий парсер; если JSON нет вовсе - шаги ищутся в тексте в прежнем
+формате "Шаг N (M мин): действие". Результат всегда - строки этого формата,
+которые используют остальные части бота.
+"""
+import os
+import re
+import json
+
+# Просить у модели JSON (1) или шаги текстом, как раньше (0)
+DECOMPOSE_JSON = os.getenv("DECOMPOSE_JSON", "1") == "1"
+# Вопросы по задаче и черновик декомпозиции одним запросом (prompts/task_overview.txt)
+COMBINED_OVERVIEW = os.getenv("COMBINED_OVERVIEW", "0") == "1"
+
+MAX_STEPS = 10
+DEFAULT_MINUTES = 5
+MAX_MINUTES = 120
+
+# Схема для structured output Gemini (response_schema)
+DECOMPOSITION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'steps': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'minutes': {'type': 'integer'},
+                    'text': {'type': 'string'},
+                },
+                'required': ['minutes', 'text'],
+            },
+        },
+    },
+    'required': ['steps'],
+}
+
+# Вопросы и черновик декомпозиции одним ответом
+OVERVIEW_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'questions': {'type': 'array', 'items': {'type': 'string'}},
+        'steps': DECOMPOSITION_SCHEMA['properties']['steps'],
+    },
+    'required': ['questions', 'steps'],
+}
+MAX_QUESTIONS = 5
+QUESTION_MARKER_RE = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s*')
+
+# Как модель называет поля, когда отступает от схемы
+TEXT_KEYS = ('text', 'action', 'step', 'description', 'title', 'действие', 'шаг')
+MINUTES_KEYS = ('minutes', 'min', 'mins', 'time', 'duration', 'минуты', 'мин', 'время')
+
+FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+TRAILING_COMMA_RE = re.compile(r',\s*([\]}])')
+NUMBER_RE = re.compile(r'\d+')
+STEP_PREFIX_RE = re.compile(r'^\s*(?:Шаг\s*\d+\s*(?:\(\s*\d+\s*мин\.?\s*\))?\s*[:.)-]?|\d+\s*[.)])\s*', re.IGNORECASE)
+TEXT_STEP_RE = re.compile(r'^\s*(?:[-*•]\s*)?\**Шаг\s*(\d+)\**\s*\((\d+)\s*мин\.?\)\s*\**\s*[:.-]\s*(.+)$',
+                          re.IGNORECASE)
+
+
+class DecompositionParseError(ValueError):
+    """В ответе модели не нашлось ни одного шага"""
+
+
+def format_step(number, minutes, text):
+    return f"Шаг {number} ({minutes} мин): {text}"
+
+
+def validate(data):
+    """Строгая проверка схемы; возвращает [(минуты, текст)] или None"""
+    if not isinstance(data, dict):
+        return None
+    steps = data.get('steps')
+    if not isinstance(steps, list) or not 0 < len(steps) <= MAX_STEPS:
+        return None
+    result = []
+    for step in steps:
+        if not isinstance(step, dict):
+            return None
+        minutes, text = step.get('minutes'), step.get('text')
+        if type(minutes) is not int or not 0 < minutes <= MAX_MINUTES:
+            return None
+        if not isinstance(text, str) or not text.strip():
+            return None
+        result.append((minutes, text.strip()))
+    return result
+
+
+def _loads_lenient(text):
+    """json.loads для почти-JSON: markdown-ограда, текст вокруг, висячие запятые"""
+    fenced = FENCE_RE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        return None
+    start = min(starts)
+    end = max(text.rfind('}'), text.rfind(']'))
+    if end <= start:
+        return None
+    candidate = TRAILING_COMMA_RE.sub(r'\1', text[start:end + 1])
+    try:
+        return json.loads(candidate)
+    except ValueError:
+        return None
+
+
+def _repair_step(step):
+    if isinstance(step, str):
+        text, minutes = step, None
+    elif isinstance(step, dict):
+        lowered = {str(key).lower(): value for key, value in step.items()}
+        text = next((lowered[key] for key in TEXT_KEYS if isinstance(lowered.get(key), str)), None)
+        minutes = next((lowered[key] for key in MINUTES_KEYS if key in lowered), None)
+    else:
+        return None
+    if not text or not text.strip():
+        return None
+
+    if isinstance(minutes, str):
+        match = NUMBER_RE.search(minutes)
+        minutes = int(match.group(0)) if match else None
+    elif isinstance(minutes, float):
+        minutes = round(minutes)
+    if isinstance(step, str) or minutes is None:
+        # "Шаг 2 (7 мин): действие" внутри строки - минуты берём оттуда
+        match = TEXT_STEP_RE.match(text)
+        if match:
+            minutes, text = minutes or int(match.group(2)), match.group(3)
+    if type(minutes) is not int or not 0 < minutes <= MAX_MINUTES:
+        minutes = DEFAULT_MINUTES
+    text = STEP_PREFIX_RE.sub('', text.strip()).strip()
+    return (minutes, text) if text else None
+
+
+def repair(data):
+    """Шаги из JSON, отступающего от схемы; возвращает [(минуты, текст)] или None"""
+    if isinstance(data, dict):
+        data = next((value for key, value in data.items()
+                     if str(key).lower() in ('steps', 'шаги', 'plan') and isinstance(value, list)), None)
+    if not isinstance(data, list):
+        return None
+    steps = [step for step in (_repair_step(item) for item in data) if step]
+    return steps[:MAX_STEPS] or None
+
+
+def parse_text_steps(text):
+    """Строки шагов из текста в формате «Шаг N (M мин): действие»"""
+    steps = []
+    for line in text.split('\n'):
+        match = TEXT_STEP_RE.match(line)
+        if match:
+            # Снимаем markdown-разметку и маркеры списка
+            steps.append(format_step(int(match.group(1)), int(match.group(2)), match.group(3).strip().strip('*').strip()))
+        elif line.strip().startswith('Шаг'):
+            steps.append(line.strip())
+    return steps[:MAX_STEPS]
+
+
+def parse_decomposition(text):
+    """(строки шагов, способ разбора: json, repaired или text); DecompositionParseError, если шагов нет"""
+    try:
+        steps, how = validate(json.loads(text)), 'json'
+    except ValueError:
+        steps = None
+    if steps is None:
+        steps, how = repair(_loads_lenient(text)), 'repaired'
+    if steps is None:
+        lines = parse_text_steps(text)
+        if not lines:
+            raise DecompositionParseError("no steps in decomposition response")
+        return lines, 'text'
+    return [format_step(number, minutes, line) for number, (minutes, line) in enumerate(steps, 1)], how
+
+
+def parse_overview(text):
+    """(вопросы списком строк, строки шагов черновика) из ответа на prompts/task_overview.txt.
+
+    Шагов может не оказаться - тогда черновик None; DecompositionParseError, если нет и вопросов.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = _loads_lenient(text)
+    if not isinstance(data, dict):
+        raise DecompositionParseError("no JSON object in overview response")
+
+    questions = data.get('questions')
+    questions = [QUESTION_MARKER_RE.sub('', q).strip() for q in questions if isinstance(q, str)] \
+        if isinstance(questions, list) else []
+    questions = [q for q in questions if q][:MAX_QUESTIONS]
+    if not questions:
+        raise DecompositionParseError("no questions in overview response")
+
+    steps = validate(data) or repair(data)
+    draft = [format_step(number, minutes, line) for number, (minutes, line) in enumerate(steps, 1)] if steps else None
+    return questions, draft
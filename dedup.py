@@ -0,0 +1,104 @@
+"""Отсев повторных апдейтов и повторных нажатий кнопок.
+
+Telegram повторяет доставку вебхука, если ответ задержался, - такой апдейт
+приходит с тем же update_id и отбрасывается ещё в /webhook. Двойное нажатие
+кнопки - это два разных апдейта, но с одной и той же кнопкой одного и того же
+сообщения в одном и том же виде, и между ними пользователь больше ничего не
+нажимал: первое нажатие меняет сообщение, поэтому второе, пришедшее со старым
+текстом, повторяет уже выполненное действие. Обратный отсчёт таймера, который
+бот обновляет каждую секунду, видом сообщения не считается - иначе двойное
+нажатие "Готово", пришедшееся на смену секунды, выполнялось бы дважды.
+"""
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Сколько последних update_id помнить
+DEDUP_UPDATE_IDS = int(os.getenv("DEDUP_UPDATE_IDS", 10000))
+# Сколько секунд повторное нажатие той же кнопки на неизменившемся сообщении считается дублем
+CALLBACK_DEDUP_WINDOW = float(os.getenv("CALLBACK_DEDUP_WINDOW", 30))
+
+# Строка обратного отсчёта в сообщении шага
+TIMER_LINE_RE = re.compile(r'\s*⏱ Осталось: \d+:\d+\s*$')
+
+
+class RecentIds:
+    """Ограниченное множество недавно виденных идентификаторов (старые вытесняются)"""
+
+    def __init__(self, capacity=DEDUP_UPDATE_IDS):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """Отмечает key и возвращает True, если он уже встречался"""
+        with self._lock:
+            if key in self._ids:
+                return True
+            self._add(key)
+            return False
+
+    def add(self, key):
+        """Отмечает key, не проверяя - например, когда проверка и отметка разнесены"""
+        with self._lock:
+            self._add(key)
+
+    def _add(self, key):
+        self._ids[key] = None
+        if len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def callback_key(query):
+    """Ключ нажатия: сообщение, кнопка и вид сообщения на момент нажатия (без обратного отсчёта)"""
+    message = query.message
+    if message is None:
+        return (None, query.data, None)
+    # edit_date не берём: таймер меняет его каждую секунду
+    content = TIMER_LINE_RE.sub('', message.text or message.caption or '')
+    digest = hashlib.blake2b(content.encode('utf-8'), digest_size=8).digest()
+    return (message.message_id, query.data, digest)
+
+
+class CallbackGuard:
+    """Отсев повторных нажатий одной кнопки на одном виде сообщения.
+
+    Помнится только последнее нажатие пользователя: если между двумя одинаковыми
+    нажатиями было другое ("Назад", затем снова "Готово" на том же шаге), второе -
+    осознанное действие, а не дубль.
+    """
+
+    def __init__(self, window=CALLBACK_DEDUP_WINDOW):
+        self.window = window
+        # Пользователь -> (ключ последнего нажатия, время); упорядочено по времени
+        self._pressed = OrderedDict()
+
+    def is_duplicate(self, query, now=None):
+        now = time.monotonic() if now is None else now
+        # Забываем нажатия старше окна
+        while self._pressed:
+            user, (_, pressed_at) = next(iter(self._pressed.items()))
+            if now - pressed_at <= self.window:
+                break
+            del self._pressed[user]
+
+        user = query.from_user.id
+        key = callback_key(query)
+        last = self._pressed.get(user)
+        if last is not None and last[0] == key:
+            return True
+        self._pressed.pop(user, None)
+        self._pressed[user] = (key, now)
+        return False
+
+    def __len__(self):
+        return len(self._pressed)
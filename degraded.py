@@ -0,0 +1,78 @@
+"""Упрощённый режим, когда Gemini недоступен.
+
+Вопросы по задаче заменяются стандартными, декомпозиция - последней удачной
+декомпозицией той же задачи из кэша, а если её нет - универсальным шаблоном
+шагов. Ответ приходит сразу, без ожидания таймаута.
+
+Декомпозиция с ответами пользователя на уточняющие вопросы может содержать
+подробности его жизни, поэтому достаётся только ему самому; другим
+пользователям с той же задачей - только декомпозиции без контекста.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# Сколько удачных декомпозиций помнить для упрощённого режима
+DEGRADED_CACHE_SIZE = int(os.getenv("DEGRADED_CACHE_SIZE", 1000))
+
+FALLBACK_QUESTIONS = (
+    "• Где ты сейчас находишься?\n"
+    "• Сколько у тебя времени?\n"
+    "• Какие ресурсы доступны?\n"
+    "• Твоё текущее состояние?"
+)
+
+TEMPLATE_STEPS = (
+    "Шаг 1 (2 мин): Сядь поудобнее и убери с глаз всё, что отвлекает",
+    "Шаг 2 (3 мин): Запиши одной фразой, каким будет результат: «{task}»",
+    "Шаг 3 (5 мин): Выпиши всё, что нужно для задачи: вещи, файлы, люди",
+    "Шаг 4 (5 мин): Выбери самое маленькое действие, с которого можно начать, и сделай его",
+    "Шаг 5 (10 мин): Продолжай работать над задачей, не переключаясь",
+    "Шаг 6 (3 мин): Отметь, что уже сделано, и запиши следующее действие",
+)
+
+DEGRADED_NOTICE = "⚠️ AI сейчас недоступен, поэтому план упрощённый. Позже можно нажать «🔄 Переписать всё»."
+
+
+def _key(task):
+    return ' '.join(task.lower().split())
+
+
+class DecompositionCache:
+    """Последние удачные декомпозиции по тексту задачи (LRU).
+
+    user_id=None - общая декомпозиция, без личного контекста: её получают все.
+    """
+
+    def __init__(self, max_size=DEGRADED_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, task, steps, user_id=None):
+        key = (user_id, _key(task))
+        with self._lock:
+            self._items[key] = list(steps)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def get(self, task, user_id=None):
+        """Своя декомпозиция пользователя, а если её нет - общая"""
+        task = _key(task)
+        with self._lock:
+            steps = self._items.get((user_id, task))
+            if steps is None:
+                steps = self._items.get((None, task))
+        return list(steps) if steps is not None else None
+
+    def __len__(self):
+        return len(self._items)
+
+
+def template_steps(task):
+    """Универсальные шаги, подходящие для любой задачи"""
+    short = task.strip().replace('\n', ' ')
+    if len(short) > 80:
+        short = short[:77] + '...'
+    return [step.replace('{task}', short) for step in TEMPLATE_STEPS]
@@ -0,0 +1,58 @@
+"""Подбор примеров для промпта уточняющих вопросов (prompts/context_questions.txt).
+
+Раньше в промпт всегда попадали одни и те же три примера (статья, презентация,
+почта). Теперь примеры лежат в prompts/question_examples.json, и в промпт
+вставляются один-два самых похожих на задачу пользователя: сходство - косинус
+по множествам символьных триграмм, выбор из десятков примеров занимает
+микросекунды. Промпт короче, а примеры ближе к задаче. С FEW_SHOT_DYNAMIC=0
+вставляются прежние три примера (помечены "default").
+"""
+import os
+import json
+import math
+
+FEW_SHOT_EXAMPLES_PATH = os.getenv("FEW_SHOT_EXAMPLES_PATH",
+                                   os.path.join(os.path.dirname(__file__), 'prompts', 'question_examples.json'))
+# Подбирать примеры под задачу (1) или вставлять прежние фиксированные (0)
+FEW_SHOT_DYNAMIC = os.getenv("FEW_SHOT_DYNAMIC", "1") == "1"
+# Сколько примеров вставлять в промпт
+FEW_SHOT_COUNT = int(os.getenv("FEW_SHOT_COUNT", 2))
+# Менее похожие примеры не вставляются; если похожих нет - один самый близкий, чтобы модель видела формат
+FEW_SHOT_MIN_SIMILARITY = float(os.getenv("FEW_SHOT_MIN_SIMILARITY", 0.25))
+
+
+def trigrams(text):
+    text = ' ' + ' '.join(text.lower().split()) + ' '
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ExampleIndex:
+    def __init__(self, examples):
+        self.examples = examples
+        self._trigrams = [trigrams(example['task']) for example in examples]
+        self._defaults = [example for example in examples if example.get('default')]
+
+    @classmethod
+    def load(cls, path=FEW_SHOT_EXAMPLES_PATH):
+        """Индекс примеров из JSON; нет файла - пустой индекс, промпт без примеров"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            return cls([])
+
+    def select(self, task, count=FEW_SHOT_COUNT):
+        """До count примеров, самых похожих на задачу"""
+        query = trigrams(task)
+        if not self.examples or not query:
+            return self._defaults[:count]
+        scored = sorted(((len(query & grams) / math.sqrt(len(query) * len(grams)), index)
+                         for index, grams in enumerate(self._trigrams) if grams), reverse=True)
+        chosen = [self.examples[index] for score, index in scored[:count] if score >= FEW_SHOT_MIN_SIMILARITY]
+        return chosen or [self.examples[scored[0][1]]]
+
+    def render(self, task, dynamic=FEW_SHOT_DYNAMIC):
+        """Блок примеров для подстановки вместо {examples}"""
+        examples = self.select(task) if dynamic else self._defaults
+        return '\n\n'.join(f'Для задачи "{example["task"]}":\n' + '\n'.join(f"• {q}" for q in example['questions'])
+                           for example in examples)
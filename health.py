@@ -0,0 +1,129 @@
+"""Состояние готовности и живости бота для /ready и /live.
+
+Готовность (readiness) - приложение Telegram и вебхук настроены, бот жив и
+очередь апдейтов не переполнена: инстансу можно отдавать трафик.
+Живость (liveness) - обработчик очереди и планировщик таймеров (event loop)
+регулярно отмечаются; если отметки нет дольше допустимого, инстанс пора
+перезапустить.
+"""
+import os
+import time
+import threading
+
+# Сколько апдейтов в очереди допустимо, чтобы инстанс считался готовым
+READY_MAX_QUEUE_DEPTH = int(os.getenv("READY_MAX_QUEUE_DEPTH", 1000))
+# После скольких ошибок подряд внешний сервис помечается как failing
+BACKEND_FAILING_AFTER = 5
+
+
+class BackendStatus:
+    """Результаты последних обращений к внешнему сервису"""
+
+    def __init__(self, name):
+        self.name = name
+        self.consecutive_errors = 0
+        self.last_ok_at = None
+        self.last_error_at = None
+        self.last_error = None
+
+    def record(self, ok, error=None):
+        if ok:
+            self.consecutive_errors = 0
+            self.last_ok_at = time.time()
+        else:
+            self.consecutive_errors += 1
+            self.last_error_at = time.time()
+            self.last_error = error
+
+    def status(self):
+        return {
+            'state': 'failing' if self.consecutive_errors >= BACKEND_FAILING_AFTER else 'ok',
+            'consecutive_errors': self.consecutive_errors,
+            'last_ok_at': self.last_ok_at,
+            'last_error_at': self.last_error_at,
+            'last_error': self.last_error,
+        }
+
+
+class HealthState:
+    def __init__(self, queue_depth=lambda: 0, max_queue_depth=READY_MAX_QUEUE_DEPTH):
+        self.ready = threading.Event()
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max_queue_depth
+        self._heartbeats = {}
+        self._providers = {}
+        self.not_ready_reason = 'starting'
+
+    def register_heartbeat(self, name, max_age, source=None):
+        """Регистрирует отметку живости; source - функция, возвращающая время последней отметки (monotonic)"""
+        self._heartbeats[name] = {'max_age': max_age, 'last': None, 'source': source, 'stopped': False}
+
+    def beat(self, name):
+        self._heartbeats[name]['last'] = time.monotonic()
+
+    def stop_heartbeat(self, name):
+        """Компонент завершился - инстанс сразу считается неживым"""
+        self._heartbeats[name]['stopped'] = True
+
+    def register_provider(self, name, provider):
+        """provider() возвращает словарь со статусом внешнего сервиса"""
+        self._providers[name] = provider
+
+    def mark_ready(self):
+        self.not_ready_reason = None
+        self.ready.set()
+
+    def mark_not_ready(self, reason):
+        self.not_ready_reason = reason
+        self.ready.clear()
+
+    def _heartbeat_status(self):
+        now = time.monotonic()
+        result = {}
+        for name, heartbeat in self._heartbeats.items():
+            last = heartbeat['source']() if heartbeat['source'] else heartbeat['last']
+            age = None if last is None else now - last
+            alive = not heartbeat['stopped'] and age is not None and age <= heartbeat['max_age']
+            result[name] = {'alive': alive, 'age_s': None if age is None else round(age, 3)}
+        return result
+
+    def _providers_status(self):
+        result = {}
+        for name, provider in self._providers.items():
+            try:
+                result[name] = provider()
+            except Exception as e:
+                result[name] = {'state': 'unknown', 'error': str(e)}
+        return result
+
+    def liveness(self):
+        """(живой ли, тело ответа)"""
+        heartbeats = self._heartbeat_status()
+        # До первой отметки компонент ещё запускается - это не повод для перезапуска
+        alive = all(h['alive'] or (h['age_s'] is None and not self._heartbeats[name]['stopped'])
+                    for name, h in heartbeats.items())
+        return alive, {
+            'status': 'alive' if alive else 'dead',
+            'heartbeats': heartbeats,
+            'queue_depth': self.queue_depth(),
+            'backends': self._providers_status(),
+        }
+
+    def readiness(self):
+        """(готов ли, тело ответа)"""
+        heartbeats = self._heartbeat_status()
+        depth = self.queue_depth()
+        reason = self.not_ready_reason
+        if reason is None:
+            dead = [name for name, h in heartbeats.items() if not h['alive']]
+            if dead:
+                reason = 'not alive: ' + ', '.join(dead)
+            elif depth > self.max_queue_depth:
+                reason = f'queue depth {depth} > {self.max_queue_depth}'
+        return reason is None, {
+            'status': 'ready' if reason is None else 'not_ready',
+            'reason': reason,
+            'heartbeats': heartbeats,
+            'queue_depth': depth,
+            'backends': self._providers_status(),
+        }
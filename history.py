@@ -0,0 +1,81 @@
+import os
+from collections import deque
+from datetime import date
+
+# Сколько последних выполненных задач хранить на пользователя
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", 50))
+
+
+class CompletionRecord:
+    """Компактная запись о выполненной задаче"""
+    __slots__ = ('task_name', 'steps_count', 'completed_label')
+
+    def __init__(self, task_name, steps_count, completed_label):
+        self.task_name = task_name
+        self.steps_count = steps_count
+        # Дата форматируется один раз при записи, а не при каждом показе истории
+        self.completed_label = completed_label
+
+
+class UserHistory:
+    """Кольцевой буфер выполненных задач пользователя с агрегатами и кэшем отрисовки"""
+    __slots__ = ('records', 'total_tasks', 'total_steps', 'streak', 'best_streak',
+                 'last_day', '_pages')
+
+    def __init__(self, capacity=HISTORY_LIMIT):
+        self.records = deque(maxlen=capacity)
+        self.total_tasks = 0
+        self.total_steps = 0
+        self.streak = 0
+        self.best_streak = 0
+        self.last_day = None
+        self._pages = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, task_name, steps_count, completed_at):
+        """Добавляет выполненную задачу и обновляет агрегаты"""
+        self.records.append(CompletionRecord(task_name, steps_count, completed_at.strftime('%d.%m.%Y %H:%M')))
+        self.total_tasks += 1
+        self.total_steps += steps_count
+
+        # Серия - число дней подряд, в которые была выполнена хотя бы одна задача
+        day = completed_at.date().toordinal()
+        if self.last_day is None or day - self.last_day > 1:
+            self.streak = 1
+        elif day - self.last_day == 1:
+            self.streak += 1
+        self.last_day = max(day, self.last_day or day)
+        self.best_streak = max(self.best_streak, self.streak)
+
+        self._pages.clear()
+
+    def current_streak(self, today=None):
+        """Текущая серия: обнуляется, если вчера и сегодня задач не было"""
+        today = (today or date.today()).toordinal()
+        if self.last_day is None or today - self.last_day > 1:
+            return 0
+        return self.streak
+
+    def render(self, limit):
+        """Возвращает текст последних limit задач, кэшированный до следующего завершения задачи"""
+        today = date.today().toordinal()
+        cached = self._pages.get(limit)
+        # Серия зависит от текущей даты, поэтому кэш также сбрасывается со сменой дня
+        if cached is not None and cached[0] == today:
+            return cached[1]
+
+        lines = ["📊 История выполненных задач:\n"]
+        for i, record in enumerate(list(self.records)[-limit:], 1):
+            lines.append(f"{i}. {record.task_name}\n   Шагов: {record.steps_count} | {record.completed_label}\n")
+
+        streak = self.current_streak()
+        lines.append(
+            f"Всего задач: {self.total_tasks} | Шагов: {self.total_steps}\n"
+            f"🔥 Серия: {streak} дн. (лучшая: {self.best_streak})"
+        )
+
+        text = '\n'.join(lines)
+        self._pages[limit] = (today, text)
+        return text
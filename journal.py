@@ -0,0 +1,335 @@
+"""Журнал входящих апдейтов на диске: /webhook отвечает 200 только после записи.
+
+Записи дописываются в сегменты фиксированного размера, отображённые в память
+(mmap). Формат записи: заголовок <длина, crc32, номер> и тело апдейта как пришло
+в /webhook. Сброс на диск (msync) выполняется сразу для всех накопившихся
+записей (group commit) в отдельном потоке: запросы, пришедшие во время
+сброса, попадают в следующий.
+
+Обработанные апдейты подтверждаются через ack(). Они могут завершаться не по
+порядку, поэтому в контрольную точку пишется нижняя граница - номер, до которого
+подтверждены все записи, - и подтверждённые номера выше неё. При запуске всё
+неподтверждённое возвращается в очередь. Полностью подтверждённые сегменты удаляются.
+"""
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import threading
+
+import metrics
+from logging_setup import get_logger
+
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "1") == "1"
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", os.path.join(os.path.dirname(__file__), 'journal'))
+JOURNAL_SEGMENT_BYTES = int(os.getenv("JOURNAL_SEGMENT_BYTES", 16 * 1024 * 1024))
+# 0 - /webhook ждёт сброса своей записи на диск (group commit);
+# больше нуля - сброс раз в столько секунд, /webhook не ждёт
+JOURNAL_FSYNC_INTERVAL = float(os.getenv("JOURNAL_FSYNC_INTERVAL", 0))
+# Сколько /webhook ждёт сброса своей записи, прежде чем ответить ошибкой, с
+JOURNAL_COMMIT_TIMEOUT = float(os.getenv("JOURNAL_COMMIT_TIMEOUT", 5))
+
+# Как часто обновлять контрольную точку и удалять обработанные сегменты, с
+CHECKPOINT_INTERVAL = 1.0
+
+# Заголовок записи: длина тела, crc32 тела, номер записи
+HEADER = struct.Struct('<IIQ')
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+log = get_logger('journal')
+
+
+class JournalError(RuntimeError):
+    """Запись не удалось сбросить на диск за JOURNAL_COMMIT_TIMEOUT"""
+
+
+class Segment:
+    """Файл сегмента, отображённый в память; имя - номер первой записи"""
+
+    def __init__(self, path, first_seq, size):
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = first_seq - 1
+        self.size = size
+        self.position = 0
+        self.synced_position = 0
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), size)
+
+    def write(self, seq, payload):
+        end = self.position + HEADER.size + len(payload)
+        self.mm[self.position + HEADER.size:end] = payload
+        HEADER.pack_into(self.mm, self.position, len(payload), zlib.crc32(payload), seq)
+        self.position = end
+        self.last_seq = seq
+
+    def sync(self, end):
+        """Сбрасывает на диск записанное до позиции end"""
+        start = self.synced_position - self.synced_position % mmap.PAGESIZE
+        if end > start:
+            self.mm.flush(start, end - start)
+        self.synced_position = max(self.synced_position, end)
+
+    def close(self):
+        self.mm.close()
+
+
+def read_segment(path):
+    """Читает записи сегмента: [(номер, тело)], до первой пустой или повреждённой записи"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    records = []
+    position = 0
+    while position + HEADER.size <= len(data):
+        length, crc, seq = HEADER.unpack_from(data, position)
+        if length == 0:
+            break
+        end = position + HEADER.size + length
+        if end > len(data):
+            log.warning("Truncated journal record %d in %s", seq, path)
+            break
+        payload = data[position + HEADER.size:end]
+        if zlib.crc32(payload) != crc:
+            # Запись оборвалась при падении - дальше в сегменте ничего достоверного нет
+            log.warning("Corrupted journal record %d in %s", seq, path)
+            break
+        records.append((seq, payload))
+        position = end
+    return records
+
+
+class UpdateJournal:
+    def __init__(self, directory=JOURNAL_DIR, segment_bytes=JOURNAL_SEGMENT_BYTES,
+                 fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Ждущие сброса commit() и сам поток сброса ждут на разных условиях: иначе каждая
+        # новая запись будила бы всех, кто ждёт commit
+        self._cond = threading.Condition(self._lock)
+        self._flush_cond = threading.Condition(self._lock)
+        # Удерживается на время msync и закрытия сегмента; не держит добавление записей.
+        # Если нужны обе блокировки, _sync_lock берётся первой
+        self._sync_lock = threading.Lock()
+        self._ack_lock = threading.Lock()
+        self._segment = None
+        # Заполненные сегменты, которые ещё не сброшены на диск и не закрыты
+        self._rolled = []
+        # Закрытые сегменты, в которых могут быть неподтверждённые записи: [(последний номер, путь)]
+        self._old_segments = []
+        self._acked = set()
+        self._acks = 0
+        self._closed = False
+        self.fsyncs = 0
+
+        self._watermark, acked = self._read_checkpoint()
+        self._acked.update(acked)
+        self._checkpointed = (self._watermark, self._acks)
+        self.recovered = self._recover()
+        self._written = self._synced = self._next_seq - 1
+
+        self._flusher = threading.Thread(target=self._run, name='journal-flusher', daemon=True)
+        self._flusher.start()
+
+    # Восстановление
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE), 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+            return int(checkpoint['watermark']), {int(seq) for seq in checkpoint.get('acked', ())}
+        except FileNotFoundError:
+            return 0, set()
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Could not read journal checkpoint: %s", e)
+            return 0, set()
+
+    def _recover(self):
+        """Возвращает записи после контрольной точки: [(номер, тело)]"""
+        recovered = []
+        max_seq = self._watermark
+        for name in sorted(n for n in os.listdir(self.directory) if n.endswith(SEGMENT_SUFFIX)):
+            path = os.path.join(self.directory, name)
+            records = read_segment(path)
+            last_seq = records[-1][0] if records else int(name[:-len(SEGMENT_SUFFIX)]) - 1
+            max_seq = max(max_seq, last_seq)
+            if last_seq <= self._watermark:
+                os.remove(path)
+                continue
+            recovered.extend(r for r in records if r[0] > self._watermark and r[0] not in self._acked)
+            self._old_segments.append((last_seq, path))
+
+        # Номера, потерянные в оборванных записях, считаем подтверждёнными, иначе граница застрянет
+        present = {seq for seq, _ in recovered}
+        self._acked.update(seq for seq in range(self._watermark + 1, max_seq + 1) if seq not in present)
+        self._acked.intersection_update(range(self._watermark + 1, max_seq + 1))
+        self._advance_watermark()
+        self._next_seq = max_seq + 1
+        if recovered:
+            log.info("Recovered %d unprocessed updates from journal", len(recovered))
+        return recovered
+
+    # Запись
+
+    def append(self, payload):
+        """Дописывает запись и возвращает её номер; на диск она попадёт при ближайшем сбросе"""
+        with self._cond:
+            record_size = HEADER.size + len(payload)
+            if self._segment is None or self._segment.position + record_size > self._segment.size:
+                self._roll(record_size)
+            seq = self._next_seq
+            self._next_seq += 1
+            self._segment.write(seq, payload)
+            self._written = seq
+            if self.fsync_interval == 0:
+                self._flush_cond.notify()
+        return seq
+
+    def commit(self, seq, timeout=JOURNAL_COMMIT_TIMEOUT):
+        """Ждёт, пока запись seq будет сброшена на диск (в режиме group commit); JournalError по таймауту"""
+        if self.fsync_interval > 0:
+            return
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._synced < seq and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise JournalError(f"journal record {seq} not synced in {timeout}s")
+                self._cond.wait(remaining)
+
+    def _roll(self, record_size):
+        # Вызывается под self._lock. Старый сегмент сбрасывается при следующем сбросе - не под блокировкой
+        if self._segment is not None:
+            self._rolled.append(self._segment)
+        size = max(self.segment_bytes, record_size)
+        path = os.path.join(self.directory, f"{self._next_seq:020d}{SEGMENT_SUFFIX}")
+        self._segment = Segment(path, self._next_seq, size)
+
+    def _sync_locked(self):
+        """Сбрасывает всё записанное; вызывается под self._lock, на время msync блокировку отпускает"""
+        target = self._written
+        segment = self._segment
+        end = segment.position if segment is not None else 0
+        rolled = list(self._rolled)
+        self._lock.release()
+        try:
+            started = time.perf_counter()
+            with self._sync_lock:
+                # Записи до target - в заполненных сегментах целиком и в текущем до end
+                for old in rolled:
+                    old.sync(old.position)
+                    old.close()
+                    with self._lock:
+                        self._rolled.remove(old)
+                        self._old_segments.append((old.last_seq, old.path))
+                        self.fsyncs += 1
+                # Сегменты закрывает только поток сброса, поэтому текущий можно сбрасывать,
+                # даже если он уже заполнился
+                if segment is not None:
+                    segment.sync(end)
+            metrics.JOURNAL_FSYNC.observe(time.perf_counter() - started)
+        finally:
+            self._lock.acquire()
+        self.fsyncs += 1
+        self._synced = max(self._synced, target)
+        self._cond.notify_all()
+
+    def _run(self):
+        last_checkpoint = time.monotonic()
+        while True:
+            try:
+                with self._cond:
+                    if self._written == self._synced and not self._closed:
+                        self._flush_cond.wait(self.fsync_interval or CHECKPOINT_INTERVAL)
+                    elif self.fsync_interval > 0:
+                        self._flush_cond.wait(self.fsync_interval)
+                    closed = self._closed
+                    if self._written > self._synced:
+                        self._sync_locked()
+                if closed:
+                    return
+                if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    self.checkpoint()
+                    last_checkpoint = time.monotonic()
+            except Exception:
+                # Поток не должен умирать: иначе commit() ждал бы до таймаута, а журнал рос бы бесконечно
+                log.exception("Journal flush failed, retrying")
+                last_checkpoint = time.monotonic()
+                time.sleep(CHECKPOINT_INTERVAL)
+
+    # Подтверждение обработки
+
+    def ack(self, seq):
+        """Отмечает запись обработанной; порядок подтверждений не важен"""
+        with self._ack_lock:
+            if seq > self._watermark:
+                self._acked.add(seq)
+                self._acks += 1
+                self._advance_watermark()
+
+    def _advance_watermark(self):
+        while self._watermark + 1 in self._acked:
+            self._watermark += 1
+            self._acked.remove(self._watermark)
+
+    def checkpoint(self):
+        """Сохраняет подтверждённые записи и удаляет отработанные сегменты"""
+        with self._ack_lock:
+            state = (self._watermark, self._acks)
+            acked = sorted(self._acked)
+        if state == self._checkpointed:
+            return
+        watermark = state[0]
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'watermark': watermark, 'acked': acked}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._checkpointed = state
+
+        with self._lock:
+            done = [path for last_seq, path in self._old_segments if last_seq <= watermark]
+            self._old_segments = [(last_seq, path) for last_seq, path in self._old_segments if last_seq > watermark]
+        for segment_path in done:
+            try:
+                os.remove(segment_path)
+            except OSError as e:
+                log.warning("Could not remove journal segment %s: %s", segment_path, e)
+
+    def close(self):
+        """Сбрасывает записи и контрольную точку на диск; неподтверждённые записи останутся для повтора"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._flush_cond.notify()
+        self._flusher.join(5)
+        self.checkpoint()
+        # Порядок блокировок тот же, что в _sync_locked: сначала _sync_lock, потом _lock
+        with self._sync_lock, self._lock:
+            for old in self._rolled:
+                old.sync(old.position)
+                old.close()
+                self._old_segments.append((old.last_seq, old.path))
+            self._rolled = []
+            if self._segment is not None:
+                self._segment.sync(self._segment.position)
+                self._segment.close()
+                self._segment = None
+
+    def stats(self):
+        return {
+            'written': self._written,
+            'synced': self._synced,
+            'watermark': self._watermark,
+            'backlog': self._written - self._watermark - len(self._acked),
+            'fsyncs': self.fsyncs,
+            'segments': len(self._old_segments) + len(self._rolled) + (1 if self._segment is not None else 0),
+        }
@@ -0,0 +1,153 @@
+"""Микробатчинг запросов к LLM от разных пользователей.
+
+Однотипные запросы (например, переписывание шага), пришедшие в течение
+LLM_BATCH_WINDOW_MS, отправляются одним промптом: каждый запрос - отдельный
+пронумерованный блок, модель отвечает JSON-массивом ответов. Ответ
+раскладывается по вызывающим; если его не удалось разобрать, недостающие
+ответы запрашиваются обычными одиночными запросами. Ошибка самого запроса
+(таймаут, открытый предохранитель) достаётся всем запросам пачки - повторять
+их по одному значило бы умножить нагрузку на и без того сбоящий Gemini.
+
+В пачке оказываются тексты разных пользователей, поэтому каждый запрос
+обрамлён метками со случайным для пачки ключом: текст пользователя не может
+закрыть свой блок и выдать себя за инструкцию или за чужой запрос. По
+умолчанию пачки выключены (LLM_BATCH_ENABLED=0).
+"""
+import os
+import re
+import json
+import asyncio
+import secrets
+
+import metrics
+from logging_setup import get_logger
+
+LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "0") == "1"
+# Сколько ждать попутных запросов после первого, мс
+LLM_BATCH_WINDOW_MS = float(os.getenv("LLM_BATCH_WINDOW_MS", 10))
+# Больше запросов в одном промпте - длиннее ответ и выше риск ошибки разбора
+LLM_BATCH_MAX = int(os.getenv("LLM_BATCH_MAX", 8))
+
+log = get_logger('llm')
+
+JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+
+def build_batch_prompt(template, prompts, boundary=None):
+    """Собирает промпт из шаблона prompts/batch.txt и пронумерованных запросов.
+
+    Каждый запрос - между метками <<<ЗАПРОС n boundary>>> и <<<КОНЕЦ n boundary>>>;
+    boundary случаен для каждой пачки, поэтому подделать метку в тексте запроса нельзя.
+    """
+    boundary = boundary or secrets.token_hex(8)
+    items = '\n\n'.join(f"<<<ЗАПРОС {number} {boundary}>>>\n{prompt.strip()}\n<<<КОНЕЦ {number} {boundary}>>>"
+                        for number, prompt in enumerate(prompts, 1))
+    return (template.replace('{count}', str(len(prompts))).replace('{boundary}', boundary)
+            .replace('{items}', items))
+
+
+def parse_batch_response(text, count):
+    """Возвращает список из count ответов (None - ответа на запрос нет); ValueError, если ответ не JSON"""
+    match = JSON_ARRAY_RE.search(text)
+    if not match:
+        raise ValueError("no JSON array in batch response")
+    items = json.loads(match.group(0))
+    if not isinstance(items, list):
+        raise ValueError("batch response is not a list")
+
+    answers = [None] * count
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        number, answer = item.get('id'), item.get('answer')
+        if isinstance(number, int) and 1 <= number <= count and isinstance(answer, str) and answer.strip():
+            answers[number - 1] = answer
+    return answers
+
+
+class MicroBatcher:
+    """Собирает однотипные запросы в пачки.
+
+    send(prompt, kind) - корутина одиночного запроса к LLM; load_template() -
+    возвращает шаблон пакетного промпта с переменными {count} и {items}.
+    """
+
+    def __init__(self, send, load_template, window=LLM_BATCH_WINDOW_MS / 1000, max_size=LLM_BATCH_MAX):
+        self.send = send
+        self.load_template = load_template
+        self.window = window
+        self.max_size = max_size
+        # kind -> [(prompt, future)], ещё не отправленные
+        self._pending = {}
+        self._timers = {}
+        # Ссылки на отправляющие задачи, чтобы их не собрал сборщик мусора
+        self._running = set()
+
+    async def submit(self, prompt, kind):
+        """Возвращает ответ LLM на prompt; запрос может уйти в составе пачки"""
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.setdefault(kind, [])
+        batch.append((prompt, future))
+        if len(batch) >= self.max_size:
+            self._flush(kind)
+        elif kind not in self._timers:
+            self._timers[kind] = asyncio.get_running_loop().call_later(self.window, self._flush, kind)
+        return await future
+
+    def _flush(self, kind):
+        timer = self._timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(kind, [])
+        # Ответ уже никому не нужен - не тратим на него запрос
+        batch = [(prompt, future) for prompt, future in batch if not future.cancelled()]
+        if batch:
+            task = asyncio.create_task(self._run(kind, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, kind, batch):
+        metrics.LLM_BATCH_SIZE.labels(kind).observe(len(batch))
+        if len(batch) == 1:
+            await self._single(kind, *batch[0])
+            return
+
+        prompts = [prompt for prompt, _ in batch]
+        template = self.load_template()
+        answers = [None] * len(batch)
+        if not template:
+            log.warning("Batch prompt template not found, sending %d %s requests one by one", len(batch), kind)
+        else:
+            try:
+                text = await self.send(build_batch_prompt(template, prompts), f'{kind}_batch')
+            except Exception as e:
+                # Gemini недоступен - одиночные запросы упали бы так же
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            try:
+                answers = parse_batch_response(text, len(batch))
+            except ValueError as e:
+                log.warning("Could not parse batched %s response for %d items, falling back to single requests: %s",
+                            kind, len(batch), e)
+
+        missing = []
+        for (prompt, future), answer in zip(batch, answers):
+            if answer is None:
+                missing.append((prompt, future))
+            elif not future.done():
+                future.set_result(answer)
+        if missing:
+            metrics.LLM_BATCH_FALLBACKS.labels(kind).inc(len(missing))
+            await asyncio.gather(*(self._single(kind, prompt, future) for prompt, future in missing))
+
+    async def _single(self, kind, prompt, future):
+        try:
+            result = await self.send(prompt, kind)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
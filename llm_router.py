@@ -0,0 +1,193 @@
+"""Выбор модели LLM по задержке и ошибкам и хеджированные запросы.
+
+Для каждой пары (модель, тип промпта) хранится скользящее окно последних
+запросов: задержки успешных и доля ошибок. Запрос уходит в самую быструю
+(по медиане) здоровую модель. Если ответа нет дольше p90 этой модели, тот же
+промпт отправляется второй модели (или ещё раз той же, если модель одна):
+используется первый успешный ответ, второй запрос отменяется. Чтобы хеджи не
+удваивали нагрузку, их доля ограничена LLM_HEDGE_MAX_RATIO, а если у общего
+лимита запросов нет свободного слота, хедж не отправляется.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+
+import metrics
+from logging_setup import get_logger
+
+# Модели через запятую; первая - модель по умолчанию, пока нет статистики
+LLM_MODELS = [name.strip() for name in (os.getenv("LLM_MODELS") or os.getenv(
+    "GEMINI_MODEL", "gemini-2.5-flash-lite-preview-06-17")).split(',') if name.strip()]
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+# Не больше такой доли запросов получает второй, хеджирующий запрос
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", 0.1))
+# Модель с долей ошибок выше порога не выбирается, пока есть здоровые
+LLM_MAX_ERROR_RATE = float(os.getenv("LLM_MAX_ERROR_RATE", 0.5))
+
+# Размер скользящего окна запросов на модель и тип промпта
+WINDOW = 100
+# Пока запросов меньше, p90 не считается и хедж не отправляется; такие модели опрашиваются в первую очередь
+MIN_SAMPLES = 5
+# Доля запросов, которые уходят не лучшей модели, чтобы статистика остальных не устаревала
+EXPLORE_RATE = 0.05
+# Раньше этого хедж не отправляется, даже если p90 меньше, с
+MIN_HEDGE_DELAY = 0.05
+
+log = get_logger('llm')
+
+
+class ModelStats:
+    """Скользящее окно запросов одной модели для одного типа промпта"""
+
+    def __init__(self, window=WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self._lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(latency)
+
+    def quantile(self, q):
+        with self._lock:
+            values = sorted(self.latencies)
+        if len(values) < MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def error_rate(self):
+        with self._lock:
+            outcomes = list(self.outcomes)
+        return 0.0 if not outcomes else 1 - sum(outcomes) / len(outcomes)
+
+    def samples(self):
+        return len(self.outcomes)
+
+    def snapshot(self):
+        p50, p90 = self.quantile(0.5), self.quantile(0.9)
+        return {
+            'samples': self.samples(),
+            'p50_ms': None if p50 is None else round(p50 * 1000, 1),
+            'p90_ms': None if p90 is None else round(p90 * 1000, 1),
+            'error_rate': round(self.error_rate(), 3),
+        }
+
+
+class ModelRouter:
+    def __init__(self, models=None, hedge=LLM_HEDGE_ENABLED, hedge_max_ratio=LLM_HEDGE_MAX_RATIO,
+                 max_error_rate=LLM_MAX_ERROR_RATE):
+        self.models = list(models or LLM_MODELS)
+        self.hedge = hedge
+        self.hedge_max_ratio = hedge_max_ratio
+        self.max_error_rate = max_error_rate
+        self._stats = {}
+        self._lock = threading.Lock()
+        # Недавние запросы: был ли у каждого хедж - для ограничения доли хеджей
+        self._hedged = deque(maxlen=WINDOW)
+
+    def stats(self, model, kind):
+        key = (model, kind)
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key, ModelStats())
+        return stats
+
+    def ranked(self, kind):
+        """Модели от лучшей к худшей для этого типа промпта"""
+        def score(model):
+            stats = self.stats(model, kind)
+            p50 = stats.quantile(0.5)
+            unhealthy = stats.samples() >= MIN_SAMPLES and stats.error_rate() > self.max_error_rate
+            # Без статистики модель идёт первой, чтобы её набрать; порядок LLM_MODELS - при равенстве
+            return (unhealthy, p50 is not None, p50 or 0.0, self.models.index(model))
+
+        ranked = sorted(self.models, key=score)
+        if len(ranked) > 1 and random.random() < EXPLORE_RATE:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    def _hedge_allowed(self):
+        return self.hedge and sum(self._hedged) < self.hedge_max_ratio * max(len(self._hedged), 1 / self.hedge_max_ratio)
+
+    async def call(self, kind, send, reserve=None):
+        """Выполняет send(model) в лучшей модели с хеджем; возвращает (ответ, модель).
+
+        reserve() - занимает слот для хеджа и возвращает функцию его освобождения или None,
+        если слота нет (тогда хедж не отправляется).
+        """
+        ranked = self.ranked(kind)
+        primary = ranked[0]
+        backup = ranked[1] if len(ranked) > 1 else primary
+
+        # Попытки, отменённые потому, что другая уже ответила, - в отличие от отмены по таймауту или остановке
+        losers = set()
+        first = asyncio.create_task(self._timed(send, primary, kind, losers))
+        attempts = {first: primary}
+
+        delay = self.stats(primary, kind).quantile(0.9)
+        hedged = False
+        try:
+            if delay is not None and self._hedge_allowed():
+                done, _ = await asyncio.wait(set(attempts), timeout=max(delay, MIN_HEDGE_DELAY))
+                release = reserve() if not done and reserve is not None else None
+                if not done and reserve is not None and release is None:
+                    metrics.LLM_HEDGES_SKIPPED.labels(kind).inc()
+                    log.debug("Not hedging %s request: no free slot", kind)
+                elif not done:
+                    hedged = True
+                    log.debug("Hedging %s request: %s slower than p90 %.0f ms, sending to %s",
+                              kind, primary, delay * 1000, backup)
+                    hedge = asyncio.create_task(self._timed(send, backup, kind, losers))
+                    if release is not None:
+                        # Через колбэк: отменённая до запуска задача тоже освобождает слот
+                        hedge.add_done_callback(lambda _: release())
+                    attempts[hedge] = backup
+            self._hedged.append(hedged)
+
+            error = None
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = attempts[task]
+                        if hedged:
+                            metrics.LLM_HEDGES.labels(kind, 'primary' if task is first else 'hedge').inc()
+                        metrics.LLM_ROUTED.labels(kind, winner).inc()
+                        losers.update(pending)
+                        return task.result(), winner
+                    error = task.exception()
+            raise error
+        finally:
+            # Проигравший запрос больше не нужен
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+
+    async def _timed(self, send, model, kind, losers=()):
+        started = time.perf_counter()
+        try:
+            result = await send(model)
+        except asyncio.CancelledError:
+            # Проигравший хедж: ответ занял бы не меньше, чем уже прошло. Без этой нижней оценки
+            # в окне остались бы только быстрые ответы медленной модели, и её p50 и p90 занижались бы.
+            # Любая другая отмена - таймаут запроса или остановка бота - считается ошибкой модели
+            lost = asyncio.current_task() in losers
+            self.stats(model, kind).record(time.perf_counter() - started, lost)
+            raise
+        except Exception:
+            self.stats(model, kind).record(time.perf_counter() - started, False)
+            raise
+        self.stats(model, kind).record(time.perf_counter() - started, True)
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            items = sorted(self._stats.items())
+        return {f"{model}/{kind}": stats.snapshot() for (model, kind), stats in items}
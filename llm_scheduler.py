@@ -0,0 +1,135 @@
+"""Планировщик запросов к LLM: общий лимит, приоритеты и честная очередь по пользователям.
+
+Одновременно к Gemini уходит не больше LLM_MAX_CONCURRENCY запросов, остальные
+ждут в очереди. Слот занимает каждый запрос к Gemini, а не логический запрос
+бота: повтор после ошибки встаёт в очередь заново (пауза перед ним слот не
+держит), а хедж получает отдельный слот, только если тот свободен сразу. Очередь разбита на классы приоритета: первая декомпозиция
+задачи, вопросы по задаче, переписывание (шага или всей задачи) и фоновая
+подготовка вариантов. Свободный слот достаётся запросу самого приоритетного
+непустого класса. Внутри класса работает взвешенная честная очередь (WFQ) по
+пользователям: пользователь, отправивший много запросов подряд, не отодвигает
+того, кто пришёл с первым запросом.
+
+Пользователь и приоритет передаются через contextvars: пользователь
+выставляется при обработке апдейта, приоритет выводится из типа промпта, а
+with priority(...) может его понизить (но не повысить): так повторная
+декомпозиция по "Переписать всё" идёт после первых декомпозиций, а фоновая
+подготовка вариантов внутри неё остаётся фоновой.
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import contextlib
+import contextvars
+
+import metrics
+
+# Запросов к Gemini одновременно; 0 - без ограничения
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 16))
+
+# Классы приоритета: меньше - раньше
+FIRST_DECOMPOSE, QUESTIONS, REWRITE, BACKGROUND = range(4)
+PRIORITY_NAMES = ('first_decompose', 'questions', 'rewrite', 'background')
+
+KIND_PRIORITY = {
+    'decompose': FIRST_DECOMPOSE,
+    'questions': QUESTIONS,
+    'questions_batch': QUESTIONS,
+    'overview': QUESTIONS,
+    'rewrite': REWRITE,
+    'rewrite_batch': REWRITE,
+    'alternatives': BACKGROUND,
+}
+
+# Больше пользователей с тегами - теги, которые уже не влияют на очередь, удаляются
+MAX_TRACKED_USERS = 10000
+
+current_user = contextvars.ContextVar('llm_user', default=None)
+_priority = contextvars.ContextVar('llm_priority', default=None)
+
+
+@contextlib.contextmanager
+def priority(value):
+    """Запросы к LLM внутри блока получают класс приоритета не выше value"""
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        # Класс приоритета -> куча (finish tag, порядковый номер, future)
+        self._queues = [[] for _ in PRIORITY_NAMES]
+        # Пользователь -> finish tag его последнего запроса
+        self._finish = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+    def _waiting(self):
+        return sum(len(q) for q in self._queues)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, kind):
+        """Занимает слот для запроса типа kind, ожидая своей очереди"""
+        level = max(KIND_PRIORITY.get(kind, REWRITE), _priority.get() or 0)
+        started = time.perf_counter()
+
+        if not self.max_concurrency or (self.active < self.max_concurrency and not self._waiting()):
+            self.active += 1
+        else:
+            user = current_user.get()
+            # WFQ: запрос пользователя встаёт после его предыдущего, но не раньше текущего виртуального времени
+            finish = max(self._virtual_time, self._finish.get(user, 0.0)) + 1.0
+            self._finish[user] = finish
+            if len(self._finish) > MAX_TRACKED_USERS:
+                self._finish = {u: f for u, f in self._finish.items() if f > self._virtual_time}
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queues[level], (finish, next(self._seq), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Слот успели передать, но запрос уже не нужен - отдаём слот следующему
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+
+        metrics.LLM_QUEUE_WAIT.labels(PRIORITY_NAMES[level]).observe(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def try_reserve(self):
+        """Занимает слот, только если он свободен и никто его не ждёт.
+
+        Возвращает функцию, освобождающую слот, или None, если свободного слота нет.
+        """
+        if self.max_concurrency and (self.active >= self.max_concurrency or self._waiting()):
+            return None
+        self.active += 1
+        return self._release
+
+    def _release(self):
+        for queue in self._queues:
+            while queue:
+                finish, _, future = heapq.heappop(queue)
+                if future.cancelled():
+                    continue
+                # Слот переходит следующему запросу, не освобождаясь
+                self._virtual_time = max(self._virtual_time, finish)
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'limit': self.max_concurrency,
+            'waiting': {name: len(queue) for name, queue in zip(PRIORITY_NAMES, self._queues)},
+        }
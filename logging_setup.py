@@ -0,0 +1,123 @@
+"""Структурированное логирование без блокировок на горячем пути.
+
+Записи уходят в очередь через QueueHandler и форматируются в JSON отдельным
+потоком QueueListener, поэтому обработчики апдейтов не ждут stdout. Форматирование
+сообщения тоже откладывается до потока записи: в очередь кладётся сама запись
+с аргументами. Для шумных категорий можно задать долю сохраняемых записей.
+
+Настройки:
+    LOG_LEVEL=INFO                                  - общий уровень
+    LOG_FORMAT=json                                 - json или text
+    LOG_LEVELS=bot.debug=DEBUG,bot.timer=WARNING    - уровни отдельных категорий
+    LOG_SAMPLING=bot.webhook=0.01,bot.updates=0.1   - доля сохраняемых записей ниже WARNING
+"""
+import os
+import sys
+import json
+import queue
+import random
+import logging
+import logging.handlers
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# Корневой логгер бота; категории - его дочерние логгеры (bot.webhook, bot.timer, ...)
+ROOT_LOGGER = "bot"
+
+# Стандартные атрибуты LogRecord, которые не попадают в JSON как дополнительные поля
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+
+
+def _parse_mapping(spec):
+    result = {}
+    for item in spec.split(','):
+        name, _, value = item.strip().partition('=')
+        if name and value:
+            result[name.strip()] = value.strip()
+    return result
+
+
+class JSONFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra= добавляются на верхний уровень"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в потоке вызова.
+
+    Стандартный prepare() вызывает format() прямо в обработчике апдейта - именно
+    этого мы и избегаем. Аргументы сообщения - числа и строки, поэтому их можно
+    безопасно отформатировать позже в потоке записи.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Оставляет долю rate записей ниже WARNING; предупреждения и ошибки проходят всегда"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def setup_logging():
+    """Настраивает логгер бота; повторный вызов ничего не делает"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'text':
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    else:
+        stream_handler.setFormatter(JSONFormatter())
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.propagate = False
+
+    for name, level in _parse_mapping(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+    for name, rate in _parse_mapping(LOG_SAMPLING).items():
+        logging.getLogger(name).addFilter(SamplingFilter(float(rate)))
+
+
+def flush_logging():
+    """Дописывает все записи из очереди (при завершении процесса)"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(category):
+    """Логгер категории: get_logger('timer') -> bot.timer"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{category}" if category else ROOT_LOGGER)
@@ -0,0 +1,108 @@
+"""Контроль здоровья event loop бота.
+
+Корутина-пульс раз в LOOP_MONITOR_INTERVAL засыпает и замеряет, насколько позже
+положенного её разбудили - это задержка планирования (lag). Если пульса нет
+дольше LOOP_STALL_THRESHOLD, сторожевой поток снимает стек потока event loop
+через sys._current_frames(): в стеке видно, какой синхронный вызов его держит.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+
+import metrics
+from logging_setup import get_logger
+
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))
+# Через сколько секунд без пульса event loop считается заблокированным
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.25))
+
+# Сколько последних блокировок хранить и сколько кадров стека снимать
+STALL_HISTORY = 20
+STACK_LIMIT = 30
+
+log = get_logger('loop')
+
+
+class LoopMonitor:
+    def __init__(self, interval=LOOP_MONITOR_INTERVAL, stall_threshold=LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.loop_thread_id = None
+        self.last_beat = None
+        self.max_lag = 0.0
+        self.stalls = deque(maxlen=STALL_HISTORY)
+        self.stalls_total = 0
+        self._stall = None
+        self._stall_beat = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+
+    def start(self):
+        """Запускает пульс и сторожевой поток; вызывается из потока event loop"""
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        return self._task
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _beat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            now = time.monotonic()
+            self.last_beat = now
+            self.max_lag = max(self.max_lag, lag)
+            metrics.LOOP_LAG.observe(lag)
+
+            if self._stall is not None:
+                with self._lock:
+                    stall, self._stall = self._stall, None
+                    stall['duration_ms'] = round((now - self._stall_beat) * 1000, 1)
+                log.warning("Event loop was blocked for %.0f ms", stall['duration_ms'],
+                            extra={'stack': stall['stack']})
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            beat = self.last_beat
+            blocked_for = time.monotonic() - beat
+            if blocked_for < self.interval + self.stall_threshold:
+                continue
+            with self._lock:
+                # Одну блокировку снимаем один раз
+                if self._stall is not None and self._stall_beat == beat:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame, limit=STACK_LIMIT)) if frame is not None else ''
+                self._stall = {'at': round(time.time(), 3), 'duration_ms': None, 'stack': stack}
+                self._stall_beat = beat
+                self.stalls.append(self._stall)
+                self.stalls_total += 1
+            metrics.LOOP_STALLS.inc()
+
+    def stalled(self):
+        """Заблокирован ли event loop прямо сейчас"""
+        return self.last_beat is not None and time.monotonic() - self.last_beat > self.interval + self.stall_threshold
+
+    def stats(self, recent=5):
+        lag = metrics.LOOP_LAG.labels()
+        return {
+            'running': self.last_beat is not None,
+            'stalled': self.stalled(),
+            'lag_p50_ms': round(lag.quantile(0.5) * 1000, 1),
+            'lag_p99_ms': round(lag.quantile(0.99) * 1000, 1),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+            'stalls_total': self.stalls_total,
+            'recent_stalls': list(self.stalls)[-recent:],
+        }
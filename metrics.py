@@ -0,0 +1,263 @@
+"""Лёгкие метрики в формате Prometheus: счётчики, gauge и гистограммы.
+
+Запись метрики - это поиск по словарю, bisect по корзинам и инкремент под
+блокировкой, порядка микросекунды, поэтому метрики включены всегда.
+"""
+import threading
+from bisect import bisect_left
+
+# Корзины гистограмм задержек по умолчанию, в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """Возвращает дочернюю метрику для набора значений меток"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self, lock):
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild(self._lock)
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Значение вычисляется при каждом чтении метрик"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(float(child.get()))}"
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds, lock):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = lock
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Грубая оценка квантиля по корзинам (верхняя граница корзины)"""
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if not total:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets, self._lock)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        with self._lock:
+            counts, total, sum_ = list(child.counts), child.count, child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            extra = (('le', _format_value(float(bound))),)
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, values, extra)} {cumulative}"
+        labels = _format_labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_format_value(sum_)}"
+        yield f"{self.name}_count{labels} {total}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Текст в формате Prometheus exposition"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Метрики бота
+WEBHOOK_REQUESTS = REGISTRY.counter('bot_webhook_requests_total', 'Запросы к /webhook', ('status',))
+WEBHOOK_DURATION = REGISTRY.histogram('bot_webhook_duration_seconds', 'Время обработки запроса /webhook',
+                                      buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+QUEUE_WAIT = REGISTRY.histogram('bot_update_queue_wait_seconds', 'Время ожидания апдейта в update_queue')
+QUEUE_DEPTH = REGISTRY.gauge('bot_update_queue_depth', 'Апдейтов в update_queue')
+UPDATE_DURATION = REGISTRY.histogram('bot_update_handler_duration_seconds', 'Время обработки апдейта по типу',
+                                     ('kind',))
+UPDATES_PROCESSED = REGISTRY.counter('bot_updates_processed_total', 'Обработанные апдейты', ('kind', 'status'))
+LLM_DURATION = REGISTRY.histogram('bot_llm_request_duration_seconds', 'Задержка запросов к Gemini', ('kind',))
+LLM_REQUESTS = REGISTRY.counter('bot_llm_requests_total', 'Запросы к Gemini', ('kind', 'status'))
+STT_DURATION = REGISTRY.histogram('bot_stt_request_duration_seconds', 'Задержка распознавания AssemblyAI')
+STT_REQUESTS = REGISTRY.counter('bot_stt_requests_total', 'Запросы к AssemblyAI', ('status',))
+TELEGRAM_DURATION = REGISTRY.histogram('bot_telegram_api_duration_seconds', 'Задержка вызовов Bot API', ('method',))
+TELEGRAM_REQUESTS = REGISTRY.counter('bot_telegram_api_requests_total', 'Вызовы Bot API', ('method', 'code'))
+TELEGRAM_RATE_LIMITED = REGISTRY.counter('bot_telegram_api_rate_limited_total', 'Ответы Bot API 429', ('method',))
+ACTIVE_TIMERS = REGISTRY.gauge('bot_active_timers', 'Работающие таймеры шагов')
+RESIDENT_SESSIONS = REGISTRY.gauge('bot_resident_sessions', 'Сессии пользователей в памяти')
+LOOP_LAG = REGISTRY.histogram('bot_event_loop_lag_seconds', 'Задержка планирования event loop',
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+LOOP_STALLS = REGISTRY.counter('bot_event_loop_stalls_total', 'Блокировки event loop дольше LOOP_STALL_THRESHOLD')
+JOURNAL_FSYNC = REGISTRY.histogram('bot_journal_fsync_seconds', 'Время сброса журнала апдейтов на диск',
+                                   buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5))
+JOURNAL_BACKLOG = REGISTRY.gauge('bot_journal_backlog', 'Записанные в журнал, но ещё не обработанные апдейты')
+DUPLICATES_DROPPED = REGISTRY.counter('bot_duplicates_dropped_total', 'Отброшенные повторные апдейты и нажатия',
+                                      ('kind',))
+REWRITES_SERVED = REGISTRY.counter('bot_rewrites_served_total', 'Переписанные шаги: из пула вариантов или запросом к LLM',
+                                   ('source',))
+LLM_BATCH_SIZE = REGISTRY.histogram('bot_llm_batch_size', 'Запросов к LLM в одной пачке', ('kind',),
+                                    buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+LLM_BATCH_FALLBACKS = REGISTRY.counter('bot_llm_batch_fallbacks_total',
+                                       'Запросы из пачки, повторённые одиночными из-за ошибки разбора', ('kind',))
+UPDATES_IN_FLIGHT = REGISTRY.gauge('bot_updates_in_flight', 'Апдейты, обрабатываемые одновременно')
+LLM_ROUTED = REGISTRY.counter('bot_llm_routed_total', 'Ответы LLM по модели, которая ответила первой', ('kind', 'model'))
+LLM_HEDGES = REGISTRY.counter('bot_llm_hedges_total', 'Хеджирующие запросы к LLM и чей ответ пришёл первым',
+                              ('kind', 'winner'))
+CIRCUIT_STATE = REGISTRY.gauge('bot_circuit_state', 'Состояние circuit breaker: 0 - замкнут, 1 - пробный запрос, 2 - разомкнут',
+                               ('backend',))
+RETRIES = REGISTRY.counter('bot_backend_retries_total', 'Повторы запросов к внешним сервисам и отказы из-за бюджета',
+                           ('backend', 'outcome'))
+DEGRADED_RESPONSES = REGISTRY.counter('bot_degraded_responses_total', 'Ответы в упрощённом режиме без Gemini/AssemblyAI',
+                                      ('kind',))
+LLM_COALESCED = REGISTRY.counter('bot_llm_coalesced_total', 'Запросы к LLM, получившие ответ уже выполняющегося такого же запроса',
+                                 ('kind',))
+LLM_QUEUE_WAIT = REGISTRY.histogram('bot_llm_queue_wait_seconds', 'Ожидание слота планировщика запросов к LLM',
+                                    ('priority',))
+DECOMPOSE_PARSED = REGISTRY.counter('bot_decompose_parsed_total',
+                                    'Разбор ответов на декомпозицию: json, repaired, text или failed', ('result',))
+DRAFTS_USED = REGISTRY.counter('bot_draft_decompositions_used_total',
+                               'Декомпозиции из черновика, полученного вместе с вопросами, без второго запроса к LLM')
+CLASSIFIER_DECISIONS = REGISTRY.counter('bot_task_classifier_decisions_total',
+                                        'Решения классификатора простых задач: ask, skip или explore', ('decision',))
+LLM_PROMPT_CHARS = REGISTRY.histogram('bot_llm_prompt_chars', 'Длина промптов к LLM в символах', ('kind',),
+                                      buckets=(250, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000, 20000))
+LLM_HEDGES_SKIPPED = REGISTRY.counter('bot_llm_hedges_skipped_total',
+                                      'Хеджи, не отправленные из-за отсутствия свободного слота планировщика', ('kind',))
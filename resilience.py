@@ -0,0 +1,188 @@
+"""Защита от сбоев внешних сервисов: circuit breaker, повторы и бюджет повторов.
+
+Circuit breaker размыкается после CIRCUIT_FAILURE_THRESHOLD ошибок подряд: пока
+он разомкнут, запросы к сервису не отправляются и сразу завершаются
+CircuitOpenError, чтобы бот мог ответить в упрощённом режиме, а не ждать
+таймаута. Через CIRCUIT_RESET_TIMEOUT секунд пропускается один пробный запрос:
+успех замыкает цепь, ошибка снова размыкает.
+
+Неудачный запрос повторяется до RETRY_MAX_ATTEMPTS раз с экспоненциальной
+задержкой и случайным разбросом (full jitter). Повторы всех сервисов берутся
+из общего бюджета: каждый обычный запрос пополняет его на RETRY_BUDGET_RATIO,
+каждый повтор тратит единицу - при массовом сбое повторы не умножают нагрузку.
+
+Повторяются и считаются сбоем сервиса только временные ошибки: таймауты,
+сетевые ошибки, ответы 429 и 5xx. Ошибка в самом запросе (400, ответ,
+заблокированный фильтрами безопасности) при повторе не исчезнет и о
+доступности сервиса ничего не говорит.
+"""
+import os
+import time
+import random
+import asyncio
+import threading
+import contextlib
+
+import httpx
+
+import metrics
+from logging_setup import get_logger
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 2))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.2))
+RETRY_MAX_DELAY = 2.0
+# Доля повторов от числа обычных запросов
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.1))
+# Запас повторов: при малом трафике несколько повторов доступны сразу
+RETRY_BUDGET_MAX = 10
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+log = get_logger('resilience')
+
+
+class CircuitOpenError(Exception):
+    """Сервис считается недоступным, запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        metrics.CIRCUIT_STATE.labels(name).set_function(lambda: _STATE_VALUES[self.state])
+
+    def allow(self):
+        """Можно ли отправить запрос; в полуоткрытом состоянии пропускается один пробный"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                if self.state != CLOSED:
+                    log.info("Circuit %s closed", self.name)
+                self.state = CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    log.warning("Circuit %s opened after %d failures", self.name, self.failures)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def release(self):
+        """Запрос отменён, не дав результата - пробный слот снова свободен"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    @property
+    def is_open(self):
+        return self.state == OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def status(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'open_for_s': round(time.monotonic() - self.opened_at, 1) if self.state == OPEN else None,
+            'rejected': self.rejected,
+        }
+
+
+class RetryBudget:
+    """Общий для всех сервисов запас повторов"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, max_tokens=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def stats(self):
+        return {'tokens': round(self.tokens, 2), 'ratio': self.ratio}
+
+
+def is_transient(error):
+    """Временная ли ошибка: таймаут, сеть, перегрузка или сбой на стороне сервиса"""
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    # google.api_core.exceptions.GoogleAPICallError хранит HTTP-код в code, httpx - в response.status_code
+    status = getattr(error, 'code', None)
+    if not isinstance(status, int):
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+async def call_with_retries(breaker, budget, call, timeout=None, attempts=RETRY_MAX_ATTEMPTS, failed=None,
+                            slot=None):
+    """Выполняет корутину call() через breaker с повторами из budget; timeout - на одну попытку, с.
+
+    failed(result) - для сервисов, которые сообщают о сбое в самом ответе: такой ответ
+    возвращается как есть, без повтора, но считается для breaker'а ошибкой.
+    slot() - асинхронный контекстный менеджер, который удерживается на время каждой попытки,
+    но не паузы между ними; его ожидание в timeout не входит.
+    """
+    if not breaker.allow():
+        raise CircuitOpenError(f"{breaker.name} circuit is open")
+    budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            async with (slot() if slot is not None else contextlib.nullcontext()):
+                result = await asyncio.wait_for(call(), timeout)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            if not is_transient(e):
+                # Сервис ответил - для breaker'а это не сбой, а повтор дал бы ту же ошибку
+                breaker.record(True)
+                raise
+            breaker.record(False)
+            if attempt >= attempts:
+                raise
+            if not budget.withdraw():
+                metrics.RETRIES.labels(breaker.name, 'no_budget').inc()
+                raise
+            if not breaker.allow():
+                raise
+            attempt += 1
+            metrics.RETRIES.labels(breaker.name, 'retried').inc()
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            log.debug("Retrying %s request in %.2f s after %s (attempt %d)", breaker.name, delay,
+                      type(e).__name__, attempt + 1)
+            await asyncio.sleep(delay)
+            continue
+        breaker.record(failed is None or not failed(result))
+        return result
@@ -0,0 +1,274 @@
+import os
+import time
+import pickle
+import asyncio
+from collections import OrderedDict
+from logging_setup import get_logger
+
+# Настройки хранения сессий
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 6 * 60 * 60))
+MAX_RESIDENT_SESSIONS = int(os.getenv("MAX_RESIDENT_SESSIONS", 10000))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", 60))
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", os.path.join(os.path.dirname(__file__), 'sessions'))
+# Выгруженные сессии старше этого срока удаляются с диска
+SESSION_SPILL_TTL_SECONDS = int(os.getenv("SESSION_SPILL_TTL_SECONDS", 30 * 24 * 60 * 60))
+# Как часто искать устаревшие файлы сессий
+SPILL_EXPIRE_INTERVAL = int(os.getenv("SPILL_EXPIRE_INTERVAL", 6 * 60 * 60))
+
+# Сколько сессий выгружаем подряд, прежде чем отдать управление event loop
+EVICTION_BATCH = 100
+
+log = get_logger('sessions')
+
+
+def read_rss_bytes():
+    """Возвращает текущий RSS процесса в байтах (или пиковый, если /proc недоступен)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SessionManager:
+    """Следит за активностью пользователей и держит в памяти ограниченное число сессий.
+
+    Сессия пользователя - это его запись в user_tasks, user_history, timer_tasks
+    и user_data приложения PTB. Неактивные дольше SESSION_TTL_SECONDS сессии и сессии
+    сверх MAX_RESIDENT_SESSIONS (по LRU) выгружаются на диск и поднимаются обратно
+    при следующем обращении пользователя.
+    """
+
+    def __init__(self, user_tasks, user_history, timer_tasks, ttl=SESSION_TTL_SECONDS,
+                 max_resident=MAX_RESIDENT_SESSIONS, storage_dir=SESSIONS_DIR, spill_ttl=SESSION_SPILL_TTL_SECONDS):
+        self.user_tasks = user_tasks
+        self.user_history = user_history
+        self.timer_tasks = timer_tasks
+        self.ttl = ttl
+        self.spill_ttl = spill_ttl
+        self.max_resident = max_resident
+        self.storage_dir = storage_dir
+        self.application = None
+
+        self._last_seen = OrderedDict()
+        # Выгруженные, но ещё не записанные на диск сессии: пишутся в потоке, см. flush()
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self.evicted_total = 0
+        self.restored_total = 0
+        self.expired_total = 0
+
+    def attach(self, application):
+        """Подключает приложение PTB, чтобы управлять его user_data"""
+        self.application = application
+        os.makedirs(self.storage_dir, exist_ok=True)
+
+    def _path(self, user_id):
+        return os.path.join(self.storage_dir, f"{user_id}.pkl")
+
+    def _has_running_timer(self, user_id):
+        timer = self.timer_tasks.get(user_id)
+        return timer is not None and not timer.done()
+
+    def touch(self, user_id, user_data=None):
+        """Отмечает активность пользователя и поднимает его сессию с диска при необходимости"""
+        # Диск проверяем только для нерезидентных пользователей - без списка всех выгруженных в памяти
+        if user_id not in self._last_seen:
+            self._restore(user_id, user_data)
+
+        self._last_seen[user_id] = time.monotonic()
+        self._last_seen.move_to_end(user_id)
+
+        if len(self._last_seen) > self.max_resident:
+            self._evict_lru()
+
+    def _restore(self, user_id, user_data):
+        snapshot = self._pending.pop(user_id, None)
+        if snapshot is None:
+            path = self._path(user_id)
+            if not os.path.exists(path):
+                return
+            try:
+                with open(path, 'rb') as f:
+                    snapshot = pickle.load(f)
+                os.remove(path)
+            except (OSError, pickle.UnpicklingError, EOFError) as e:
+                log.warning("Could not restore session %s: %s", user_id, e)
+                return
+
+        if snapshot.get('task') is not None:
+            self.user_tasks[user_id] = snapshot['task']
+        if snapshot.get('history'):
+            self.user_history[user_id] = snapshot['history']
+        if user_data is not None and snapshot.get('user_data'):
+            user_data.update(snapshot['user_data'])
+
+        self.restored_total += 1
+
+    def _evict_lru(self):
+        # Пропускаем пользователей с идущим таймером - они не холодные
+        for user_id in list(self._last_seen):
+            if len(self._last_seen) <= self.max_resident:
+                break
+            if not self._has_running_timer(user_id):
+                self.evict(user_id)
+        # touch() синхронный - запись на диск уходит в фоновую задачу
+        if self._pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def evict(self, user_id):
+        """Освобождает память сессии; на диск она попадёт при следующем flush()"""
+        self._last_seen.pop(user_id, None)
+
+        timer = self.timer_tasks.pop(user_id, None)
+        if timer is not None and not timer.done():
+            timer.cancel()
+
+        user_data = None
+        if self.application is not None:
+            user_data = self.application.user_data.get(user_id)
+        snapshot = {
+            'task': self.user_tasks.pop(user_id, None),
+            'history': self.user_history.pop(user_id, None),
+            'user_data': dict(user_data) if user_data else None,
+        }
+        if self.application is not None:
+            self.application.drop_user_data(user_id)
+            if user_id in self.application.chat_data:
+                self.application.drop_chat_data(user_id)
+
+        if any(snapshot.values()):
+            self._pending[user_id] = snapshot
+
+        self.evicted_total += 1
+
+    def _write(self, items):
+        # В потоке: pickle и запись не блокируют event loop
+        for user_id, snapshot in items:
+            try:
+                tmp_path = self._path(user_id) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, self._path(user_id))
+            except OSError as e:
+                log.warning("Could not spill session %s: %s", user_id, e)
+
+    def _remove(self, user_ids):
+        for user_id in user_ids:
+            try:
+                os.remove(self._path(user_id))
+            except FileNotFoundError:
+                pass
+
+    async def flush(self):
+        """Записывает выгруженные сессии на диск в потоке"""
+        async with self._flush_lock:
+            items = list(self._pending.items())
+            if not items:
+                return
+            await asyncio.to_thread(self._write, items)
+            stale = []
+            for user_id, snapshot in items:
+                current = self._pending.get(user_id)
+                if current is snapshot:
+                    del self._pending[user_id]
+                elif current is None:
+                    # Пользователь вернулся, пока сессия писалась, - файл уже не нужен
+                    stale.append(user_id)
+            if stale:
+                await asyncio.to_thread(self._remove, stale)
+
+    def _expire(self, deadline):
+        expired = 0
+        with os.scandir(self.storage_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.pkl'):
+                    continue
+                try:
+                    if entry.stat().st_mtime < deadline:
+                        os.remove(entry.path)
+                        expired += 1
+                except OSError:
+                    pass
+        return expired
+
+    async def expire_spilled(self):
+        """Удаляет выгруженные сессии, к которым не возвращались дольше spill_ttl"""
+        expired = await asyncio.to_thread(self._expire, time.time() - self.spill_ttl)
+        self.expired_total += expired
+        return expired
+
+    def prune_timers(self):
+        """Удаляет завершившиеся таймеры из timer_tasks"""
+        for user_id in [uid for uid, timer in self.timer_tasks.items() if timer.done()]:
+            del self.timer_tasks[user_id]
+
+    async def sweep(self):
+        """Выгружает сессии, неактивные дольше TTL"""
+        self.prune_timers()
+
+        deadline = time.monotonic() - self.ttl
+        evicted = 0
+        # _last_seen упорядочен по времени активности, самые старые - в начале
+        for user_id, last_seen in list(self._last_seen.items()):
+            if last_seen > deadline:
+                break
+            if self._has_running_timer(user_id):
+                continue
+            self.evict(user_id)
+            evicted += 1
+            if evicted % EVICTION_BATCH == 0:
+                await self.flush()
+        await self.flush()
+        return evicted
+
+    async def run_sweeper(self, interval=SESSION_SWEEP_INTERVAL):
+        """Периодически вытесняет неактивные сессии и логирует метрики памяти"""
+        log.info("Session sweeper started (ttl=%ss, max_resident=%s)", self.ttl, self.max_resident)
+        next_expire = 0
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if time.monotonic() >= next_expire:
+                    next_expire = time.monotonic() + SPILL_EXPIRE_INTERVAL
+                    expired = await self.expire_spilled()
+                    if expired:
+                        log.info("Removed %d spilled sessions older than %ss", expired, self.spill_ttl)
+                evicted = await self.sweep()
+                if evicted:
+                    stats = self.stats()
+                    log.info("Evicted %d idle sessions, resident: %d, rss: %d MB",
+                             evicted, stats['resident_sessions'], stats['rss_bytes'] // (1024 * 1024))
+            except Exception:
+                log.exception("Error in session sweeper")
+
+    async def checkpoint(self):
+        """Выгружает на диск все сессии (при остановке бота); возвращает их число"""
+        user_ids = set(self._last_seen) | set(self.user_tasks) | set(self.user_history)
+        if self.application is not None:
+            user_ids |= set(self.application.user_data)
+        for user_id in user_ids:
+            self.evict(user_id)
+        await self.flush()
+        return len(user_ids)
+
+    def resident_count(self):
+        return len(self._last_seen)
+
+    def stats(self):
+        """Метрики резидентного набора сессий"""
+        return {
+            'resident_sessions': len(self._last_seen),
+            'active_tasks': len(self.user_tasks),
+            'history_users': len(self.user_history),
+            'history_entries': sum(len(h) for h in list(self.user_history.values())),
+            'timers': len(self.timer_tasks),
+            'user_data': len(self.application.user_data) if self.application is not None else 0,
+            'pending_spills': len(self._pending),
+            'evicted_total': self.evicted_total,
+            'restored_total': self.restored_total,
+            'expired_total': self.expired_total,
+            'rss_bytes': read_rss_bytes(),
+        }
@@ -0,0 +1,49 @@
+"""Объединение одновременных одинаковых запросов к LLM (single-flight).
+
+Если такой же запрос (тот же промпт и те же параметры модели) уже выполняется,
+новый вызывающий не отправляет свой, а ждёт ответа на уже отправленный: все
+получают один и тот же результат или одну и ту же ошибку. Запрос отменяется,
+только когда его перестали ждать все вызывающие.
+"""
+import asyncio
+import hashlib
+
+import metrics
+
+
+def request_key(*parts):
+    """Ключ запроса: хэш промпта и параметров модели"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.digest()
+
+
+class SingleFlight:
+    def __init__(self):
+        # ключ -> [задача запроса, число ожидающих]
+        self._flights = {}
+
+    async def do(self, key, call, kind=''):
+        """Возвращает результат call() или уже выполняющегося запроса с тем же ключом"""
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.create_task(call())
+            flight = self._flights[key] = [task, 0]
+            task.add_done_callback(lambda _: self._flights.pop(key, None) if self._flights.get(key) is flight else None)
+        else:
+            metrics.LLM_COALESCED.labels(kind).inc()
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not flight[0].done():
+                # Ответ больше никому не нужен; новые вызывающие отправят свой запрос
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight[0].cancel()
+
+    def __len__(self):
+        return len(self._flights)
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import itertools
+import threading
+from array import array
+
+# События шага
+STEP_START = 0
+STEP_DONE = 1
+STEP_SKIP = 2
+STEP_BACK = 3
+
+EVENT_NAMES = {STEP_START: 'start', STEP_DONE: 'done', STEP_SKIP: 'skip', STEP_BACK: 'back'}
+
+# Максимум событий в памяти; при переполнении отбрасывается самая старая четверть
+STEP_EVENTS_CAPACITY = int(os.getenv("STEP_EVENTS_CAPACITY", 2_000_000))
+
+# Колонки журнала: имя -> typecode массива
+COLUMNS = (
+    ('user_id', 'q'),
+    ('task_id', 'q'),
+    ('step', 'h'),
+    ('steps_total', 'h'),
+    ('kind', 'b'),
+    ('ts', 'd'),
+    ('estimate_s', 'f'),
+    ('actual_s', 'f'),
+)
+
+FILE_MAGIC = b'STEPEV1\n'
+
+# Идентификаторы задач уникальны и между перезапусками
+_task_ids = itertools.count(time.time_ns() // 1000)
+
+
+def new_task_id():
+    """Возвращает новый идентификатор задачи"""
+    return next(_task_ids)
+
+
+class StepEventLog:
+    """Колоночный журнал событий шагов на массивах array.array.
+
+    Каждое событие занимает 37 байт вместо сотен байт у словаря, а колонки
+    отдаются в numpy без копирования (см. analytics.py).
+    """
+
+    def __init__(self, capacity=STEP_EVENTS_CAPACITY):
+        self.capacity = capacity
+        self.columns = {name: array(code) for name, code in COLUMNS}
+        # record идёт из event loop, snapshot - из потока выгрузки и аналитики
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.columns['kind'])
+
+    def record(self, user_id, task_id, step, steps_total, kind, estimate_s, actual_s=float('nan'), ts=None):
+        """Добавляет событие шага"""
+        c = self.columns
+        with self._lock:
+            if len(self) >= self.capacity:
+                self._drop_oldest(self.capacity // 4)
+            c['user_id'].append(user_id)
+            c['task_id'].append(task_id)
+            c['step'].append(step)
+            c['steps_total'].append(steps_total)
+            c['kind'].append(kind)
+            c['ts'].append(time.time() if ts is None else ts)
+            c['estimate_s'].append(estimate_s)
+            c['actual_s'].append(actual_s)
+
+    def _drop_oldest(self, count):
+        # Вызывается под self._lock
+        for column in self.columns.values():
+            del column[:count]
+
+    def snapshot(self):
+        """Возвращает согласованную копию колонок (безопасно читать из другого потока)"""
+        with self._lock:
+            n = len(self)
+            return {name: column[:n] for name, column in self.columns.items()}
+
+    def dump(self, path):
+        """Сохраняет журнал в бинарный файл"""
+        columns = self.snapshot()
+        header = {name: [column.typecode, len(column)] for name, column in columns.items()}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(FILE_MAGIC)
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for name, _ in COLUMNS:
+                columns[name].tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, capacity=STEP_EVENTS_CAPACITY):
+        """Загружает журнал, сохранённый методом dump"""
+        log = cls(capacity)
+        with open(path, 'rb') as f:
+            if f.readline() != FILE_MAGIC:
+                raise ValueError(f"Not a step events file: {path}")
+            header = json.loads(f.readline())
+            for name, _ in COLUMNS:
+                typecode, length = header[name]
+                log.columns[name].fromfile(f, length)
+        return log
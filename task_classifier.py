@@ -0,0 +1,217 @@
+"""Локальный классификатор: нужны ли уточняющие вопросы к задаче.
+
+Логистическая регрессия по хэшированным символьным n-граммам (2-4 символа) текста
+задачи. Предсказание - сумма нескольких десятков весов, десятки микросекунд
+без обращения к Gemini. Если задача простая ("помыть посуду") с вероятностью не
+ниже TASK_CLASSIFIER_THRESHOLD, бот сразу декомпозирует её, без вопросов и
+ожидания ответа пользователя.
+
+Обучается на журнале TASK_LABELS_PATH, который пишет сам бот: после показа
+вопросов пользователь либо нажал "Пропустить контекст" (вопросы не нужны,
+метка 1), либо ответил на них (метка 0). В журнале - тексты задач без id
+пользователей; адреса, ссылки, @имена и длинные числа маскируются. Журнал
+пишется по файлу на день, файлы старше TASK_LABELS_RETENTION_DAYS удаляются.
+
+Запуск из командной строки:
+    python task_classifier.py train task_labels.*.jsonl --out models/task_classifier.json
+    python task_classifier.py predict models/task_classifier.json "помыть посуду"
+"""
+import os
+import re
+import sys
+import glob
+import json
+import math
+import time
+import zlib
+import random
+import argparse
+import calendar
+import threading
+
+# Файл обученной модели (нет файла - вопросы задаются всегда)
+TASK_CLASSIFIER_PATH = os.getenv("TASK_CLASSIFIER_PATH", "models/task_classifier.json")
+# С какой вероятности "вопросы не нужны" пропускать их
+TASK_CLASSIFIER_THRESHOLD = float(os.getenv("TASK_CLASSIFIER_THRESHOLD", 0.8))
+# Доля простых по мнению модели задач, для которых вопросы всё равно задаются - чтобы журнал пополнялся
+TASK_CLASSIFIER_EXPLORE = float(os.getenv("TASK_CLASSIFIER_EXPLORE", 0.05))
+# Журнал решений пользователей для обучения (пусто - не пишется)
+TASK_LABELS_PATH = os.getenv("TASK_LABELS_PATH", "")
+# Сколько дней хранить файлы журнала
+TASK_LABELS_RETENTION_DAYS = int(os.getenv("TASK_LABELS_RETENTION_DAYS", 30))
+
+HASH_BITS = 18
+NGRAM_SIZES = (2, 3, 4)
+
+# Что в тексте задачи может указать на человека: почта, ссылки, @имена, телефоны и номера
+REDACT_RE = re.compile(r'\S+@\S+|https?://\S+|www\.\S+|@\w+|\+?\d[\d\s()-]{4,}\d')
+
+
+def features(text):
+    """Индексы хэшированных признаков текста задачи"""
+    words = text.lower().split()
+    text = ' ' + ' '.join(words) + ' '
+    mask = (1 << HASH_BITS) - 1
+    # Длина задачи в словах - отдельный признак: короткие задачи чаще простые
+    result = {zlib.crc32(b'words:%d' % min(len(words), 10)) & mask}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            result.add(zlib.crc32(text[i:i + n].encode('utf-8')) & mask)
+    return result
+
+
+class TaskClassifier:
+    def __init__(self, weights=None, bias=0.0):
+        # Разреженные веса: индекс признака -> вес
+        self.weights = weights or {}
+        self.bias = bias
+
+    def simple_probability(self, text):
+        """Вероятность того, что уточняющие вопросы к задаче не нужны"""
+        weights = self.weights
+        score = self.bias + sum(weights.get(index, 0.0) for index in features(text))
+        return 1 / (1 + math.exp(-max(min(score, 30), -30)))
+
+    @classmethod
+    def train(cls, samples, epochs=10, learning_rate=0.1, l2=1e-5, seed=0):
+        """samples - [(текст, метка 0/1)]; SGD по логистической функции потерь"""
+        rng = random.Random(seed)
+        data = [(features(text), label) for text, label in samples]
+        model = cls()
+        weights = model.weights
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch)
+            for indices, label in data:
+                score = model.bias + sum(weights.get(index, 0.0) for index in indices)
+                gradient = 1 / (1 + math.exp(-max(min(score, 30), -30))) - label
+                model.bias -= rate * gradient
+                for index in indices:
+                    weight = weights.get(index, 0.0)
+                    weights[index] = weight - rate * (gradient + l2 * weight)
+        return model
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        weights = {str(index): round(weight, 5) for index, weight in self.weights.items() if abs(weight) > 1e-5}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'hash_bits': HASH_BITS, 'ngrams': NGRAM_SIZES, 'bias': self.bias, 'weights': weights}, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('hash_bits') != HASH_BITS or tuple(data.get('ngrams', ())) != NGRAM_SIZES:
+            raise ValueError(f"{path}: model was trained with different features")
+        return cls({int(index): weight for index, weight in data['weights'].items()}, data['bias'])
+
+
+def redact(text):
+    """Маскирует в тексте задачи почту, ссылки, @имена и длинные числа"""
+    return REDACT_RE.sub(lambda m: '0' if m.group()[-1].isdigit() else 'x', text)
+
+
+class TaskLabelLog:
+    """Дописывает в JSONL решения пользователей: пропустил вопросы (1) или ответил (0).
+
+    Файл на каждый день по UTC: task_labels.jsonl -> task_labels.2026-10-19.jsonl;
+    при переходе на новый день файлы старше retention_days удаляются.
+    """
+
+    def __init__(self, path, retention_days=TASK_LABELS_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self._base, self._ext = os.path.splitext(path)
+        self._ext = self._ext or '.jsonl'
+        self._day = None
+        self._lock = threading.Lock()
+
+    def record(self, task, simple):
+        now = time.time()
+        day = time.strftime('%Y-%m-%d', time.gmtime(now))
+        line = json.dumps({'task': redact(task), 'label': int(simple), 'ts': round(now)}, ensure_ascii=False)
+        with self._lock:
+            if day != self._day:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._day = day
+                self.expire(now)
+            with open(f"{self._base}.{day}{self._ext}", 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def expire(self, now=None):
+        """Удаляет файлы журнала старше retention_days"""
+        cutoff = (time.time() if now is None else now) - self.retention_days * 86400
+        prefix = f"{self._base}."
+        for path in glob.glob(f"{glob.escape(self._base)}.*{glob.escape(self._ext)}"):
+            try:
+                day = time.strptime(path[len(prefix):-len(self._ext)], '%Y-%m-%d')
+            except ValueError:
+                continue
+            # Файл дня удаляется, когда истёк срок хранения последней его записи
+            if calendar.timegm(day) + 86400 <= cutoff:
+                os.remove(path)
+
+
+def load_samples(paths):
+    samples = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    samples.append((record['task'], int(record['label'])))
+    return samples
+
+
+def evaluate(model, samples, threshold=TASK_CLASSIFIER_THRESHOLD):
+    """Точность и доля задач, для которых вопросы будут пропущены"""
+    skipped = correct = wrong_skips = 0
+    for text, label in samples:
+        skip = model.simple_probability(text) >= threshold
+        skipped += skip
+        correct += skip == bool(label)
+        wrong_skips += skip and not label
+    total = max(len(samples), 1)
+    return {'accuracy': correct / total, 'skipped_share': skipped / total,
+            'wrong_skips_share': wrong_skips / total}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    train = commands.add_parser('train', help="обучить модель на журналах TASK_LABELS_PATH")
+    train.add_argument('labels', nargs='+')
+    train.add_argument('--out', default=TASK_CLASSIFIER_PATH)
+    train.add_argument('--epochs', type=int, default=10)
+    train.add_argument('--holdout', type=float, default=0.2, help="доля примеров для проверки")
+    predict = commands.add_parser('predict', help="вероятность того, что вопросы не нужны")
+    predict.add_argument('model')
+    predict.add_argument('tasks', nargs='+')
+    args = parser.parse_args(argv)
+
+    if args.command == 'predict':
+        model = TaskClassifier.load(args.model)
+        for task in args.tasks:
+            print(f"{model.simple_probability(task):.3f}  {task}")
+        return
+
+    samples = load_samples(args.labels)
+    random.Random(1).shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    train_samples, test_samples = samples[:split], samples[split:]
+    model = TaskClassifier.train(train_samples, epochs=args.epochs)
+    if test_samples:
+        report = evaluate(model, test_samples)
+        print(f"holdout {len(test_samples)}: accuracy {report['accuracy']:.3f}, questions skipped for "
+              f"{report['skipped_share']:.1%}, wrongly skipped {report['wrong_skips_share']:.1%}")
+        started = time.perf_counter()
+        for text, _ in test_samples:
+            model.simple_probability(text)
+        print(f"prediction: {(time.perf_counter() - started) / len(test_samples) * 1e6:.0f} us")
+    # Итоговая модель - на всех примерах
+    TaskClassifier.train(samples, epochs=args.epochs).save(args.out)
+    print(f"trained on {len(samples)} samples -> {args.out}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from alternatives import AlternativesPool
+
+
+class TakeTest(unittest.IsolatedAsyncioTestCase):
+    async def test_generation_finishing_during_on_wait(self):
+        release = asyncio.Event()
+
+        async def generate(task_name, steps, count):
+            await release.wait()
+            return {index: [f"вариант {index}"] for index in steps}
+
+        pool = AlternativesPool(generate, max_calls=1)
+        pool.fill(1, 'task', "задача", ["Шаг 1 (5 мин): начать"])
+
+        async def on_wait():
+            # Пока правится статус, генерация успевает завершиться и сбросить entry.pending
+            release.set()
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(await pool.take(1, 'task', 0, on_wait=on_wait), "вариант 0")
+
+    async def test_waits_for_pending_generation(self):
+        async def generate(task_name, steps, count):
+            await asyncio.sleep(0.01)
+            return {index: [f"вариант {index}"] for index in steps}
+
+        pool = AlternativesPool(generate, max_calls=1)
+        pool.fill(1, 'task', "задача", ["Шаг 1 (5 мин): начать", "Шаг 2 (5 мин): продолжить"])
+        waited = []
+
+        async def on_wait():
+            waited.append(True)
+
+        self.assertEqual(await pool.take(1, 'task', 1, on_wait=on_wait), "вариант 1")
+        self.assertEqual(waited, [True])
+        # Вариантов шага больше нет, лимит запросов исчерпан - ждать нечего
+        self.assertIsNone(await pool.take(1, 'task', 1, on_wait=on_wait))
+        self.assertEqual(waited, [True])
+
+    async def test_other_task_gets_nothing(self):
+        async def generate(task_name, steps, count):
+            return {index: ["вариант"] for index in steps}
+
+        pool = AlternativesPool(generate)
+        pool.fill(1, 'task', "задача", ["Шаг 1 (5 мин): начать"])
+        self.assertIsNone(await pool.take(1, 'other', 0))
+        pool.discard(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from decomposition import DecompositionParseError, MAX_STEPS, DEFAULT_MINUTES, parse_decomposition
+
+
+class ParseDecompositionTest(unittest.TestCase):
+    def test_strict_json(self):
+        text = '{"steps": [{"minutes": 5, "text": "Открой ноутбук"}, {"minutes": 10, "text": "Напиши план"}]}'
+        self.assertEqual(parse_decomposition(text),
+                         (["Шаг 1 (5 мин): Открой ноутбук", "Шаг 2 (10 мин): Напиши план"], 'json'))
+
+    def test_fenced_json_with_text_around(self):
+        text = 'Вот план:\n```json\n{"steps": [{"minutes": 7, "text": "Налей воды"}]}\n```\nУдачи!'
+        self.assertEqual(parse_decomposition(text), (["Шаг 1 (7 мин): Налей воды"], 'repaired'))
+
+    def test_trailing_comma(self):
+        text = '{"steps": [{"minutes": 5, "text": "Встань",}, {"minutes": 5, "text": "Потянись"},]}'
+        self.assertEqual(parse_decomposition(text),
+                         (["Шаг 1 (5 мин): Встань", "Шаг 2 (5 мин): Потянись"], 'repaired'))
+
+    def test_off_schema_steps_are_repaired(self):
+        text = '{"шаги": ["Шаг 1 (3 мин): Открой почту", {"action": "Ответь на письмо", "time": "15 минут"}, {"text": "Закрой", "minutes": 0}]}'
+        steps, how = parse_decomposition(text)
+        self.assertEqual(how, 'repaired')
+        self.assertEqual(steps, ["Шаг 1 (3 мин): Открой почту", "Шаг 2 (15 мин): Ответь на письмо",
+                                 f"Шаг 3 ({DEFAULT_MINUTES} мин): Закрой"])
+
+    def test_plain_text(self):
+        text = "Конечно!\n**Шаг 1 (5 мин):** Открой документ\n- Шаг 2 (10 мин): Прочитай первый абзац\nВсё."
+        self.assertEqual(parse_decomposition(text),
+                         (["Шаг 1 (5 мин): Открой документ", "Шаг 2 (10 мин): Прочитай первый абзац"], 'text'))
+
+    def test_too_many_steps_are_truncated(self):
+        steps = ', '.join(f'{{"minutes": 5, "text": "действие {n}"}}' for n in range(MAX_STEPS + 3))
+        result, how = parse_decomposition(f'{{"steps": [{steps}]}}')
+        self.assertEqual(how, 'repaired')
+        self.assertEqual(len(result), MAX_STEPS)
+
+    def test_no_steps(self):
+        for text in ("", "Извините, не могу помочь", '{"steps": []}', '```json\n{"answer": 42}\n```'):
+            with self.subTest(text=text), self.assertRaises(DecompositionParseError):
+                parse_decomposition(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
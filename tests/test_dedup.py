@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dedup import CallbackGuard, RecentIds
+
+
+def tap(data, text, user=1, message_id=10, edit_date=0):
+    message = SimpleNamespace(message_id=message_id, text=text, caption=None, edit_date=edit_date)
+    return SimpleNamespace(from_user=SimpleNamespace(id=user), message=message, data=data)
+
+
+STEP_2 = "Шаг 2/5:\n\nОткрой документ\n\n⏱ Осталось: 04:{:02d}"
+
+
+class CallbackGuardTest(unittest.TestCase):
+    def test_double_tap_across_timer_tick_is_duplicate(self):
+        guard = CallbackGuard()
+        self.assertFalse(guard.is_duplicate(tap('next_step', STEP_2.format(59), edit_date=100), now=0))
+        self.assertTrue(guard.is_duplicate(tap('next_step', STEP_2.format(58), edit_date=101), now=0.5))
+
+    def test_same_tap_after_another_action_is_not_duplicate(self):
+        guard = CallbackGuard()
+        self.assertFalse(guard.is_duplicate(tap('next_step', STEP_2.format(59)), now=0))
+        # "Назад" с шага 3 возвращает тот же шаг 2, и "Готово" на нём - новое действие
+        self.assertFalse(guard.is_duplicate(tap('prev_step', "Шаг 3/5:\n\nСделай план\n\n⏱ Осталось: 05:00"), now=5))
+        self.assertFalse(guard.is_duplicate(tap('next_step', STEP_2.format(50)), now=10))
+
+    def test_changed_message_is_not_duplicate(self):
+        guard = CallbackGuard()
+        self.assertFalse(guard.is_duplicate(tap('rewrite_step_0', "Шаг 1 (5 мин): начать"), now=0))
+        self.assertFalse(guard.is_duplicate(tap('rewrite_step_0', "Шаг 1 (5 мин): начать иначе"), now=1))
+
+    def test_window_and_users(self):
+        guard = CallbackGuard(window=30)
+        self.assertFalse(guard.is_duplicate(tap('next_step', STEP_2.format(59)), now=0))
+        self.assertFalse(guard.is_duplicate(tap('next_step', STEP_2.format(59), user=2), now=1))
+        self.assertFalse(guard.is_duplicate(tap('next_step', STEP_2.format(59)), now=31))
+        self.assertEqual(len(guard), 2)
+
+
+class RecentIdsTest(unittest.TestCase):
+    def test_capacity_and_add(self):
+        ids = RecentIds(capacity=2)
+        self.assertFalse(ids.seen(1))
+        self.assertTrue(ids.seen(1))
+        ids.add(2)
+        ids.add(3)
+        self.assertNotIn(1, ids)
+        self.assertIn(3, ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
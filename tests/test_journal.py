@@ -0,0 +1,185 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import threading
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from journal import UpdateJournal, JournalError, Segment, HEADER, SEGMENT_SUFFIX
+
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_journal_')
+        # Очистки выполняются в обратном порядке: журналы закрываются раньше, чем удаляется папка
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def open(self, **kwargs):
+        journal = UpdateJournal(self.directory, segment_bytes=kwargs.pop('segment_bytes', 4096), **kwargs)
+        self.addCleanup(journal.close)
+        return journal
+
+    def write(self, journal, *payloads):
+        seqs = [journal.append(payload) for payload in payloads]
+        journal.commit(seqs[-1])
+        return seqs
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+class RecoverTest(JournalTestCase):
+    def test_unacked_records_are_recovered_in_order(self):
+        journal = self.open()
+        self.write(journal, b'one', b'two', b'three')
+        journal.close()
+
+        self.assertEqual(self.open().recovered, [(1, b'one'), (2, b'two'), (3, b'three')])
+
+    def test_acked_records_are_not_recovered(self):
+        journal = self.open()
+        self.write(journal, b'one', b'two', b'three', b'four')
+        journal.ack(1)
+        journal.ack(3)
+        journal.close()
+
+        reopened = self.open()
+        self.assertEqual(reopened.recovered, [(2, b'two'), (4, b'four')])
+        # Нумерация продолжается после последней записи
+        self.assertEqual(reopened.append(b'five'), 5)
+
+    def test_torn_record_stops_recovery_of_its_segment(self):
+        journal = self.open()
+        self.write(journal, b'one', b'two', b'three')
+        journal.close()
+
+        # Портим тело второй записи, как при падении посреди записи
+        path = os.path.join(self.directory, self.segments()[0])
+        with open(path, 'r+b') as f:
+            f.seek(HEADER.size + len(b'one') + HEADER.size)
+            f.write(b'XXX')
+
+        reopened = self.open()
+        self.assertEqual(reopened.recovered, [(1, b'one')])
+        # Записи после оборванной недостоверны: граница не ждёт их подтверждения
+        reopened.ack(1)
+        self.assertEqual(reopened.stats()['watermark'], 1)
+        self.assertEqual(reopened.stats()['backlog'], 0)
+        seq = reopened.append(b'four')
+        reopened.commit(seq)
+        reopened.close()
+        self.assertEqual(self.open().recovered, [(seq, b'four')])
+
+    def test_truncated_record_is_skipped(self):
+        journal = self.open()
+        self.write(journal, b'one', b'two')
+        journal.close()
+
+        # Длина в заголовке второй записи больше, чем осталось в файле
+        path = os.path.join(self.directory, self.segments()[0])
+        with open(path, 'r+b') as f:
+            f.seek(HEADER.size + len(b'one'))
+            f.write(HEADER.pack(10 ** 6, 0, 2))
+
+        self.assertEqual(self.open().recovered, [(1, b'one')])
+
+    def test_records_span_rolled_segments(self):
+        journal = self.open(segment_bytes=64)
+        payloads = [bytes([65 + i]) * 30 for i in range(5)]
+        self.write(journal, *payloads)
+        journal.close()
+
+        self.assertGreater(len(self.segments()), 1)
+        self.assertEqual([payload for _, payload in self.open(segment_bytes=64).recovered], payloads)
+
+
+class AckTest(JournalTestCase):
+    def test_watermark_advances_over_out_of_order_acks(self):
+        journal = self.open()
+        self.write(journal, b'a', b'b', b'c', b'd')
+
+        journal.ack(2)
+        journal.ack(3)
+        self.assertEqual(journal.stats()['watermark'], 0)
+        self.assertEqual(journal.stats()['backlog'], 2)
+
+        journal.ack(1)
+        self.assertEqual(journal.stats()['watermark'], 3)
+        self.assertEqual(journal.stats()['backlog'], 1)
+
+    def test_repeated_and_stale_acks_are_ignored(self):
+        journal = self.open()
+        self.write(journal, b'a', b'b')
+        journal.ack(1)
+        journal.ack(1)
+        journal.ack(2)
+        journal.ack(2)
+        self.assertEqual(journal.stats()['watermark'], 2)
+        self.assertEqual(journal.stats()['backlog'], 0)
+
+    def test_acked_set_above_watermark_survives_restart(self):
+        journal = self.open()
+        self.write(journal, b'a', b'b', b'c')
+        journal.ack(3)
+        journal.close()
+
+        reopened = self.open()
+        self.assertEqual(reopened.recovered, [(1, b'a'), (2, b'b')])
+        reopened.ack(1)
+        reopened.ack(2)
+        self.assertEqual(reopened.stats()['watermark'], 3)
+
+    def test_checkpoint_removes_fully_acked_segments(self):
+        journal = self.open(segment_bytes=64)
+        seqs = self.write(journal, *(bytes([65 + i]) * 30 for i in range(5)))
+        for seq in seqs[:-1]:
+            journal.ack(seq)
+        journal.close()
+
+        # По записи на сегмент: остаётся только сегмент с неподтверждённой последней записью
+        reopened = self.open(segment_bytes=64)
+        self.assertEqual([seq for seq, _ in reopened.recovered], [seqs[-1]])
+        self.assertEqual(len(self.segments()), 1)
+
+
+class FlushFailureTest(JournalTestCase):
+    def test_commit_fails_and_flusher_survives_sync_errors(self):
+        journal = self.open()
+        with mock.patch.object(Segment, 'sync', side_effect=OSError("disk full")), \
+                mock.patch('journal.CHECKPOINT_INTERVAL', 0.01):
+            seq = journal.append(b'lost?')
+            with self.assertRaises(JournalError):
+                journal.commit(seq, timeout=0.1)
+        # Диск снова в порядке - поток сброса жив и досбрасывает запись
+        journal.commit(seq, timeout=5)
+        self.assertTrue(journal._flusher.is_alive())
+
+    def test_close_during_slow_sync_of_rolled_segment(self):
+        journal = self.open(segment_bytes=64)
+        syncing = threading.Event()
+        original_sync = Segment.sync
+
+        def slow_sync(segment, end):
+            syncing.set()
+            time.sleep(0.2)
+            original_sync(segment, end)
+
+        with mock.patch.object(Segment, 'sync', slow_sync):
+            # Вторая запись не помещается в сегмент: первый уходит в сброс заполненных
+            journal.append(b'x' * 40)
+            journal.append(b'y' * 40)
+            self.assertTrue(syncing.wait(5))
+            # close() после таймаута join, пока поток сброса держит _sync_lock
+            with mock.patch.object(journal._flusher, 'join'):
+                closer = threading.Thread(target=journal.close, daemon=True)
+                closer.start()
+                closer.join(5)
+        self.assertFalse(closer.is_alive(), "close() deadlocked with the flusher")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import asyncio
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import llm_router
+from llm_router import ModelRouter, MIN_SAMPLES
+
+
+def router_with_history(latency=0.01):
+    """Роутер с двумя моделями, у которых уже есть статистика: p90 известен, хедж возможен"""
+    router = ModelRouter(models=['a', 'b'], hedge=True, hedge_max_ratio=1.0)
+    for model in ('a', 'b'):
+        for _ in range(MIN_SAMPLES):
+            router.stats(model, 'k').record(latency, True)
+    return router
+
+
+def fake_send(latencies):
+    async def send(model):
+        await asyncio.sleep(latencies[model])
+        return model
+    return send
+
+
+# Без случайного исследования: первой всегда идёт модель 'a'
+@mock.patch.object(llm_router, 'EXPLORE_RATE', 0)
+class HedgeAccountingTest(unittest.IsolatedAsyncioTestCase):
+    async def test_hedge_loser_is_recorded_as_lower_bound_sample(self):
+        router = router_with_history()
+        result = await router.call('k', fake_send({'a': 0.2, 'b': 0.01}))
+        self.assertEqual(result, ('b', 'b'))
+        await asyncio.sleep(0)
+
+        stats = router.stats('a', 'k')
+        self.assertEqual(stats.samples(), MIN_SAMPLES + 1)
+        self.assertEqual(stats.error_rate(), 0.0)
+        # Проигравший успел проработать хотя бы задержку до хеджа
+        self.assertGreaterEqual(max(stats.latencies), 0.05)
+
+    async def test_timeout_is_recorded_as_error(self):
+        router = router_with_history()
+        router.hedge = False
+        for _ in range(3):
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(router.call('k', fake_send({'a': 1.0, 'b': 1.0})), 0.05)
+        await asyncio.sleep(0)
+
+        stats = router.stats('a', 'k')
+        self.assertEqual(stats.samples(), MIN_SAMPLES + 3)
+        self.assertAlmostEqual(stats.error_rate(), 3 / (MIN_SAMPLES + 3))
+
+    async def test_timeout_of_hedged_request_counts_both_attempts_as_errors(self):
+        router = router_with_history()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(router.call('k', fake_send({'a': 1.0, 'b': 1.0})), 0.2)
+        await asyncio.sleep(0)
+
+        for model in ('a', 'b'):
+            self.assertAlmostEqual(router.stats(model, 'k').error_rate(), 1 / (MIN_SAMPLES + 1))
+
+    async def test_hedge_skipped_without_free_slot(self):
+        router = router_with_history()
+        calls = []
+
+        async def send(model):
+            calls.append(model)
+            await asyncio.sleep(0.1)
+            return model
+
+        self.assertEqual(await router.call('k', send, reserve=lambda: None), ('a', 'a'))
+        self.assertEqual(calls, ['a'])
+
+    async def test_hedge_slot_is_released(self):
+        router = router_with_history()
+        released = []
+        await router.call('k', fake_send({'a': 0.2, 'b': 0.01}), reserve=lambda: lambda: released.append(True))
+        await asyncio.sleep(0)
+        self.assertEqual(released, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import random
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from llm_scheduler import LLMScheduler, current_user, priority, BACKGROUND
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_never_exceeds_limit(self):
+        scheduler = LLMScheduler(max_concurrency=3)
+        running = peak = 0
+        kinds = ['decompose', 'questions', 'rewrite', 'alternatives']
+        rng = random.Random(1)
+
+        async def request(user, kind):
+            nonlocal running, peak
+            current_user.set(user)
+            async with scheduler.slot(kind):
+                running += 1
+                peak = max(peak, running)
+                # Хедж берёт второй слот, только если он свободен сразу
+                release = scheduler.try_reserve()
+                if release:
+                    running += 1
+                    peak = max(peak, running)
+                await asyncio.sleep(rng.random() / 100)
+                if release:
+                    running -= 1
+                    release()
+                running -= 1
+
+        tasks = [asyncio.create_task(request(n % 7, kinds[n % 4])) for n in range(60)]
+        # Часть ожидающих отменяется - их слоты не должны теряться или удваиваться
+        await asyncio.sleep(0.005)
+        for task in tasks[40:50]:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.assertLessEqual(peak, 3)
+        self.assertEqual(peak, 3)
+        self.assertEqual(scheduler.active, 0)
+
+    async def test_try_reserve_only_when_free_and_nobody_waits(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        release = scheduler.try_reserve()
+        self.assertIsNotNone(release)
+        self.assertIsNone(scheduler.try_reserve())
+
+        waiter = asyncio.create_task(scheduler.slot('rewrite').__aenter__())
+        await asyncio.sleep(0)
+        # Слот переходит ждущему, а не освобождается для хеджа
+        release()
+        self.assertEqual(scheduler.active, 1)
+        self.assertIsNone(scheduler.try_reserve())
+        await waiter
+        scheduler._release()
+        self.assertEqual(scheduler.active, 0)
+
+    async def test_priority_and_fair_order(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+        release = scheduler.try_reserve()
+
+        async def request(user, kind, background=False):
+            current_user.set(user)
+            if background:
+                with priority(BACKGROUND):
+                    async with scheduler.slot(kind):
+                        order.append((user, kind))
+            else:
+                async with scheduler.slot(kind):
+                    order.append((user, kind))
+
+        tasks = []
+        for user, kind, background in [('a', 'rewrite', False), ('a', 'rewrite', False), ('a', 'rewrite', False),
+                                       ('b', 'rewrite', False), ('c', 'decompose', True), ('d', 'decompose', False)]:
+            tasks.append(asyncio.create_task(request(user, kind, background)))
+            await asyncio.sleep(0)
+        release()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(order, [('d', 'decompose'), ('a', 'rewrite'), ('b', 'rewrite'),
+                                 ('a', 'rewrite'), ('a', 'rewrite'), ('c', 'decompose')])
+
+    async def test_unlimited(self):
+        scheduler = LLMScheduler(max_concurrency=0)
+        releases = [scheduler.try_reserve() for _ in range(100)]
+        self.assertNotIn(None, releases)
+
+
+if __name__ == '__main__':
+    unittest.main()
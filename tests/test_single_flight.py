@@ -0,0 +1,99 @@
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from single_flight import SingleFlight, request_key
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_identical_requests_are_coalesced(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(True)
+            await asyncio.sleep(0.01)
+            return "ответ"
+
+        key = request_key("промпт", 0.7)
+        results = await asyncio.gather(*(flight.do(key, call) for _ in range(5)))
+        self.assertEqual(results, ["ответ"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(flight), 0)
+
+    async def test_different_keys_are_not_coalesced(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(True)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        await asyncio.gather(flight.do(request_key("a"), call), flight.do(request_key("b"), call))
+        self.assertEqual(len(calls), 2)
+
+    async def test_error_is_shared_by_all_callers(self):
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("boom")
+
+        results = await asyncio.gather(*(flight.do('k', call) for _ in range(3)), return_exceptions=True)
+        self.assertEqual([type(r) for r in results], [RuntimeError] * 3)
+        self.assertEqual(len(flight), 0)
+
+    async def test_finished_request_is_not_reused(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(True)
+            return len(calls)
+
+        self.assertEqual(await flight.do('k', call), 1)
+        self.assertEqual(await flight.do('k', call), 2)
+
+    async def test_request_survives_while_someone_waits(self):
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def call():
+            await release.wait()
+            return "ответ"
+
+        first = asyncio.create_task(flight.do('k', call))
+        second = asyncio.create_task(flight.do('k', call))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await second, "ответ")
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+
+    async def test_request_cancelled_when_nobody_waits(self):
+        flight = SingleFlight()
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def call():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(flight.do('k', call))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        self.assertEqual(len(flight), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+"""Трассировка апдейтов: от прихода в /webhook до последнего вызова Bot API.
+
+Трасса создаётся в /webhook и едет через update_queue вместе с апдейтом;
+дальше текущий спан хранится в contextvars, поэтому вложенные спаны (Gemini,
+AssemblyAI, Bot API) находят родителя сами, в том числе в asyncio.to_thread.
+Когда апдейт обработан, трасса целиком либо сохраняется в файл, либо
+отбрасывается: медленные (дольше TRACE_SLOW_MS) и упавшие сохраняются всегда,
+остальные - с вероятностью TRACE_SAMPLE_RATE.
+
+Формат файла - JSONL, одна строка на спан:
+    {"trace_id", "span_id", "parent_id", "name", "start", "duration_ms", "attrs", "error"}
+"""
+import os
+import json
+import time
+import queue
+import random
+import threading
+import contextlib
+import contextvars
+
+# Файл для сохранения трасс (пусто - трассировка выключена)
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+# Трассы дольше этого порога сохраняются всегда, мс
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 2000))
+# Доля сохраняемых быстрых трасс
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+
+# Ограничение числа спанов в одной трассе (длинные циклы не раздувают память)
+MAX_SPANS_PER_TRACE = 256
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_id():
+    return os.urandom(8).hex()
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'duration', 'attrs', 'error', '_started')
+
+    def __init__(self, trace, name, parent_id, attrs):
+        self.trace = trace
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.attrs = attrs
+        self.error = None
+        self._started = time.perf_counter()
+
+    def end(self):
+        self.duration = time.perf_counter() - self._started
+        self.trace.add(self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attrs': self.attrs,
+            'error': self.error,
+        }
+
+
+class Trace:
+    """Спаны одного апдейта; корневой спан длится до вызова finish()"""
+
+    def __init__(self, name, attrs):
+        self.trace_id = _new_id()
+        self.spans = []
+        self.finished = False
+        self._lock = threading.Lock()
+        self.root = Span(self, name, None, attrs)
+
+    def add(self, span):
+        # Спаны фоновых задач (таймеров), переживших апдейт, не сохраняем
+        with self._lock:
+            if not self.finished and len(self.spans) < MAX_SPANS_PER_TRACE:
+                self.spans.append(span)
+
+    def add_span(self, name, duration, **attrs):
+        """Добавляет уже завершившийся интервал (например, ожидание в очереди)"""
+        parent = _current.get()
+        span = Span(self, name, parent.span_id if parent else self.root.span_id, attrs)
+        span.start -= duration
+        span.duration = duration
+        self.add(span)
+
+    def finish(self, error=None):
+        root = self.root
+        root.duration = time.perf_counter() - root._started
+        root.error = error
+        with self._lock:
+            self.finished = True
+            spans = [root] + self.spans
+        exporter.submit(self, spans)
+
+
+class SpanExporter:
+    """Решает, сохранять ли трассу, и пишет сохранённые в файл из отдельного потока"""
+
+    def __init__(self, path, slow_ms=TRACE_SLOW_MS, sample_rate=TRACE_SAMPLE_RATE):
+        self.path = path
+        self.slow_s = slow_ms / 1000
+        self.sample_rate = sample_rate
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.finished = 0
+        self.kept = 0
+
+    def submit(self, trace, spans):
+        self.finished += 1
+        root = trace.root
+        keep = root.error is not None or root.duration >= self.slow_s or random.random() < self.sample_rate
+        if not keep:
+            return
+        self.kept += 1
+        if self._thread is None:
+            self._start()
+        self._queue.put(spans)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                batch = [self._queue.get()]
+                # Дописываем всё, что накопилось, одной записью
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                for spans in batch:
+                    if spans is None:
+                        continue
+                    for span in spans:
+                        f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n')
+                f.flush()
+                if stop:
+                    return
+
+    def close(self, timeout=5.0):
+        """Дописывает очередь в файл и останавливает поток"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {'traces_finished': self.finished, 'traces_kept': self.kept}
+
+
+exporter = SpanExporter(TRACE_EXPORT_PATH)
+
+
+def start_trace(name, **attrs):
+    """Начинает трассу апдейта; None, если трассировка выключена"""
+    if not TRACE_EXPORT_PATH:
+        return None
+    return Trace(name, attrs)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """Делает корневой спан трассы текущим в этом контексте"""
+    if trace is None:
+        yield None
+        return
+    token = _current.set(trace.root)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """Вложенный спан; вне трассы ничего не делает"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, parent.span_id, attrs)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
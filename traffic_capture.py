@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import hmac
+import time
+import hashlib
+import threading
+
+# Файл для записи входящих апдейтов (пусто - запись выключена)
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+# Ключ для обезличивания id пользователей; одинаковый ключ даёт одинаковые id между записями
+TRAFFIC_CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT", "")
+# Сохранять ли тексты сообщений как есть (по умолчанию буквы и цифры маскируются)
+TRAFFIC_CAPTURE_KEEP_TEXT = os.getenv("TRAFFIC_CAPTURE_KEEP_TEXT", "") == "1"
+
+# Как часто сбрасывать буфер файла на диск, в секундах
+FLUSH_INTERVAL = 1.0
+
+# Поля с персональными данными, которые удаляются целиком
+PII_FIELDS = {'last_name', 'username', 'language_code', 'phone_number', 'title', 'bio',
+              'is_premium', 'added_to_attachment_menu'}
+# Обязательные для Bot API поля с персональными данными заменяются заглушкой
+PII_PLACEHOLDERS = {'first_name': 'User'}
+# Объекты, поле id которых - id пользователя или чата
+ID_OWNERS = {'from', 'chat', 'user', 'sender_chat'}
+# Поля с пользовательским текстом
+TEXT_FIELDS = {'text', 'caption'}
+# Поля с идентификаторами файлов
+FILE_ID_FIELDS = {'file_id', 'file_unique_id'}
+
+STEP_PREFIX_RE = re.compile(r'(Шаг \d+ \(\d+ мин\):?)')
+WORD_RE = re.compile(r'[^\W_]')
+
+
+class TrafficRecorder:
+    """Дописывает обезличенные апдейты в JSONL-журнал вместе со временем прихода.
+
+    Каждая строка: {"t": секунды от начала записи, "update": апдейт}.
+    id пользователей и чатов заменяются на HMAC от TRAFFIC_CAPTURE_SALT, имена
+    удаляются или заменяются заглушкой, а текст маскируется с сохранением длины и формата "Шаг N (M мин)",
+    чтобы смещения entities и разбор шагов при воспроизведении не ломались.
+    """
+
+    def __init__(self, path, salt=TRAFFIC_CAPTURE_SALT, keep_text=TRAFFIC_CAPTURE_KEEP_TEXT):
+        self.path = path
+        self.salt = (salt or os.urandom(16).hex()).encode('utf-8')
+        self.keep_text = keep_text
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last_flush = self._started
+        self.recorded = 0
+
+    def _anon_id(self, value):
+        digest = hmac.new(self.salt, str(value).encode('utf-8'), hashlib.sha256).digest()
+        # 48 бит хватает, чтобы не было коллизий, и id остаётся обычным int для Telegram
+        anon = int.from_bytes(digest[:6], 'big')
+        return -anon if isinstance(value, int) and value < 0 else anon
+
+    def _mask_text(self, text):
+        if self.keep_text or text.startswith('/'):
+            return text
+        parts = STEP_PREFIX_RE.split(text)
+        # Нечётные элементы - совпавшие префиксы шагов, их оставляем
+        return ''.join(part if i % 2 else WORD_RE.sub(lambda m: '0' if m.group().isdigit() else 'x', part)
+                       for i, part in enumerate(parts))
+
+    def anonymize(self, value, key=None):
+        """Возвращает обезличенную копию апдейта"""
+        if isinstance(value, dict):
+            result = {}
+            for k, v in value.items():
+                if k in PII_FIELDS:
+                    continue
+                if k in PII_PLACEHOLDERS:
+                    result[k] = PII_PLACEHOLDERS[k]
+                    continue
+                if k == 'id' and key in ID_OWNERS:
+                    result[k] = self._anon_id(v)
+                elif k in FILE_ID_FIELDS:
+                    result[k] = hashlib.sha256(self.salt + str(v).encode('utf-8')).hexdigest()[:32]
+                elif k in TEXT_FIELDS and isinstance(v, str):
+                    result[k] = self._mask_text(v)
+                else:
+                    result[k] = self.anonymize(v, k)
+            return result
+        if isinstance(value, list):
+            return [self.anonymize(v, key) for v in value]
+        return value
+
+    def record(self, update):
+        """Записывает апдейт в журнал (вызывается из потока Flask)"""
+        anonymized = self.anonymize(update)
+        with self._lock:
+            # Время берётся под блокировкой, чтобы строки шли в порядке прихода
+            now = time.monotonic()
+            record = {'t': round(now - self._started, 4), 'update': anonymized}
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.recorded += 1
+            if now - self._last_flush >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            self._file.close()
+
+
+def load_capture(path):
+    """Читает журнал, записанный TrafficRecorder: список пар (t, update)
+
+    Журнал дописывается между перезапусками, и время в каждом запуске начинается
+    с нуля - такие участки склеиваются подряд.
+    """
+    events = []
+    offset = 0.0
+    last_t = 0.0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record['t'] < last_t:
+                offset = events[-1][0]
+            last_t = record['t']
+            events.append((offset + record['t'], record['update']))
+    return events